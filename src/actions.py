@@ -0,0 +1,349 @@
+from datetime import datetime, timezone
+from typing import Any, Literal
+from pydantic import BaseModel
+from loguru import logger
+
+from src.checkpoint import Checkpoint
+from src.functions import search_mapping, to_aware_utc
+from src.watched import (
+    MediaIdentifiers,
+    MediaItem,
+    Ord,
+    UserData,
+    WatchedStatus,
+    check_same_identifiers,
+    compare_media_items,
+)
+
+# Positions within 10 seconds are the same state, same as compare_media_items
+POSITION_TOLERANCE = 10 * 1_000
+
+
+class SyncAction(BaseModel):
+    """
+    A single write to a server, either marking an item as watched or setting its
+    playback position. User and library are the keys of the source watched list,
+    the writers resolve them with the user and library mappings.
+    """
+
+    action: Literal["mark_watched", "set_position"]
+    user: str
+    library: str
+    identifiers: MediaIdentifiers
+    # Identifiers of the show for episodes, None for movies
+    series: MediaIdentifiers | None = None
+    # Playback position in milliseconds for set_position
+    position: int = 0
+    viewed_date: datetime
+    # Id of the item on the target server once it is known
+    target_id: str | None = None
+    # Set by the writers, satisfied when the target item already has this state,
+    # skipped when it was not written because of the ledger or a dry run
+    outcome: Literal["satisfied", "written", "skipped", "failed"] | None = None
+
+    def media_item(self) -> MediaItem:
+        return MediaItem(
+            identifiers=self.identifiers,
+            status=WatchedStatus(
+                completed=self.action == "mark_watched",
+                time=self.position,
+                viewed_date=self.viewed_date,
+            ),
+        )
+
+
+def get_action(
+    user: str,
+    library: str,
+    item: MediaItem,
+    series: MediaIdentifiers | None = None,
+) -> SyncAction:
+    return SyncAction(
+        action="mark_watched" if item.status.completed else "set_position",
+        user=user,
+        library=library,
+        identifiers=item.identifiers,
+        series=series,
+        position=0 if item.status.completed else item.status.time,
+        viewed_date=item.status.viewed_date,
+    )
+
+
+def is_satisfied(action: SyncAction, completed: bool, position: int) -> bool:
+    """
+    Whether the current state of the target item already matches the action,
+    so writing it would not change anything.
+    """
+    if action.action == "mark_watched":
+        return completed
+
+    return not completed and abs(position - action.position) <= POSITION_TOLERANCE
+
+
+def is_superseded(
+    action: SyncAction, completed: bool, position: int, viewed_date: datetime | None
+) -> bool:
+    """
+    Whether a queued action must not be replayed, because the target item already
+    has its state or was played after the action was queued.
+    """
+    if is_satisfied(action, completed, position):
+        return True
+
+    viewed = to_aware_utc(viewed_date)
+    queued = to_aware_utc(action.viewed_date)
+    return viewed is not None and queued is not None and viewed > queued
+
+
+def build_actions(watched_list: dict[str, UserData]) -> list[SyncAction]:
+    """
+    Flatten a watched list into one action per movie and episode.
+    """
+    actions: list[SyncAction] = []
+    for user, user_data in watched_list.items():
+        for library_title, library in user_data.libraries.items():
+            for movie in library.movies:
+                actions.append(get_action(user, library_title, movie))
+
+            for series in library.series:
+                for episode in series.episodes:
+                    actions.append(
+                        get_action(user, library_title, episode, series.identifiers)
+                    )
+
+    return actions
+
+
+def get_viewed_sort_key(action: SyncAction) -> datetime:
+    # viewed_date is always set, the fallback only keeps the key a datetime
+    return to_aware_utc(action.viewed_date) or datetime.min.replace(tzinfo=timezone.utc)
+
+
+def group_actions(
+    actions: list[SyncAction],
+) -> dict[str, dict[str, list[SyncAction]]]:
+    """
+    Group the actions by user and library, the writers match every library once.
+    The most recently viewed items come first, so users, libraries and shows with
+    fresh changes are written before the ones with years of old history.
+    """
+    grouped: dict[str, dict[str, list[SyncAction]]] = {}
+    for action in sorted(actions, key=get_viewed_sort_key, reverse=True):
+        grouped.setdefault(action.user, {}).setdefault(action.library, []).append(
+            action
+        )
+
+    return grouped
+
+
+def group_series_actions(
+    actions: list[SyncAction],
+) -> list[tuple[MediaIdentifiers, list[SyncAction]]]:
+    """
+    Group the episode actions by show, so every show is only searched once.
+    """
+    grouped: list[tuple[MediaIdentifiers, list[SyncAction]]] = []
+    for action in actions:
+        if action.series is None:
+            continue
+
+        for series, episode_actions in grouped:
+            if check_same_identifiers(series, action.series):
+                episode_actions.append(action)
+                break
+        else:
+            grouped.append((action.series, [action]))
+
+    return grouped
+
+
+def log_actions(actions: list[SyncAction], source: str, target: str) -> None:
+    mark_watched = sum(1 for action in actions if action.action == "mark_watched")
+    logger.info(
+        f"{source} -> {target}: {len(actions)} actions, {mark_watched} mark watched, {len(actions) - mark_watched} set position"
+    )
+    for action in actions:
+        logger.debug(
+            f"{action.action} {action.series.title + ' ' if action.series and action.series.title else ''}{action.identifiers.title} for {action.user} in {action.library}"
+        )
+
+
+def get_identifier_keys(identifiers: MediaIdentifiers) -> list[tuple[str, str]]:
+    keys = [("location", location) for location in identifiers.locations]
+    for guid in ["imdb_id", "tvdb_id", "tmdb_id"]:
+        value = getattr(identifiers, guid)
+        if value:
+            keys.append((guid, value))
+
+    return keys
+
+
+def get_mapping_key(mapping: dict[str, str] | None, value: str) -> str:
+    """
+    The same key for both sides of a mapping, so writes coming from servers with
+    different user or library names end up in the same bucket.
+    """
+    other = search_mapping(mapping, value) if mapping else None
+    return min(value.lower(), other.lower()) if other else value.lower()
+
+
+def write_actions(
+    target: Any,
+    actions: list[SyncAction],
+    user_mapping: dict[str, str] | None,
+    library_mapping: dict[str, str] | None,
+    dryrun: bool,
+    checkpoint: Checkpoint | None = None,
+    source: Any = None,
+) -> None:
+    """
+    Write the actions to the target. With a checkpoint every user library is
+    written and recorded on its own, libraries written before a restart are skipped.
+    Actions of a single pair pass their source, so pairs writing to the same target
+    do not skip each other.
+    """
+    if checkpoint is None:
+        target.update_watched(actions, user_mapping, library_mapping, dryrun)
+        return
+
+    for user, libraries in group_actions(actions).items():
+        for library, library_actions in libraries.items():
+            if checkpoint.is_written(target, user, library, source):
+                logger.info(
+                    f"Checkpoint: {user} {library} was already written to {target.info()}, skipping"
+                )
+                continue
+
+            target.update_watched(
+                library_actions, user_mapping, library_mapping, dryrun
+            )
+            checkpoint.record_write(target, user, library, source)
+
+
+def log_action_results(actions: list[SyncAction], target: str) -> None:
+    matched = [action for action in actions if action.target_id is not None]
+    outcomes = {
+        outcome: sum(1 for action in matched if action.outcome == outcome)
+        for outcome in ["written", "satisfied", "failed"]
+    }
+    skipped = len(matched) - sum(outcomes.values())
+    logger.info(
+        f"{target}: {outcomes['written']} actions written, {outcomes['satisfied']} already up to date, {skipped} skipped, {outcomes['failed']} failed, {len(actions) - len(matched)} not found"
+    )
+
+
+class PendingWrites:
+    """
+    Writes scheduled for every target during a run. With three or more servers the
+    same target item can be written by several pairs, only the winning state per
+    item according to compare_media_items is kept so every item is written once.
+    """
+
+    def __init__(
+        self,
+        env: dict[str, str | float | None],
+        user_mapping: dict[str, str] | None = None,
+        library_mapping: dict[str, str] | None = None,
+    ) -> None:
+        self.env: dict[str, str | float | None] = env
+        self.user_mapping: dict[str, str] | None = user_mapping
+        self.library_mapping: dict[str, str] | None = library_mapping
+        self.targets: list[tuple[Any, list[SyncAction]]] = []
+        # Per target, (user, library, identifier) to the indexes of its actions
+        self.indexes: list[dict[tuple[str, str, tuple[str, str]], list[int]]] = []
+        self.dropped: int = 0
+
+    def get_target_index(self, target: Any) -> int:
+        for index, (server, _) in enumerate(self.targets):
+            if server is target:
+                return index
+
+        self.targets.append((target, []))
+        self.indexes.append({})
+        return len(self.targets) - 1
+
+    def find(self, target_index: int, action: SyncAction) -> int | None:
+        _, actions = self.targets[target_index]
+        bucket = (
+            get_mapping_key(self.user_mapping, action.user),
+            get_mapping_key(self.library_mapping, action.library),
+        )
+        for key in get_identifier_keys(action.identifiers):
+            for index in self.indexes[target_index].get((*bucket, key), []):
+                existing = actions[index]
+                # Episode file names are only unique within their show
+                if (existing.series is None) != (action.series is None):
+                    continue
+                if (
+                    existing.series
+                    and action.series
+                    and not check_same_identifiers(existing.series, action.series)
+                ):
+                    continue
+
+                return index
+
+        return None
+
+    def add(self, target: Any, actions: list[SyncAction]) -> None:
+        target_index = self.get_target_index(target)
+        _, target_actions = self.targets[target_index]
+        for action in actions:
+            index = self.find(target_index, action)
+            if index is None:
+                index = len(target_actions)
+                target_actions.append(action)
+            else:
+                self.dropped += 1
+                if (
+                    compare_media_items(
+                        target_actions[index].media_item(),
+                        action.media_item(),
+                        self.env,
+                    )
+                    != Ord.B_BETTER
+                ):
+                    continue
+
+                target_actions[index] = action
+
+            bucket = (
+                get_mapping_key(self.user_mapping, action.user),
+                get_mapping_key(self.library_mapping, action.library),
+            )
+            for key in get_identifier_keys(action.identifiers):
+                indexes = self.indexes[target_index].setdefault((*bucket, key), [])
+                if index not in indexes:
+                    indexes.append(index)
+
+    def flush(self, dryrun: bool, checkpoint: Checkpoint | None = None) -> int:
+        """
+        Write the pending actions to every target, returns the number of actions
+        the targets did not already satisfy.
+        """
+        if self.dropped:
+            logger.info(
+                f"Pending writes: dropped {self.dropped} duplicate writes across server pairs"
+            )
+
+        writes = 0
+        for target, actions in self.targets:
+            if not actions:
+                continue
+
+            logger.info(f"Pending writes: {len(actions)} actions for {target.info()}")
+            write_actions(
+                target,
+                actions,
+                self.user_mapping,
+                self.library_mapping,
+                dryrun,
+                checkpoint,
+            )
+            log_action_results(actions, str(target.info()))
+            writes += sum(1 for action in actions if action.outcome != "satisfied")
+
+        self.targets = []
+        self.indexes = []
+        self.dropped = 0
+        return writes
@@ -0,0 +1,196 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any
+from loguru import logger
+
+from src.functions import str_to_bool, get_env_value, to_aware_utc
+
+
+def get_server_key(server: Any) -> str:
+    return f"{server.server_type}:{server.base_url}"
+
+
+def get_pair_key(server_1: Any, server_2: Any) -> str:
+    return f"{get_server_key(server_1)} <-> {get_server_key(server_2)}"
+
+
+def load_activity_state(activity_file: str) -> dict[str, Any]:
+    if not os.path.exists(activity_file):
+        return {"full_sync": {}, "servers": {}}
+
+    try:
+        with open(activity_file, "r", encoding="utf-8") as file:
+            state = json.load(file)
+    except Exception as e:
+        logger.warning(f"Failed to read activity file {activity_file}, Error: {e}")
+        return {"full_sync": {}, "servers": {}}
+
+    state.setdefault("full_sync", {})
+    state.setdefault("servers", {})
+    return state
+
+
+def save_activity_state(activity_file: str, state: dict[str, Any]) -> None:
+    # Write to a temporary file first so a crash mid write does not lose the state
+    temp_file = f"{activity_file}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as file:
+        json.dump(state, file, indent=2)
+    os.replace(temp_file, activity_file)
+
+
+def full_sync_due(
+    state: dict[str, Any], full_sync_interval: float, now: datetime, key: str = "all"
+) -> bool:
+    last_full_sync = state["full_sync"].get(key)
+    if not last_full_sync:
+        return True
+
+    elapsed = (now - datetime.fromisoformat(last_full_sync)).total_seconds()
+    return elapsed >= full_sync_interval
+
+
+def is_user_idle(last_activity: datetime | None, last_sync: str | None) -> bool:
+    """
+    A user is idle if the server reports activity that is older than the last
+    successful sync. Missing information is always treated as activity.
+    """
+    if last_activity is None or last_sync is None:
+        return False
+
+    last_activity = to_aware_utc(last_activity)
+    last_sync_date = to_aware_utc(datetime.fromisoformat(last_sync))
+    if last_activity is None or last_sync_date is None:
+        return False
+
+    return last_activity < last_sync_date
+
+
+def get_idle_users(server: Any, state: dict[str, Any]) -> set[str]:
+    server_state: dict[str, str] = state["servers"].get(get_server_key(server), {})
+    if not server_state:
+        return set()
+
+    # Only activity newer than the oldest sync can make a user active again
+    since = min(datetime.fromisoformat(date) for date in server_state.values())
+
+    idle_users: set[str] = set()
+    for user_name, last_activity in server.get_users_activity(since).items():
+        if is_user_idle(last_activity, server_state.get(user_name.lower())):
+            idle_users.add(user_name.lower())
+
+    logger.debug(f"{server.server_type}: Idle users {idle_users}")
+
+    return idle_users
+
+
+def filter_idle_user_lists(
+    users: dict[str, str],
+    server_1_idle_users: set[str],
+    server_2_idle_users: set[str],
+) -> dict[str, str]:
+    # A user pair can only be skipped if neither side has done anything since the last sync
+    users_active: dict[str, str] = {}
+    for user_1, user_2 in users.items():
+        if user_1 in server_1_idle_users and user_2 in server_2_idle_users:
+            logger.info(f"Skipping {user_1} and {user_2}, no activity since last sync")
+            continue
+
+        users_active[user_1] = user_2
+
+    return users_active
+
+
+def record_user_sync(
+    state: dict[str, Any], server: Any, user_names: list[str], sync_date: datetime
+) -> None:
+    server_state = state["servers"].setdefault(get_server_key(server), {})
+    for user_name in user_names:
+        server_state[user_name.lower()] = sync_date.astimezone(timezone.utc).isoformat()
+
+
+def get_user_names(users: Any) -> list[str]:
+    # Jellyfin/Emby users are a dict of name to id, Plex users are a list of accounts
+    if isinstance(users, dict):
+        return [user_name.lower() for user_name in users]
+
+    return [
+        user.username.lower() if user.username else user.title.lower() for user in users
+    ]
+
+
+def order_users_by_activity(server: Any, users: Any, now: datetime) -> Any:
+    """
+    Sort the users returned by setup_users so the most recently active ones are
+    gathered and written first. Users without a known activity date go last.
+    """
+    # Plex reads its history for this, so only look back a limited time
+    activity = {
+        user_name.lower(): to_aware_utc(last_activity)
+        for user_name, last_activity in server.get_users_activity(
+            now - timedelta(days=30)
+        ).items()
+    }
+    oldest = datetime.min.replace(tzinfo=timezone.utc)
+
+    def last_activity(user: Any) -> datetime:
+        return activity.get(get_user_names(user)[0]) or oldest
+
+    if isinstance(users, dict):
+        return dict(
+            sorted(
+                users.items(),
+                key=lambda user: last_activity({user[0]: user[1]}),
+                reverse=True,
+            )
+        )
+
+    return sorted(users, key=lambda user: last_activity([user]), reverse=True)
+
+
+def setup_activity(
+    env, run_start: datetime, key: str = "all"
+) -> tuple[dict[str, Any] | None, bool]:
+    """
+    Load the activity state when skipping idle users or the sync window is enabled.
+    Returns the state and whether this run has to be a full sync, the key allows
+    the scheduler to track full syncs per server pair.
+    """
+    skip_idle_users = str_to_bool(get_env_value(env, "SKIP_IDLE_USERS", "False"))
+    sync_window = get_env_value(env, "SYNC_WINDOW", None)
+    if not skip_idle_users and not sync_window:
+        return None, True
+
+    activity_state = load_activity_state(
+        get_env_value(env, "ACTIVITY_FILE", "activity.json")
+    )
+    full_sync = full_sync_due(
+        activity_state,
+        float(get_env_value(env, "FULL_SYNC_INTERVAL", "86400")),
+        run_start,
+        key,
+    )
+    if skip_idle_users:
+        logger.info(f"Skip idle users: {not full_sync}")
+    if sync_window:
+        logger.info(f"Only syncing recent activity: {not full_sync}")
+
+    return activity_state, full_sync
+
+
+def save_activity(
+    env,
+    activity_state: dict[str, Any] | None,
+    full_sync: bool,
+    run_start: datetime,
+    key: str = "all",
+) -> None:
+    if activity_state is None:
+        return
+
+    if full_sync:
+        activity_state["full_sync"][key] = run_start.isoformat()
+
+    save_activity_state(
+        get_env_value(env, "ACTIVITY_FILE", "activity.json"), activity_state
+    )
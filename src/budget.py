@@ -0,0 +1,143 @@
+import json
+import os
+from time import monotonic
+from typing import Any
+from loguru import logger
+
+from src.activity import get_pair_key, get_server_key, get_user_names
+from src.functions import get_env_value
+
+
+class RunBudget:
+    """
+    Time budget of a single run. Once less than the reserve is left no new server
+    pairs or users are started, the ones already started are finished and written.
+    Whatever was not started is stored in path and goes first in the next run.
+    """
+
+    def __init__(
+        self,
+        seconds: float,
+        reserve: float | None = None,
+        path: str | None = None,
+    ) -> None:
+        self.seconds: float = seconds
+        self.reserve: float = seconds * 0.2 if reserve is None else reserve
+        self.path: str | None = path
+        self.started: float = monotonic()
+        self.deferred_pairs: list[str] = []
+        self.deferred_users: dict[str, list[str]] = {}
+        # Work deferred by the previous run
+        self.carried_pairs: set[str] = set()
+        self.carried_users: dict[str, set[str]] = {}
+        self.load()
+
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                state = json.load(file)
+        except Exception as e:
+            logger.warning(f"Budget: Failed to read {self.path}, Error: {e}")
+            return
+
+        self.carried_pairs = set(state.get("pairs", []))
+        self.carried_users = {
+            server: set(users) for server, users in state.get("users", {}).items()
+        }
+
+    def save(self) -> None:
+        if not self.path:
+            return
+
+        if not self.deferred_pairs and not self.deferred_users:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+
+        # Write to a temporary file first so a crash mid write does not lose the state
+        temp_file = f"{self.path}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump(
+                {"pairs": self.deferred_pairs, "users": self.deferred_users},
+                file,
+                indent=2,
+            )
+        os.replace(temp_file, self.path)
+
+    def elapsed(self) -> float:
+        return monotonic() - self.started
+
+    def remaining(self) -> float:
+        return self.seconds - self.elapsed()
+
+    def exhausted(self) -> bool:
+        return self.remaining() <= self.reserve
+
+    def defer_pair(self, server_1: Any, server_2: Any) -> None:
+        key = get_pair_key(server_1, server_2)
+        logger.info(f"Budget: Deferring {key} to the next run")
+        self.deferred_pairs.append(key)
+
+    def defer_users(self, server: Any, user_names: list[str]) -> None:
+        if not user_names:
+            return
+
+        self.deferred_users.setdefault(get_server_key(server), []).extend(user_names)
+
+    def has_deferred(self) -> bool:
+        return bool(self.deferred_pairs or self.deferred_users)
+
+    def is_deferred(self, server: Any, user_name: str) -> bool:
+        return user_name.lower() in self.deferred_users.get(get_server_key(server), [])
+
+    def prioritize_pairs(self, pairs: list[tuple[Any, Any]]) -> list[tuple[Any, Any]]:
+        return sorted(
+            pairs,
+            key=lambda pair: get_pair_key(*pair) not in self.carried_pairs,
+        )
+
+    def prioritize_users(self, server: Any, users: Any) -> Any:
+        """
+        Move the users deferred by the previous run to the front, keeping the order
+        of everyone else.
+        """
+        carried = self.carried_users.get(get_server_key(server), set())
+        if not carried:
+            return users
+
+        if isinstance(users, dict):
+            return dict(
+                sorted(users.items(), key=lambda user: user[0].lower() not in carried)
+            )
+
+        return sorted(users, key=lambda user: get_user_names([user])[0] not in carried)
+
+    def report(self) -> None:
+        users = sum(len(user_names) for user_names in self.deferred_users.values())
+        if not self.deferred_pairs and not users:
+            logger.info(
+                f"Budget: Run finished in {self.elapsed():.0f} of {self.seconds:.0f} seconds"
+            )
+            return
+
+        logger.warning(
+            f"Budget: Ran low after {self.elapsed():.0f} of {self.seconds:.0f} seconds, deferred {len(self.deferred_pairs)} server pairs and {users} users to the next run"
+        )
+        for server, user_names in self.deferred_users.items():
+            logger.info(f"Budget: Deferred users on {server}: {user_names}")
+
+
+def load_run_budget(env) -> RunBudget | None:
+    seconds = get_env_value(env, "RUN_BUDGET", None)
+    if not seconds:
+        return None
+
+    reserve = get_env_value(env, "RUN_BUDGET_RESERVE", None)
+    return RunBudget(
+        float(seconds),
+        reserve=float(reserve) if reserve else None,
+        path=get_env_value(env, "RUN_BUDGET_FILE", "deferred.json"),
+    )
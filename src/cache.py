@@ -0,0 +1,73 @@
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Hashable, TypeVar
+from loguru import logger
+
+T = TypeVar("T")
+
+
+class MetadataCache:
+    """
+    Cache of metadata lookups (users, libraries, server info) for a single server.
+    It is cleared at the start of every run so changes on the server are picked up,
+    in daemon mode only entries older than METADATA_CACHE_TTL are dropped.
+    """
+
+    def __init__(self, server_type: str) -> None:
+        self.server_type: str = server_type
+        self.entries: dict[Hashable, Any] = {}
+        self.created: dict[Hashable, float] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        # The gather workers share the cache, a key is only fetched by one of them
+        self.lock = Lock()
+        self.key_locks: dict[Hashable, Lock] = {}
+
+    def get(self, key: Hashable, fetch: Callable[[], T]) -> T:
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                return self.entries[key]
+            key_lock = self.key_locks.setdefault(key, Lock())
+
+        # Other keys are fetched in parallel while this one is fetched
+        with key_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.hits += 1
+                    return self.entries[key]
+
+            value = fetch()
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = value
+                self.created[key] = monotonic()
+        return value
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+            self.created.pop(key, None)
+
+    def expire(self, ttl: float) -> None:
+        now = monotonic()
+        with self.lock:
+            expired = [
+                key for key, created in self.created.items() if now - created >= ttl
+            ]
+        for key in expired:
+            self.invalidate(key)
+
+        logger.debug(
+            f"{self.server_type}: Expired {len(expired)} metadata cache entries, {len(self.entries)} remaining"
+        )
+
+    def clear(self) -> None:
+        logger.debug(
+            f"{self.server_type}: Clearing metadata cache, {self.hits} hits, {self.misses} misses"
+        )
+        with self.lock:
+            self.entries = {}
+            self.created = {}
+            self.hits = 0
+            self.misses = 0
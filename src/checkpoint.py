@@ -0,0 +1,206 @@
+import json
+import os
+from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic
+from typing import Any
+from loguru import logger
+
+from src.activity import get_server_key, get_user_names
+from src.functions import get_env_value, str_to_bool
+from src.watched import LibraryData, UserData
+
+
+class Checkpoint:
+    """
+    Append-only journal of the progress of a run. Every gathered user library and
+    every written user library is appended as a json line, so a run that crashed
+    or was restarted resumes where it stopped instead of starting over.
+    Lines are flushed right away but only fsynced every fsync_interval seconds.
+    """
+
+    def __init__(
+        self, path: str, fsync_interval: float = 5, max_age: float = 86400
+    ) -> None:
+        self.path: str = path
+        self.fsync_interval: float = fsync_interval
+        self.max_age: float = max_age
+        self.gathered: dict[str, dict[str, UserData]] = {}
+        # (source, target, user, library), the source is empty for writes merged
+        # across server pairs
+        self.written: set[tuple[str, str, str, str]] = set()
+        self.started: datetime = datetime.now(timezone.utc)
+        self.last_fsync: float = monotonic()
+        self.pending: int = 0
+        # Users are gathered and written from several pipeline stages at once
+        self.lock = Lock()
+
+        if self.load():
+            logger.info(
+                f"Checkpoint: Resuming run from {self.started.isoformat()}, {sum(len(user.libraries) for users in self.gathered.values() for user in users.values())} libraries gathered, {len(self.written)} libraries written"
+            )
+            self.file = open(self.path, "a", encoding="utf-8")
+        else:
+            self.file = open(self.path, "w", encoding="utf-8")
+            self.append({"type": "run", "started": self.started.isoformat()})
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+
+        started = None
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line can be cut off by a crash
+                    logger.warning(f"Checkpoint: Skipping invalid line in {self.path}")
+                    continue
+
+                if entry["type"] == "run":
+                    started = datetime.fromisoformat(entry["started"])
+                elif entry["type"] == "gather":
+                    self.gathered.setdefault(entry["server"], {}).setdefault(
+                        entry["user"], UserData()
+                    ).libraries[entry["library"]] = LibraryData.model_validate(
+                        entry["data"]
+                    )
+                elif entry["type"] == "write":
+                    self.written.add(
+                        (
+                            entry.get("source", ""),
+                            entry["server"],
+                            entry["user"],
+                            entry["library"],
+                        )
+                    )
+
+        if started is None:
+            return False
+
+        age = (datetime.now(timezone.utc) - started).total_seconds()
+        if age > self.max_age:
+            logger.info(
+                f"Checkpoint: Run from {started.isoformat()} is older than {self.max_age} seconds, starting over"
+            )
+            self.gathered = {}
+            self.written = set()
+            return False
+
+        self.started = started
+        return True
+
+    def append(self, entry: dict[str, Any]) -> None:
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.pending += 1
+            if monotonic() - self.last_fsync >= self.fsync_interval:
+                self.sync()
+
+    def sync(self) -> None:
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+        self.last_fsync = monotonic()
+
+    def record_gather(
+        self, server: Any, user_name: str, library_title: str, library: LibraryData
+    ) -> None:
+        server_key = get_server_key(server)
+        self.gathered.setdefault(server_key, {}).setdefault(
+            user_name.lower(), UserData()
+        ).libraries[library_title] = library.model_copy(deep=True)
+        self.append(
+            {
+                "type": "gather",
+                "server": server_key,
+                "user": user_name.lower(),
+                "library": library_title,
+                "data": library.model_dump(mode="json"),
+            }
+        )
+
+    def get_watched(
+        self, server: Any, users: Any, libraries: list[str]
+    ) -> dict[str, UserData] | None:
+        """
+        Copy of the libraries of the given users that were already gathered in this
+        run, to be passed to get_watched so they are not gathered again.
+        """
+        gathered = self.gathered.get(get_server_key(server))
+        if not gathered:
+            return None
+
+        users_watched: dict[str, UserData] = {}
+        for user_name in get_user_names(users):
+            if user_name not in gathered:
+                continue
+
+            users_watched[user_name] = UserData(
+                libraries={
+                    title: library.model_copy(deep=True)
+                    for title, library in gathered[user_name].libraries.items()
+                    if title in libraries
+                }
+            )
+
+        return users_watched
+
+    def get_write_key(
+        self, server: Any, user_name: str, library_title: str, source: Any = None
+    ) -> tuple[str, str, str, str]:
+        # Every pair writing to the same target keeps its own progress
+        return (
+            get_server_key(source) if source is not None else "",
+            get_server_key(server),
+            user_name.lower(),
+            library_title,
+        )
+
+    def record_write(
+        self, server: Any, user_name: str, library_title: str, source: Any = None
+    ) -> None:
+        key = self.get_write_key(server, user_name, library_title, source)
+        self.written.add(key)
+        self.append(
+            {
+                "type": "write",
+                "source": key[0],
+                "server": key[1],
+                "user": key[2],
+                "library": key[3],
+            }
+        )
+
+    def is_written(
+        self, server: Any, user_name: str, library_title: str, source: Any = None
+    ) -> bool:
+        return self.get_write_key(server, user_name, library_title, source) in (
+            self.written
+        )
+
+    def complete(self) -> None:
+        """
+        The run finished, the next run starts from scratch.
+        """
+        self.file.close()
+        os.remove(self.path)
+        logger.debug(f"Checkpoint: Run from {self.started.isoformat()} completed")
+
+    def close(self) -> None:
+        self.sync()
+        self.file.close()
+
+
+def load_checkpoint(env) -> Checkpoint | None:
+    if not str_to_bool(get_env_value(env, "RUN_CHECKPOINT", "False")):
+        return None
+
+    return Checkpoint(
+        get_env_value(env, "CHECKPOINT_FILE", "checkpoint.jsonl"),
+        fsync_interval=float(get_env_value(env, "CHECKPOINT_FSYNC_INTERVAL", "5")),
+        max_age=float(get_env_value(env, "CHECKPOINT_MAX_AGE", "86400")),
+    )
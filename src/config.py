@@ -0,0 +1,127 @@
+import json
+from pydantic import BaseModel, Field
+from loguru import logger
+
+from src.functions import (
+    parse_string_to_list,
+    str_to_bool,
+    get_env_value,
+)
+from src.black_white import setup_black_white_lists
+from src.topology import SyncMatrix, load_sync_matrix
+
+
+class SyncConfig(BaseModel):
+    dryrun: bool = False
+    user_mapping: dict[str, str] | None = None
+    library_mapping: dict[str, str] | None = None
+    blacklist_library: list[str] = Field(default_factory=list)
+    whitelist_library: list[str] = Field(default_factory=list)
+    blacklist_library_type: list[str] = Field(default_factory=list)
+    whitelist_library_type: list[str] = Field(default_factory=list)
+    blacklist_users: list[str] = Field(default_factory=list)
+    whitelist_users: list[str] = Field(default_factory=list)
+    sync_matrix: SyncMatrix = Field(default_factory=SyncMatrix)
+    sync_per_user: bool = False
+    gather_workers: int = 1
+    diff_workers: int = 1
+    write_workers: int = 1
+    pipeline_queue_size: int = 2
+    skip_idle_users: bool = False
+    # Seconds back from the start of a run that items are gathered, between full passes
+    sync_window: float | None = None
+    prioritize_recent: bool = True
+    # memory, sqlite or auto to move the watched lists to disk past watched_store_threshold items
+    watched_store: str = "memory"
+    watched_store_threshold: int = 1_000_000
+    watched_store_dir: str | None = None
+    diff_processes: int = 1
+
+
+def load_sync_config(env: dict[str, str | float | None]) -> SyncConfig:
+    dryrun = str_to_bool(get_env_value(env, "DRYRUN", "False"))
+    logger.info(f"Dryrun: {dryrun}")
+
+    user_mapping_env = get_env_value(env, "USER_MAPPING", None)
+    user_mapping = None
+    if user_mapping_env:
+        user_mapping = json.loads(user_mapping_env.lower())
+    logger.info(f"User Mapping: {user_mapping}")
+
+    library_mapping_env = get_env_value(env, "LIBRARY_MAPPING", None)
+    library_mapping = None
+    if library_mapping_env:
+        library_mapping = json.loads(library_mapping_env)
+    logger.info(f"Library Mapping: {library_mapping}")
+
+    # Create (black/white)lists
+    logger.info("Creating (black/white)lists")
+    blacklist_library = parse_string_to_list(
+        get_env_value(env, "BLACKLIST_LIBRARY", None)
+    )
+    whitelist_library = parse_string_to_list(
+        get_env_value(env, "WHITELIST_LIBRARY", None)
+    )
+    blacklist_library_type = parse_string_to_list(
+        get_env_value(env, "BLACKLIST_LIBRARY_TYPE", None)
+    )
+    whitelist_library_type = parse_string_to_list(
+        get_env_value(env, "WHITELIST_LIBRARY_TYPE", None)
+    )
+    blacklist_users = parse_string_to_list(get_env_value(env, "BLACKLIST_USERS", None))
+    whitelist_users = parse_string_to_list(get_env_value(env, "WHITELIST_USERS", None))
+
+    (
+        blacklist_library,
+        whitelist_library,
+        blacklist_library_type,
+        whitelist_library_type,
+        blacklist_users,
+        whitelist_users,
+    ) = setup_black_white_lists(
+        blacklist_library,
+        whitelist_library,
+        blacklist_library_type,
+        whitelist_library_type,
+        blacklist_users,
+        whitelist_users,
+        library_mapping,
+        user_mapping,
+    )
+
+    sync_window = get_env_value(env, "SYNC_WINDOW", None)
+    logger.info(f"Sync window: {sync_window}")
+
+    watched_store = get_env_value(env, "WATCHED_STORE", "memory").lower()
+    if watched_store not in ["memory", "sqlite", "auto"]:
+        raise Exception(
+            f"Invalid WATCHED_STORE {watched_store}, please choose between memory, sqlite, auto"
+        )
+    logger.info(f"Watched store: {watched_store}")
+
+    return SyncConfig(
+        dryrun=dryrun,
+        user_mapping=user_mapping,
+        library_mapping=library_mapping,
+        blacklist_library=blacklist_library,
+        whitelist_library=whitelist_library,
+        blacklist_library_type=blacklist_library_type,
+        whitelist_library_type=whitelist_library_type,
+        blacklist_users=blacklist_users,
+        whitelist_users=whitelist_users,
+        sync_matrix=load_sync_matrix(env),
+        sync_per_user=str_to_bool(get_env_value(env, "SYNC_PER_USER", "False")),
+        gather_workers=int(get_env_value(env, "SYNC_GATHER_WORKERS", "1")),
+        diff_workers=int(get_env_value(env, "SYNC_DIFF_WORKERS", "1")),
+        write_workers=int(get_env_value(env, "SYNC_WRITE_WORKERS", "1")),
+        pipeline_queue_size=int(get_env_value(env, "SYNC_QUEUE_SIZE", "2")),
+        skip_idle_users=str_to_bool(get_env_value(env, "SKIP_IDLE_USERS", "False")),
+        sync_window=float(sync_window) if sync_window else None,
+        prioritize_recent=str_to_bool(get_env_value(env, "PRIORITIZE_RECENT", "True")),
+        watched_store=watched_store,
+        watched_store_threshold=int(
+            get_env_value(env, "WATCHED_STORE_THRESHOLD", "1000000")
+        ),
+        watched_store_dir=get_env_value(env, "WATCHED_STORE_DIR", None) or None,
+        diff_processes=int(get_env_value(env, "DIFF_PROCESSES", "1")),
+    )
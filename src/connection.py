@@ -1,7 +1,12 @@
-from typing import Literal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+from typing import Callable, Literal
 from loguru import logger
 
 from src.functions import str_to_bool, get_env_value
+from src.ledger import load_write_ledger
+from src.outbox import load_write_outbox
 from src.plex import Plex
 from src.jellyfin import Jellyfin
 from src.emby import Emby
@@ -12,9 +17,8 @@ def jellyfin_emby_server_connection(
     server_baseurl: str,
     server_token: str,
     server_type: Literal["jellyfin", "emby"],
-) -> list[Jellyfin | Emby]:
-    servers: list[Jellyfin | Emby] = []
-    server: Jellyfin | Emby
+) -> list[tuple[str, Callable[[], Jellyfin | Emby]]]:
+    connections: list[tuple[str, Callable[[], Jellyfin | Emby]]] = []
 
     server_baseurls = server_baseurl.split(",")
     server_tokens = server_token.split(",")
@@ -30,24 +34,84 @@ def jellyfin_emby_server_connection(
             base_url = base_url[:-1]
 
         if server_type == "jellyfin":
-            server = Jellyfin(
-                env=env, base_url=base_url, token=server_tokens[i].strip()
+            connections.append(
+                (
+                    f"{server_type} Server {i}",
+                    partial(
+                        Jellyfin,
+                        env=env,
+                        base_url=base_url,
+                        token=server_tokens[i].strip(),
+                    ),
+                )
             )
-            servers.append(server)
 
         elif server_type == "emby":
-            server = Emby(env=env, base_url=base_url, token=server_tokens[i].strip())
-            servers.append(server)
+            connections.append(
+                (
+                    f"{server_type} Server {i}",
+                    partial(
+                        Emby, env=env, base_url=base_url, token=server_tokens[i].strip()
+                    ),
+                )
+            )
         else:
             raise Exception("Unknown server type")
 
-        logger.debug(f"{server_type} Server {i} info: {server.info()}")
+    return connections
+
+
+def connect_servers(
+    connections: list[tuple[str, Callable[[], Plex | Jellyfin | Emby]]],
+    timeout: float,
+) -> list[Plex | Jellyfin | Emby]:
+    servers: list[Plex | Jellyfin | Emby] = []
+    if not connections:
+        return servers
+
+    # Connect to every server at the same time so a slow server only delays itself
+    executor = ThreadPoolExecutor(max_workers=len(connections))
+    futures = [(name, executor.submit(connect)) for name, connect in connections]
+    deadline = monotonic() + timeout
+
+    try:
+        # Keep the configured order of the servers
+        for index, (name, future) in enumerate(futures):
+            try:
+                server = future.result(timeout=max(0.0, deadline - monotonic()))
+            except TimeoutError:
+                logger.error(
+                    f"{name}: Failed to connect within {timeout} seconds, skipping"
+                )
+                continue
+            except Exception as e:
+                logger.error(f"{name}: Failed to connect, skipping, Error: {e}")
+                continue
+
+            logger.debug(f"{name} info: {server.info()}")
+            server.connection_index = index
+            servers.append(server)
+    finally:
+        # Do not wait on servers that did not respond before the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if len(servers) < len(connections):
+        logger.warning(
+            f"Connected to {len(servers)} of {len(connections)} servers, continuing with the connected servers"
+        )
 
     return servers
 
 
 def generate_server_connections(env) -> list[Plex | Jellyfin | Emby]:
-    servers: list[Plex | Jellyfin | Emby] = []
+    connection_timeout = float(get_env_value(env, "CONNECTION_TIMEOUT", 60))
+    return setup_servers(env, load_server_connections(env), connection_timeout)
+
+
+def load_server_connections(
+    env,
+) -> list[tuple[str, Callable[[], Plex | Jellyfin | Emby]]]:
+    connections: list[tuple[str, Callable[[], Plex | Jellyfin | Emby]]] = []
 
     plex_baseurl_str: str | None = get_env_value(env, "PLEX_BASEURL", None)
     plex_token_str: str | None = get_env_value(env, "PLEX_TOKEN", None)
@@ -66,20 +130,22 @@ def generate_server_connections(env) -> list[Plex | Jellyfin | Emby]:
             )
 
         for i, url in enumerate(plex_baseurl):
-            server = Plex(
-                env,
-                base_url=url.strip(),
-                token=plex_token[i].strip(),
-                user_name=None,
-                password=None,
-                server_name=None,
-                ssl_bypass=ssl_bypass,
+            connections.append(
+                (
+                    f"Plex Server {i}",
+                    partial(
+                        Plex,
+                        env,
+                        base_url=url.strip(),
+                        token=plex_token[i].strip(),
+                        user_name=None,
+                        password=None,
+                        server_name=None,
+                        ssl_bypass=ssl_bypass,
+                    ),
+                )
             )
 
-            logger.debug(f"Plex Server {i} info: {server.info()}")
-
-            servers.append(server)
-
     if plex_username_str and plex_password_str and plex_servername_str:
         plex_username = plex_username_str.split(",")
         plex_password = plex_password_str.split(",")
@@ -93,23 +159,26 @@ def generate_server_connections(env) -> list[Plex | Jellyfin | Emby]:
             )
 
         for i, username in enumerate(plex_username):
-            server = Plex(
-                env,
-                base_url=None,
-                token=None,
-                user_name=username.strip(),
-                password=plex_password[i].strip(),
-                server_name=plex_servername[i].strip(),
-                ssl_bypass=ssl_bypass,
+            connections.append(
+                (
+                    f"Plex Server {i}",
+                    partial(
+                        Plex,
+                        env,
+                        base_url=None,
+                        token=None,
+                        user_name=username.strip(),
+                        password=plex_password[i].strip(),
+                        server_name=plex_servername[i].strip(),
+                        ssl_bypass=ssl_bypass,
+                    ),
+                )
             )
 
-            logger.debug(f"Plex Server {i} info: {server.info()}")
-            servers.append(server)
-
     jellyfin_baseurl = get_env_value(env, "JELLYFIN_BASEURL", None)
     jellyfin_token = get_env_value(env, "JELLYFIN_TOKEN", None)
     if jellyfin_baseurl and jellyfin_token:
-        servers.extend(
+        connections.extend(
             jellyfin_emby_server_connection(
                 env, jellyfin_baseurl, jellyfin_token, "jellyfin"
             )
@@ -118,8 +187,106 @@ def generate_server_connections(env) -> list[Plex | Jellyfin | Emby]:
     emby_baseurl = get_env_value(env, "EMBY_BASEURL", None)
     emby_token = get_env_value(env, "EMBY_TOKEN", None)
     if emby_baseurl and emby_token:
-        servers.extend(
+        connections.extend(
             jellyfin_emby_server_connection(env, emby_baseurl, emby_token, "emby")
         )
 
+    return connections
+
+
+def setup_servers(
+    env,
+    connections: list[tuple[str, Callable[[], Plex | Jellyfin | Emby]]],
+    timeout: float,
+) -> list[Plex | Jellyfin | Emby]:
+    servers = connect_servers(connections, timeout)
+
+    ledger = load_write_ledger(env)
+    outbox = load_write_outbox(env)
+    for server in servers:
+        server.ledger = ledger
+        server.outbox = outbox
+
+    return servers
+
+
+def connect_missing_servers(
+    env,
+    connections: list[tuple[str, Callable[[], Plex | Jellyfin | Emby]]],
+    servers: list[Plex | Jellyfin | Emby],
+) -> list[Plex | Jellyfin | Emby]:
+    """
+    Retry the configured connections that failed before, the connected servers
+    are kept as they are with their cached metadata, ledger and outbox.
+    """
+    connected = {server.connection_index: server for server in servers}
+    logger.info(
+        f"Retrying {len(connections) - len(connected)} servers that failed to connect"
+    )
+
+    def keep(server: Plex | Jellyfin | Emby) -> Plex | Jellyfin | Emby:
+        return server
+
+    servers = connect_servers(
+        [
+            (name, partial(keep, connected[index]) if index in connected else connect)
+            for index, (name, connect) in enumerate(connections)
+        ],
+        float(get_env_value(env, "CONNECTION_TIMEOUT", 60)),
+    )
+
+    # New servers share the ledger and outbox of the connected ones
+    if connected:
+        ledger = next(iter(connected.values())).ledger
+        outbox = next(iter(connected.values())).outbox
+    else:
+        ledger = load_write_ledger(env)
+        outbox = load_write_outbox(env)
+    for server in servers:
+        if server.connection_index not in connected:
+            server.ledger = ledger
+            server.outbox = outbox
+
     return servers
+
+
+def get_server_connections(
+    servers: list[Plex | Jellyfin | Emby],
+) -> list[tuple[str, Callable[[], Plex | Jellyfin | Emby]]]:
+    """
+    Connections to servers that are already connected, they can be pickled and sent
+    to worker processes. Plex servers found through a plex.tv account are connected
+    with the address and token they resolved to, so workers do not log in again.
+    """
+    connections: list[tuple[str, Callable[[], Plex | Jellyfin | Emby]]] = []
+    for i, server in enumerate(servers):
+        if isinstance(server, Plex):
+            connections.append(
+                (
+                    f"Plex Server {i}",
+                    partial(
+                        Plex,
+                        server.env,
+                        base_url=server.plex._baseurl,
+                        token=server.plex._token,
+                        user_name=None,
+                        password=None,
+                        server_name=None,
+                        ssl_bypass=server.ssl_bypass,
+                    ),
+                )
+            )
+        else:
+            connections.append(
+                (
+                    f"{server.server_type.lower()} Server {i}",
+                    partial(
+                        type(server),
+                        env=server.env,
+                        base_url=server.base_url,
+                        token=server.token,
+                    ),
+                )
+            )
+
+    return connections
@@ -0,0 +1,57 @@
+from loguru import logger
+
+from src.connection import (
+    connect_missing_servers,
+    generate_server_connections,
+    load_server_connections,
+)
+from src.emby import Emby
+from src.jellyfin import Jellyfin
+from src.plex import Plex
+
+
+def refresh_servers(
+    env,
+    servers: list[Plex | Jellyfin | Emby] | None,
+    metadata_cache_ttl: float,
+) -> list[Plex | Jellyfin | Emby]:
+    """
+    Reuse the server objects from the previous loop, only dropping the cached
+    metadata that is older than metadata_cache_ttl. Servers that failed to connect
+    are retried on every loop.
+    """
+    if servers is None:
+        logger.info("Creating server connections")
+        return generate_server_connections(env)
+
+    for server in servers:
+        server.cache.expire(metadata_cache_ttl)
+        server.refresh()
+
+    connections = load_server_connections(env)
+    if len(servers) < len(connections):
+        servers = connect_missing_servers(env, connections, servers)
+
+    return servers
+
+
+def reconnect_servers(
+    servers: list[Plex | Jellyfin | Emby] | None,
+) -> list[Plex | Jellyfin | Emby] | None:
+    """
+    Reconnect the existing server objects after a failed loop, if any of them fail
+    to reconnect the whole list is dropped so it is recreated on the next loop.
+    """
+    if servers is None:
+        return None
+
+    for server in servers:
+        try:
+            server.reconnect()
+        except Exception as e:
+            logger.error(
+                f"{server.server_type}: Failed to reconnect, recreating all server connections on the next loop, Error: {e}"
+            )
+            return None
+
+    return servers
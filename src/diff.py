@@ -0,0 +1,296 @@
+import copy
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime
+from typing import Any
+from loguru import logger
+
+from src.actions import get_identifier_keys
+from src.functions import search_mapping
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    Series,
+    UserData,
+    WatchedStatus,
+    check_remove_entry,
+    get_other,
+)
+
+# Compact form of a library sent to the diff processes, plain tuples pickle
+# several times smaller and faster than the pydantic models
+EncodedIdentifiers = tuple[
+    str | None, tuple[str, ...], str | None, str | None, str | None
+]
+EncodedItem = tuple[EncodedIdentifiers, bool, int, datetime]
+EncodedLibrary = tuple[
+    list[EncodedItem], list[tuple[EncodedIdentifiers, list[EncodedItem]]]
+]
+# Indexes of the movies to keep and per series the indexes of the episodes to
+# keep, None for series that did not match any series of the other library
+KeptItems = tuple[list[int], list[list[int] | None]]
+
+# Diff processes are started once and reused, forked workers start their own
+_diff_pool: tuple[int, int, Executor] | None = None
+
+
+def encode_identifiers(identifiers: MediaIdentifiers) -> EncodedIdentifiers:
+    return (
+        identifiers.title,
+        identifiers.locations,
+        identifiers.imdb_id,
+        identifiers.tvdb_id,
+        identifiers.tmdb_id,
+    )
+
+
+def encode_library(library: LibraryData) -> EncodedLibrary:
+    def encode_item(item: MediaItem) -> EncodedItem:
+        return (
+            encode_identifiers(item.identifiers),
+            item.status.completed,
+            item.status.time,
+            item.status.viewed_date,
+        )
+
+    return (
+        [encode_item(movie) for movie in library.movies],
+        [
+            (
+                encode_identifiers(series.identifiers),
+                [encode_item(episode) for episode in series.episodes],
+            )
+            for series in library.series
+        ],
+    )
+
+
+def decode_identifiers(encoded: EncodedIdentifiers) -> MediaIdentifiers:
+    title, locations, imdb_id, tvdb_id, tmdb_id = encoded
+    # The data was validated when it was gathered
+    return MediaIdentifiers.model_construct(
+        title=title,
+        locations=locations,
+        imdb_id=imdb_id,
+        tvdb_id=tvdb_id,
+        tmdb_id=tmdb_id,
+    )
+
+
+def decode_item(encoded: EncodedItem) -> MediaItem:
+    identifiers, completed, time, viewed_date = encoded
+    return MediaItem.model_construct(
+        identifiers=decode_identifiers(identifiers),
+        status=WatchedStatus.model_construct(
+            completed=completed, time=time, viewed_date=viewed_date
+        ),
+    )
+
+
+def index_identifiers(
+    identifiers: list[MediaIdentifiers],
+) -> dict[tuple[str, str], list[int]]:
+    index: dict[tuple[str, str], list[int]] = {}
+    for position, item_identifiers in enumerate(identifiers):
+        for key in get_identifier_keys(item_identifiers):
+            index.setdefault(key, []).append(position)
+
+    return index
+
+
+def get_candidates(
+    index: dict[tuple[str, str], list[int]], identifiers: MediaIdentifiers
+) -> list[int]:
+    """
+    Positions of the indexed items that share any identifier, in their order.
+    """
+    return sorted(
+        {
+            position
+            for key in get_identifier_keys(identifiers)
+            for position in index.get(key, [])
+        }
+    )
+
+
+def get_kept_items(
+    library_1: EncodedLibrary,
+    library_2: EncodedLibrary,
+    env: dict[str, str | float | None],
+) -> KeptItems:
+    """
+    Same filtering as cleanup_watched for a single library, but items are only
+    compared to the items of the other library that share an identifier.
+    """
+    movies_1, series_list_1 = library_1
+    movies_2 = [decode_item(movie) for movie in library_2[0]]
+    movie_index = index_identifiers([movie.identifiers for movie in movies_2])
+
+    kept_movies = []
+    for position, encoded in enumerate(movies_1):
+        movie = decode_item(encoded)
+        if not any(
+            check_remove_entry(movie, movies_2[candidate], env)
+            for candidate in get_candidates(movie_index, movie.identifiers)
+        ):
+            kept_movies.append(position)
+
+    series_index = index_identifiers(
+        [decode_identifiers(identifiers) for identifiers, _ in library_2[1]]
+    )
+    episodes_2: dict[int, tuple[list[MediaItem], dict]] = {}
+    kept_series: list[list[int] | None] = []
+    for identifiers, episodes_1 in series_list_1:
+        candidates = get_candidates(series_index, decode_identifiers(identifiers))
+        if not candidates:
+            kept_series.append(None)
+            continue
+
+        # Like cleanup_watched, episodes are only compared to the first matching series
+        matching = candidates[0]
+        if matching not in episodes_2:
+            episodes = [decode_item(episode) for episode in library_2[1][matching][1]]
+            episodes_2[matching] = (
+                episodes,
+                index_identifiers([episode.identifiers for episode in episodes]),
+            )
+        episodes, episode_index = episodes_2[matching]
+
+        kept_episodes = []
+        for position, encoded in enumerate(episodes_1):
+            episode = decode_item(encoded)
+            if not any(
+                check_remove_entry(episode, episodes[candidate], env)
+                for candidate in get_candidates(episode_index, episode.identifiers)
+            ):
+                kept_episodes.append(position)
+        kept_series.append(kept_episodes)
+
+    return kept_movies, kept_series
+
+
+def _diff_partition(
+    partition: tuple[EncodedLibrary, EncodedLibrary, dict[str, str | float | None]],
+) -> KeptItems:
+    return get_kept_items(*partition)
+
+
+def filter_library(library: LibraryData, kept: KeptItems) -> LibraryData:
+    kept_movies, kept_series = kept
+    series_list = []
+    for series, kept_episodes in zip(library.series, kept_series):
+        if kept_episodes is None:
+            series_list.append(series)
+        elif kept_episodes:
+            series_list.append(
+                Series(
+                    identifiers=series.identifiers,
+                    episodes=[series.episodes[position] for position in kept_episodes],
+                )
+            )
+
+    return LibraryData(
+        title=library.title,
+        movies=[library.movies[position] for position in kept_movies],
+        series=series_list,
+    )
+
+
+def get_diff_pool(processes: int) -> Executor:
+    global _diff_pool
+
+    # A pool inherited through a fork belongs to the parent and can not be used
+    if _diff_pool is None or _diff_pool[0] != os.getpid() or _diff_pool[1] != processes:
+        # The sync runs threads, forking the processes from a clean server avoids
+        # inheriting locks held by them
+        context = (
+            multiprocessing.get_context("forkserver")
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else None
+        )
+        if _diff_pool is not None and _diff_pool[0] == os.getpid():
+            _diff_pool[2].shutdown(wait=False)
+        logger.info(f"Diff: Starting {processes} diff processes")
+        _diff_pool = (
+            os.getpid(),
+            processes,
+            ProcessPoolExecutor(max_workers=processes, mp_context=context),
+        )
+
+    return _diff_pool[2]
+
+
+def cleanup_watched_parallel(
+    watched_list_1: dict[str, UserData],
+    watched_list_2: dict[str, UserData],
+    env: dict[str, str | float | None],
+    user_mapping: dict[str, str] | None = None,
+    library_mapping: dict[str, str] | None = None,
+    processes: int = 1,
+) -> dict[str, UserData]:
+    """
+    Same result as cleanup_watched, every matched (user, library) is diffed on its
+    own in a pool of processes. Libraries are sent in their compact form and only
+    the positions of the items to keep are sent back, the results are put back
+    together in the order of watched_list_1.
+    """
+    partitions: list[tuple[str, str]] = []
+    inputs: list[Any] = []
+    for user_1, user_data in watched_list_1.items():
+        user_other = None
+        if user_mapping:
+            user_other = search_mapping(user_mapping, user_1)
+        user_2 = get_other(watched_list_2, user_1, user_other)
+        if user_2 is None:
+            continue
+
+        for library_1_key, library_1 in user_data.libraries.items():
+            library_other = None
+            if library_mapping:
+                library_other = search_mapping(library_mapping, library_1_key)
+            library_2_key = get_other(
+                watched_list_2[user_2].libraries, library_1_key, library_other
+            )
+            if library_2_key is None:
+                continue
+
+            partitions.append((user_1, library_1_key))
+            inputs.append(
+                (
+                    encode_library(library_1),
+                    encode_library(watched_list_2[user_2].libraries[library_2_key]),
+                    env,
+                )
+            )
+
+    # Shard workers are daemon processes, which can not start processes of their own
+    if (
+        processes > 1
+        and len(inputs) > 1
+        and not multiprocessing.current_process().daemon
+    ):
+        results = list(get_diff_pool(processes).map(_diff_partition, inputs))
+    else:
+        results = [_diff_partition(partition) for partition in inputs]
+    kept = dict(zip(partitions, results))
+
+    modified_watched_list_1: dict[str, UserData] = {}
+    for user_1, user_data in watched_list_1.items():
+        libraries = {}
+        for library_key, library in user_data.libraries.items():
+            if (user_1, library_key) in kept:
+                library = filter_library(library, kept[(user_1, library_key)])
+            else:
+                library = copy.deepcopy(library)
+
+            if library.movies or library.series:
+                libraries[library_key] = library
+            else:
+                logger.trace(
+                    f"Removing empty library '{library_key}' for user '{user_1}'"
+                )
+        modified_watched_list_1[user_1] = UserData(libraries=libraries)
+
+    return modified_watched_list_1
@@ -4,6 +4,8 @@ from loguru import logger
 
 
 class Emby(JellyfinEmby):
+    socket_path = "/embywebsocket"
+
     def __init__(self, env, base_url: str, token: str) -> None:
         authorization = (
             "Emby , "
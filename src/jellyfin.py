@@ -4,6 +4,8 @@ from loguru import logger
 
 
 class Jellyfin(JellyfinEmby):
+    socket_path = "/socket"
+
     def __init__(self, env, base_url: str, token: str) -> None:
         authorization = (
             "MediaBrowser , "
@@ -1,13 +1,15 @@
 # Functions for Jellyfin and Emby
 
-from datetime import datetime
+from datetime import datetime, timezone
 import requests
 import traceback
 from math import floor
 from typing import Any, Literal
+from urllib.parse import urlencode, urlparse
 from packaging.version import parse, Version
 from loguru import logger
 
+from src.cache import MetadataCache
 from src.functions import (
     filename_from_any_path,
     search_mapping,
@@ -15,6 +17,17 @@ from src.functions import (
     str_to_bool,
     get_env_value,
 )
+from src.actions import (
+    SyncAction,
+    group_actions,
+    group_series_actions,
+    is_satisfied,
+    is_superseded,
+)
+from src.checkpoint import Checkpoint
+from src.ledger import WriteLedger
+from src.limiter import AdaptiveLimiter, limit_session, load_limiter
+from src.outbox import WriteOutbox
 from src.watched import (
     LibraryData,
     MediaIdentifiers,
@@ -23,6 +36,7 @@ from src.watched import (
     Series,
     UserData,
     check_same_identifiers,
+    filter_watched_since,
 )
 
 
@@ -74,6 +88,19 @@ def extract_identifiers_from_item(
     )
 
 
+def get_users_activity(users: list[dict[str, Any]]) -> dict[str, datetime | None]:
+    activity: dict[str, datetime | None] = {}
+    for user in users:
+        activity_dates = [
+            datetime.fromisoformat(date.replace("Z", "+00:00"))
+            for date in [user.get("LastActivityDate"), user.get("LastLoginDate")]
+            if date
+        ]
+        activity[user["Name"]] = max(activity_dates) if activity_dates else None
+
+    return activity
+
+
 def get_mediaitem(
     server_type: str,
     item: dict[str, Any],
@@ -99,7 +126,19 @@ def get_mediaitem(
     )
 
 
+def get_since_filter(since: datetime | None) -> str:
+    # User data saved since the date, covers marking watched and playback progress
+    if since is None:
+        return ""
+
+    date = since.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return f"&{urlencode({'MinDateLastSavedForUser': date})}"
+
+
 class JellyfinEmby:
+    # Path of the websocket used for server events, set by the subclasses
+    socket_path: str
+
     def __init__(
         self,
         env,
@@ -124,10 +163,25 @@ class JellyfinEmby:
         if not self.token:
             raise Exception(f"{self.server_type} token not set")
 
-        self.session = requests.Session()
-        self.users: dict[str, str] = self.get_users()
-        self.server_name: str = self.info(name_only=True)
-        self.server_version: Version = self.info(version_only=True)
+        # Adapts the number of requests in flight to how the server copes
+        self.limiter: AdaptiveLimiter | None = load_limiter(
+            self.env, f"{self.server_type} {self.base_url}"
+        )
+        self.session = self.create_session()
+        self.cache: MetadataCache = MetadataCache(self.server_type)
+        # Ledger of the states written to this server, shared by all servers
+        self.ledger: WriteLedger | None = None
+        # Failed writes that are retried on their own, shared by all servers
+        self.outbox: WriteOutbox | None = None
+        # Position in the configured connections, set once connected
+        self.connection_index: int | None = None
+        self.users_activity: dict[str, datetime | None] = {}
+        self.users: dict[str, str] = self.cache.get("users", self.get_users)
+        # Fetch the server info once, name and version are both read from it
+        self.server_info: dict[str, Any] = self.get_server_info()
+        self.server_name: str = self.server_info.get("ServerName", "")
+        self.server_id: str = self.server_info.get("Id", "")
+        self.server_version: Version = parse(self.server_info.get("Version", ""))
         self.update_partial: bool = self.is_partial_update_supported(
             self.server_version
         )
@@ -138,16 +192,19 @@ class JellyfinEmby:
             get_env_value(self.env, "GENERATE_LOCATIONS", "True")
         )
 
+    def create_session(self) -> requests.Session:
+        return limit_session(requests.Session(), self.limiter)
+
     def query(
         self,
         query: str,
         query_type: Literal["get", "post"],
         identifiers: dict[str, str] | None = None,
         json: dict[str, Any] | None = None,
+        retry: bool = True,
     ) -> list[dict[str, Any]] | dict[str, Any] | None:
+        results = None
         try:
-            results = None
-
             if query_type == "get":
                 response = self.session.get(
                     self.base_url + query, headers=self.headers, timeout=self.timeout
@@ -187,34 +244,70 @@ class JellyfinEmby:
 
             return results
 
+        except requests.exceptions.ConnectionError as e:
+            if not retry:
+                logger.error(f"{self.server_type}: Query {query_type} {query}\n{e}")
+                raise Exception(e)
+
+            # Pooled connections can go stale between loops, retry once with a new session
+            logger.warning(
+                f"{self.server_type}: Connection error, retrying with a new session, {e}"
+            )
+            self.session.close()
+            self.session = self.create_session()
+            return self.query(query, query_type, identifiers, json, retry=False)
+
         except Exception as e:
             logger.error(
                 f"{self.server_type}: Query {query_type} {query}\nResults {results}\n{e}",
             )
             raise Exception(e)
 
-    def info(
-        self, name_only: bool = False, version_only: bool = False
-    ) -> str | Version | None:
+    def get_server_info(self) -> dict[str, Any]:
         try:
             query_string = "/System/Info/Public"
 
             response = self.query(query_string, "get")
 
-            if response and isinstance(response, dict):
-                if name_only:
-                    return response.get("ServerName")
-                elif version_only:
-                    return parse(response.get("Version", ""))
+            if not response or not isinstance(response, dict):
+                raise Exception("Server info response is empty")
 
-                return f"{self.server_type} {response.get('ServerName')}: {response.get('Version')}"
-            else:
-                return None
+            return response
 
         except Exception as e:
             logger.error(f"{self.server_type}: Get server name failed {e}")
             raise Exception(e)
 
+    def info(
+        self, name_only: bool = False, version_only: bool = False
+    ) -> str | Version | None:
+        if name_only:
+            return self.server_info.get("ServerName")
+        elif version_only:
+            return parse(self.server_info.get("Version", ""))
+
+        return f"{self.server_type} {self.server_info.get('ServerName')}: {self.server_info.get('Version')}"
+
+    def refresh(self) -> None:
+        # The activity of the users is fetched again on every run, even while the
+        # cached user list is kept
+        self.users_activity = {}
+        # Pick up added or removed users once the cached user list has expired
+        self.users = self.cache.get("users", self.get_users)
+
+    def reconnect(self) -> None:
+        logger.info(f"{self.server_type}: Reconnecting to {self.base_url}")
+        self.session.close()
+        self.session = self.create_session()
+        self.cache.clear()
+
+        self.server_info = self.get_server_info()
+        self.server_name = self.server_info.get("ServerName", "")
+        self.server_id = self.server_info.get("Id", "")
+        self.server_version = parse(self.server_info.get("Version", ""))
+        self.update_partial = self.is_partial_update_supported(self.server_version)
+        self.users = self.cache.get("users", self.get_users)
+
     def get_users(self) -> dict[str, str]:
         try:
             users: dict[str, str] = {}
@@ -226,20 +319,86 @@ class JellyfinEmby:
                 for user in response:
                     users[user["Name"]] = user["Id"]
 
+                # Keep track of the latest activity so idle users can be skipped
+                self.users_activity = get_users_activity(response)
+
             return users
         except Exception as e:
             logger.error(f"{self.server_type}: Get users failed {e}")
             raise Exception(e)
 
+    def get_users_activity(
+        self, since: datetime | None = None
+    ) -> dict[str, datetime | None]:
+        # LastActivityDate and LastLoginDate are part of the /Users response, it is
+        # only fetched again when the user list came from the cache
+        if not self.users_activity:
+            response = self.query("/Users", "get")
+            if response and isinstance(response, list):
+                self.users_activity = get_users_activity(response)
+
+        return self.users_activity
+
+    def get_user_views(
+        self, user_id: str
+    ) -> list[dict[str, Any]] | dict[str, Any] | None:
+        return self.cache.get(
+            ("views", user_id), lambda: self.query(f"/Users/{user_id}/Views", "get")
+        )
+
+    def get_socket_url(self) -> str:
+        url = urlparse(self.base_url)
+        scheme = "wss" if url.scheme == "https" else "ws"
+        query = urlencode(
+            {"api_key": self.token, "deviceId": "jellyplex-watched-socket"}
+        )
+        return (
+            f"{scheme}://{url.netloc}{url.path.rstrip('/')}{self.socket_path}?{query}"
+        )
+
+    def get_recent_user_data(self, since: datetime) -> list[tuple[str, str, str]]:
+        """
+        Get the items whose user data changed since the given date as
+        (user name, user id, item id), used while the websocket is down.
+        """
+        changed: list[tuple[str, str, str]] = []
+        for user_name, user_id in self.users.items():
+            response = self.query(
+                f"/Users/{user_id}/Items"
+                + "?SortBy=DatePlayed&SortOrder=Descending&IncludeItemTypes=Movie,Episode&Recursive=True&Limit=50&Fields=UserDataLastPlayedDate",
+                "get",
+            )
+            if not response or not isinstance(response, dict):
+                continue
+
+            for item in response.get("Items", []):
+                last_played_date = item.get("UserData", {}).get("LastPlayedDate")
+                if not last_played_date:
+                    break
+
+                # Items are sorted by play date so everything after this is older
+                if (
+                    datetime.fromisoformat(last_played_date.replace("Z", "+00:00"))
+                    < since
+                ):
+                    break
+
+                changed.append((user_name, user_id, item["Id"]))
+
+        return changed
+
     def get_libraries(self) -> dict[str, str]:
+        return self.cache.get("libraries", self.fetch_libraries)
+
+    def fetch_libraries(self) -> dict[str, str]:
         try:
             libraries: dict[str, str] = {}
 
             # Theres no way to get all libraries so individually get list of libraries from all users
-            users = self.get_users()
+            users = self.cache.get("users", self.get_users)
 
             for user_name, user_id in users.items():
-                user_libraries = self.query(f"/Users/{user_id}/Views", "get")
+                user_libraries = self.get_user_views(user_id)
 
                 if not user_libraries or not isinstance(user_libraries, dict):
                     logger.error(
@@ -258,11 +417,14 @@ class JellyfinEmby:
                     # If collection type is not set, fallback based on media files
                     if not library_type:
                         library_id = library.get("Id")
-                        # Get first 100 items in library
-                        library_items = self.query(
-                            f"/Users/{user_id}/Items"
-                            + f"?ParentId={library_id}&Recursive=True&excludeItemTypes=Folder&limit=100",
-                            "get",
+                        # Get first 100 items in library, the library is shared between users so only sample it once
+                        library_items = self.cache.get(
+                            ("library_sample", library_id),
+                            lambda: self.query(
+                                f"/Users/{user_id}/Items"
+                                + f"?ParentId={library_id}&Recursive=True&excludeItemTypes=Folder&limit=100",
+                                "get",
+                            ),
                         )
 
                         if not library_items or not isinstance(library_items, dict):
@@ -308,8 +470,10 @@ class JellyfinEmby:
         library_type: Literal["movies", "tvshows"],
         library_id: str,
         library_title: str,
+        since: datetime | None = None,
     ) -> LibraryData:
         user_name = user_name.lower()
+        since_filter = get_since_filter(since)
         try:
             logger.info(
                 f"{self.server_type}: Generating watched for {user_name} in library {library_title}",
@@ -321,7 +485,8 @@ class JellyfinEmby:
                 movie_items = []
                 watched_items = self.query(
                     f"/Users/{user_id}/Items"
-                    + f"?ParentId={library_id}&Filters=IsPlayed&IncludeItemTypes=Movie&Recursive=True&Fields=ItemCounts,ProviderIds,Path,UserDataLastPlayedDate",
+                    + f"?ParentId={library_id}&Filters=IsPlayed&IncludeItemTypes=Movie&Recursive=True&Fields=ItemCounts,ProviderIds,Path,UserDataLastPlayedDate"
+                    + since_filter,
                     "get",
                 )
 
@@ -330,7 +495,8 @@ class JellyfinEmby:
 
                 in_progress_items = self.query(
                     f"/Users/{user_id}/Items"
-                    + f"?ParentId={library_id}&Filters=IsResumable&IncludeItemTypes=Movie&Recursive=True&Fields=ItemCounts,ProviderIds,Path,UserDataLastPlayedDate",
+                    + f"?ParentId={library_id}&Filters=IsResumable&IncludeItemTypes=Movie&Recursive=True&Fields=ItemCounts,ProviderIds,Path,UserDataLastPlayedDate"
+                    + since_filter,
                     "get",
                 )
 
@@ -375,12 +541,33 @@ class JellyfinEmby:
                     )
                     return watched
 
+                # Only look at the episodes of shows with recent activity
+                recent_show_ids = None
+                if since is not None:
+                    recent_episodes = self.query(
+                        f"/Users/{user_id}/Items"
+                        + f"?ParentId={library_id}&IncludeItemTypes=Episode&Recursive=True&Fields=SeriesId"
+                        + since_filter,
+                        "get",
+                    )
+                    if recent_episodes and isinstance(recent_episodes, dict):
+                        recent_show_ids = {
+                            episode.get("SeriesId")
+                            for episode in recent_episodes.get("Items", [])
+                        }
+
                 # Filter the list of shows to only include those that have been partially or fully watched
                 watched_shows_filtered = []
                 for show in all_shows.get("Items", []):
                     if not show.get("UserData"):
                         continue
 
+                    if (
+                        recent_show_ids is not None
+                        and show.get("Id") not in recent_show_ids
+                    ):
+                        continue
+
                     played_percentage = show["UserData"].get("PlayedPercentage")
                     if played_percentage is None:
                         # Emby no longer shows PlayedPercentage
@@ -476,12 +663,140 @@ class JellyfinEmby:
             logger.error(traceback.format_exc())
             return LibraryData(title=library_title)
 
+    def get_active_sessions(self) -> list[tuple[str, str | None, str, int]]:
+        """
+        Get the movies and episodes that are currently playing as
+        (user name, user id, item id, position in milliseconds).
+        """
+        try:
+            sessions: list[tuple[str, str | None, str, int]] = []
+            response = self.query("/Sessions?ActiveWithinSeconds=120", "get")
+            for session in response if isinstance(response, list) else []:
+                item = session.get("NowPlayingItem")
+                if not item or item.get("Type") not in ["Movie", "Episode"]:
+                    continue
+
+                sessions.append(
+                    (
+                        session.get("UserName", ""),
+                        session.get("UserId"),
+                        item["Id"],
+                        floor(
+                            session.get("PlayState", {}).get("PositionTicks", 0) / 10000
+                        ),
+                    )
+                )
+
+            return sessions
+        except Exception as e:
+            logger.error(
+                f"{self.server_type}: Failed to get active sessions, Error: {e}"
+            )
+            raise Exception(e)
+
+    def get_item_watched(
+        self, user_name: str, item_id: str, user_id: str | None = None
+    ) -> tuple[str, str, str, LibraryData] | None:
+        """
+        Get the watched status of a single item for a user, used to sync webhook events.
+        Returns the user name, library title, library type and the item as LibraryData.
+        """
+        try:
+            for name, id in self.users.items():
+                if id == user_id or name.lower() == user_name.lower():
+                    user_name, user_id = name, id
+                    break
+            else:
+                logger.info(f"{self.server_type}: User {user_name} not found")
+                return None
+
+            item = self.query(
+                f"/Users/{user_id}/Items/{item_id}",
+                "get",
+            )
+            if not item or not isinstance(item, dict):
+                logger.debug(f"{self.server_type}: Item {item_id} not found")
+                return None
+
+            # The library the item is in is one of its ancestors
+            ancestors = self.query(
+                f"/Items/{item_id}/Ancestors?userId={user_id}", "get"
+            )
+            ancestor_ids = [
+                ancestor.get("Id")
+                for ancestor in (ancestors if isinstance(ancestors, list) else [])
+            ]
+            user_libraries = self.get_user_views(user_id)
+            if not user_libraries or not isinstance(user_libraries, dict):
+                return None
+
+            library = next(
+                (
+                    library
+                    for library in user_libraries.get("Items", [])
+                    if library.get("Id") in ancestor_ids
+                ),
+                None,
+            )
+            if not library:
+                logger.debug(
+                    f"{self.server_type}: Library for {item.get('Name')} not found"
+                )
+                return None
+
+            library_title = library.get("Name")
+            watched = LibraryData(title=library_title)
+
+            # Skip if not watched or watched less than a minute
+            user_data = item.get("UserData", {})
+            if (
+                not user_data.get("Played")
+                and user_data.get("PlaybackPositionTicks", 0) <= 600000000
+            ):
+                return user_name, library_title, library.get("CollectionType"), watched
+
+            mediaitem = get_mediaitem(
+                self.server_type, item, self.generate_guids, self.generate_locations
+            )
+            if item.get("Type") == "Movie":
+                watched.movies.append(mediaitem)
+            elif item.get("Type") == "Episode":
+                show = self.query(
+                    f"/Users/{user_id}/Items/{item.get('SeriesId')}", "get"
+                )
+                if not show or not isinstance(show, dict):
+                    return None
+
+                watched.series.append(
+                    Series(
+                        identifiers=extract_identifiers_from_item(
+                            self.server_type,
+                            show,
+                            self.generate_guids,
+                            self.generate_locations,
+                        ),
+                        episodes=[mediaitem],
+                    )
+                )
+
+            return user_name, library_title, library.get("CollectionType"), watched
+        except Exception as e:
+            logger.error(
+                f"{self.server_type}: Failed to get item {item_id} for {user_name}, Error: {e}"
+            )
+            return None
+
     def get_watched(
         self,
         users: dict[str, str],
         sync_libraries: list[str],
         users_watched: dict[str, UserData] | None = None,
+        checkpoint: Checkpoint | None = None,
+        since: datetime | None = None,
     ) -> dict[str, UserData]:
+        """
+        With since only items played at or after it are gathered.
+        """
         try:
             if not users_watched:
                 users_watched: dict[str, UserData] = {}
@@ -490,7 +805,7 @@ class JellyfinEmby:
                 if user_name.lower() not in users_watched:
                     users_watched[user_name.lower()] = UserData()
 
-                all_libraries = self.query(f"/Users/{user_id}/Views", "get")
+                all_libraries = self.get_user_views(user_id)
                 if not all_libraries or not isinstance(all_libraries, dict):
                     logger.debug(
                         f"{self.server_type}: Failed to get all libraries for {user_name}"
@@ -511,7 +826,7 @@ class JellyfinEmby:
                     if library_title not in sync_libraries:
                         continue
 
-                    if library_title in users_watched:
+                    if library_title in users_watched[user_name.lower()].libraries:
                         logger.info(
                             f"{self.server_type}: {user_name} {library_title} watched history has already been gathered, skipping"
                         )
@@ -524,7 +839,11 @@ class JellyfinEmby:
                         library_type,
                         library_id,
                         library_title,
+                        since,
                     )
+                    # The server filter is on the user data save date, keep what was played since
+                    if since is not None:
+                        library_data = filter_watched_since(library_data, since)
 
                     if user_name.lower() not in users_watched:
                         users_watched[user_name.lower()] = UserData()
@@ -532,32 +851,108 @@ class JellyfinEmby:
                     users_watched[user_name.lower()].libraries[library_title] = (
                         library_data
                     )
+                    if checkpoint:
+                        checkpoint.record_gather(
+                            self, user_name, library_title, library_data
+                        )
 
             return users_watched
         except Exception as e:
             logger.error(f"{self.server_type}: Failed to get watched, Error: {e}")
             return {}
 
+    def write_user_data(self, user_id: str, item_id: str, action: SyncAction) -> None:
+        viewed_date: str = action.viewed_date.isoformat(
+            timespec="milliseconds"
+        ).replace("+00:00", "Z")
+
+        if action.action == "mark_watched":
+            user_data_payload: dict[str, Any] = {
+                "PlayCount": 1,
+                "Played": True,
+                "PlaybackPositionTicks": 0,
+                "LastPlayedDate": viewed_date,
+            }
+        else:
+            user_data_payload = {
+                "PlayCount": 0,
+                "Played": False,
+                "PlaybackPositionTicks": action.position * 10_000,
+                "LastPlayedDate": viewed_date,
+            }
+
+        self.query(
+            f"/Users/{user_id}/Items/{item_id}/UserData",
+            "post",
+            json=user_data_payload,
+        )
+
+    def retry_write(self, user_name: str, action: SyncAction) -> bool:
+        """
+        Write an action from the outbox straight to its item, without searching
+        the library again. Returns False without writing when the item already
+        has the state or was played since.
+        """
+        for name, user_id in self.users.items():
+            if name.lower() == user_name.lower():
+                item = self.query(f"/Users/{user_id}/Items/{action.target_id}", "get")
+                if not item or not isinstance(item, dict):
+                    raise Exception(f"Item {action.target_id} not found")
+
+                user_data = item.get("UserData", {})
+                last_played_date = user_data.get("LastPlayedDate")
+                if is_superseded(
+                    action,
+                    bool(user_data.get("Played")),
+                    floor(user_data.get("PlaybackPositionTicks", 0) / 10_000),
+                    datetime.fromisoformat(last_played_date.replace("Z", "+00:00"))
+                    if last_played_date
+                    else None,
+                ):
+                    return False
+
+                self.write_user_data(user_id, str(action.target_id), action)
+                return True
+
+        raise Exception(f"User {user_name} not found")
+
+    def record_write(self, user_name: str, action: SyncAction) -> None:
+        action.outcome = "written"
+        if self.ledger:
+            self.ledger.record(self, user_name, action)
+        if self.outbox:
+            self.outbox.remove(self, user_name, action)
+
+    def record_failed_write(
+        self, user_name: str, action: SyncAction, error: Exception
+    ) -> None:
+        action.outcome = "failed"
+        if self.outbox:
+            self.outbox.add(self, user_name, action, str(error))
+
     def update_user_watched(
         self,
         user_name: str,
         user_id: str,
-        library_data: LibraryData,
+        actions: list[SyncAction],
         library_name: str,
         library_id: str,
         dryrun: bool,
     ) -> None:
         try:
             # If there are no movies or shows to update, exit early.
-            if not library_data.series and not library_data.movies:
+            if not actions:
                 return
 
+            movie_actions = [action for action in actions if action.series is None]
+            series_actions = group_series_actions(actions)
+
             logger.info(
                 f"{self.server_type}: Updating watched for {user_name} in library {library_name}",
             )
 
             # Update movies.
-            if library_data.movies:
+            if movie_actions:
                 jellyfin_search = self.query(
                     f"/Users/{user_id}/Items"
                     + f"?SortBy=SortName&SortOrder=Ascending&Recursive=True&ParentId={library_id}"
@@ -571,40 +966,59 @@ class JellyfinEmby:
                     )
                     return
 
-                for jellyfin_video in jellyfin_search.get("Items", []):
-                    jelly_identifiers = extract_identifiers_from_item(
-                        self.server_type,
+                jellyfin_videos = [
+                    (
                         jellyfin_video,
-                        self.generate_guids,
-                        self.generate_locations,
+                        extract_identifiers_from_item(
+                            self.server_type,
+                            jellyfin_video,
+                            self.generate_guids,
+                            self.generate_locations,
+                        ),
                     )
-                    # Check each stored movie for a match.
-                    for stored_movie in library_data.movies:
+                    for jellyfin_video in jellyfin_search.get("Items", [])
+                ]
+
+                # Check each stored movie for a match, most recently viewed first.
+                for action in movie_actions:
+                    for jellyfin_video, jelly_identifiers in jellyfin_videos:
                         if check_same_identifiers(
-                            jelly_identifiers, stored_movie.identifiers
+                            jelly_identifiers, action.identifiers
                         ):
                             jellyfin_video_id = jellyfin_video.get("Id")
+                            action.target_id = jellyfin_video_id
+                            user_data = jellyfin_video.get("UserData", {})
+                            if is_satisfied(
+                                action,
+                                bool(user_data.get("Played")),
+                                floor(
+                                    user_data.get("PlaybackPositionTicks", 0) / 10_000
+                                ),
+                            ):
+                                action.outcome = "satisfied"
+                                continue
 
-                            viewed_date: str = (
-                                stored_movie.status.viewed_date.isoformat(
-                                    timespec="milliseconds"
-                                ).replace("+00:00", "Z")
-                            )
+                            if self.ledger and not self.ledger.should_write(
+                                self, user_name, action
+                            ):
+                                action.outcome = "skipped"
+                                continue
 
-                            if stored_movie.status.completed:
+                            if action.action == "mark_watched":
                                 msg = f"{self.server_type}: {jellyfin_video.get('Name')} as watched for {user_name} in {library_name}"
                                 if not dryrun:
-                                    user_data_payload: dict[str, Any] = {
-                                        "PlayCount": 1,
-                                        "Played": True,
-                                        "PlaybackPositionTicks": 0,
-                                        "LastPlayedDate": viewed_date,
-                                    }
-                                    self.query(
-                                        f"/Users/{user_id}/Items/{jellyfin_video_id}/UserData",
-                                        "post",
-                                        json=user_data_payload,
-                                    )
+                                    try:
+                                        self.write_user_data(
+                                            user_id, jellyfin_video_id, action
+                                        )
+                                    except Exception as e:
+                                        logger.error(
+                                            f"{self.server_type}: Failed to update {action.identifiers.title} for {user_name}, Error: {e}"
+                                        )
+                                        self.record_failed_write(user_name, action, e)
+                                        continue
+
+                                    self.record_write(user_name, action)
 
                                 logger.success(f"{'[DRYRUN] ' if dryrun else ''}{msg}")
                                 log_marked(
@@ -618,21 +1032,21 @@ class JellyfinEmby:
                                     ),
                                 )
                             elif self.update_partial:
-                                msg = f"{self.server_type}: {jellyfin_video.get('Name')} as partially watched for {floor(stored_movie.status.time / 60_000)} minutes for {user_name} in {library_name}"
+                                msg = f"{self.server_type}: {jellyfin_video.get('Name')} as partially watched for {floor(action.position / 60_000)} minutes for {user_name} in {library_name}"
 
                                 if not dryrun:
-                                    user_data_payload: dict[str, Any] = {
-                                        "PlayCount": 0,
-                                        "Played": False,
-                                        "PlaybackPositionTicks": stored_movie.status.time
-                                        * 10_000,
-                                        "LastPlayedDate": viewed_date,
-                                    }
-                                    self.query(
-                                        f"/Users/{user_id}/Items/{jellyfin_video_id}/UserData",
-                                        "post",
-                                        json=user_data_payload,
-                                    )
+                                    try:
+                                        self.write_user_data(
+                                            user_id, jellyfin_video_id, action
+                                        )
+                                    except Exception as e:
+                                        logger.error(
+                                            f"{self.server_type}: Failed to update {action.identifiers.title} for {user_name}, Error: {e}"
+                                        )
+                                        self.record_failed_write(user_name, action, e)
+                                        continue
+
+                                    self.record_write(user_name, action)
 
                                 logger.success(f"{'[DRYRUN] ' if dryrun else ''}{msg}")
                                 log_marked(
@@ -641,7 +1055,7 @@ class JellyfinEmby:
                                     user_name,
                                     library_name,
                                     jellyfin_video.get("Name"),
-                                    duration=floor(stored_movie.status.time / 60_000),
+                                    duration=floor(action.position / 60_000),
                                     mark_file=get_env_value(
                                         self.env, "MARK_FILE", "mark.log"
                                     ),
@@ -652,7 +1066,7 @@ class JellyfinEmby:
                             )
 
             # Update TV Shows (series/episodes).
-            if library_data.series:
+            if series_actions:
                 jellyfin_search = self.query(
                     f"/Users/{user_id}/Items"
                     + f"?SortBy=SortName&SortOrder=Ascending&Recursive=True&ParentId={library_id}"
@@ -665,19 +1079,24 @@ class JellyfinEmby:
                     )
                     return
 
-                jellyfin_shows = [x for x in jellyfin_search.get("Items", [])]
-
-                for jellyfin_show in jellyfin_shows:
-                    jellyfin_show_identifiers = extract_identifiers_from_item(
-                        self.server_type,
+                jellyfin_shows = [
+                    (
                         jellyfin_show,
-                        self.generate_guids,
-                        self.generate_locations,
+                        extract_identifiers_from_item(
+                            self.server_type,
+                            jellyfin_show,
+                            self.generate_guids,
+                            self.generate_locations,
+                        ),
                     )
-                    # Try to find a matching series in your stored library.
-                    for stored_series in library_data.series:
+                    for jellyfin_show in jellyfin_search.get("Items", [])
+                ]
+
+                # Try to find each stored series, most recently viewed first.
+                for series_identifiers, episode_actions in series_actions:
+                    for jellyfin_show, jellyfin_show_identifiers in jellyfin_shows:
                         if check_same_identifiers(
-                            jellyfin_show_identifiers, stored_series.identifiers
+                            jellyfin_show_identifiers, series_identifiers
                         ):
                             logger.trace(
                                 f"Found matching show for '{jellyfin_show.get('Name')}'",
@@ -699,45 +1118,74 @@ class JellyfinEmby:
                                 )
                                 return
 
-                            for jellyfin_episode in jellyfin_episodes.get("Items", []):
-                                jellyfin_episode_identifiers = (
+                            episode_items = [
+                                (
+                                    jellyfin_episode,
                                     extract_identifiers_from_item(
                                         self.server_type,
                                         jellyfin_episode,
                                         self.generate_guids,
                                         self.generate_locations,
-                                    )
+                                    ),
+                                )
+                                for jellyfin_episode in jellyfin_episodes.get(
+                                    "Items", []
                                 )
-                                for stored_ep in stored_series.episodes:
+                            ]
+
+                            for action in episode_actions:
+                                for (
+                                    jellyfin_episode,
+                                    jellyfin_episode_identifiers,
+                                ) in episode_items:
                                     if check_same_identifiers(
                                         jellyfin_episode_identifiers,
-                                        stored_ep.identifiers,
+                                        action.identifiers,
                                     ):
                                         jellyfin_episode_id = jellyfin_episode.get("Id")
-
-                                        viewed_date: str = (
-                                            stored_ep.status.viewed_date.isoformat(
-                                                timespec="milliseconds"
-                                            ).replace("+00:00", "Z")
-                                        )
-
-                                        if stored_ep.status.completed:
+                                        action.target_id = jellyfin_episode_id
+                                        user_data = jellyfin_episode.get("UserData", {})
+                                        if is_satisfied(
+                                            action,
+                                            bool(user_data.get("Played")),
+                                            floor(
+                                                user_data.get(
+                                                    "PlaybackPositionTicks", 0
+                                                )
+                                                / 10_000
+                                            ),
+                                        ):
+                                            action.outcome = "satisfied"
+                                            continue
+
+                                        if self.ledger and not self.ledger.should_write(
+                                            self, user_name, action
+                                        ):
+                                            action.outcome = "skipped"
+                                            continue
+
+                                        if action.action == "mark_watched":
                                             msg = (
                                                 f"{self.server_type}: {jellyfin_episode.get('SeriesName')} {jellyfin_episode.get('SeasonName')} Episode {jellyfin_episode.get('IndexNumber')} {jellyfin_episode.get('Name')}"
                                                 + f" as watched for {user_name} in {library_name}"
                                             )
                                             if not dryrun:
-                                                user_data_payload: dict[str, Any] = {
-                                                    "PlayCount": 1,
-                                                    "Played": True,
-                                                    "PlaybackPositionTicks": 0,
-                                                    "LastPlayedDate": viewed_date,
-                                                }
-                                                self.query(
-                                                    f"/Users/{user_id}/Items/{jellyfin_episode_id}/UserData",
-                                                    "post",
-                                                    json=user_data_payload,
-                                                )
+                                                try:
+                                                    self.write_user_data(
+                                                        user_id,
+                                                        jellyfin_episode_id,
+                                                        action,
+                                                    )
+                                                except Exception as e:
+                                                    logger.error(
+                                                        f"{self.server_type}: Failed to update {action.identifiers.title} for {user_name}, Error: {e}"
+                                                    )
+                                                    self.record_failed_write(
+                                                        user_name, action, e
+                                                    )
+                                                    continue
+
+                                                self.record_write(user_name, action)
 
                                             logger.success(
                                                 f"{'[DRYRUN] ' if dryrun else ''}{msg}"
@@ -756,22 +1204,26 @@ class JellyfinEmby:
                                         elif self.update_partial:
                                             msg = (
                                                 f"{self.server_type}: {jellyfin_episode.get('SeriesName')} {jellyfin_episode.get('SeasonName')} Episode {jellyfin_episode.get('IndexNumber')} {jellyfin_episode.get('Name')}"
-                                                + f" as partially watched for {floor(stored_ep.status.time / 60_000)} minutes for {user_name} in {library_name}"
+                                                + f" as partially watched for {floor(action.position / 60_000)} minutes for {user_name} in {library_name}"
                                             )
 
                                             if not dryrun:
-                                                user_data_payload: dict[str, Any] = {
-                                                    "PlayCount": 0,
-                                                    "Played": False,
-                                                    "PlaybackPositionTicks": stored_ep.status.time
-                                                    * 10_000,
-                                                    "LastPlayedDate": viewed_date,
-                                                }
-                                                self.query(
-                                                    f"/Users/{user_id}/Items/{jellyfin_episode_id}/UserData",
-                                                    "post",
-                                                    json=user_data_payload,
-                                                )
+                                                try:
+                                                    self.write_user_data(
+                                                        user_id,
+                                                        jellyfin_episode_id,
+                                                        action,
+                                                    )
+                                                except Exception as e:
+                                                    logger.error(
+                                                        f"{self.server_type}: Failed to update {action.identifiers.title} for {user_name}, Error: {e}"
+                                                    )
+                                                    self.record_failed_write(
+                                                        user_name, action, e
+                                                    )
+                                                    continue
+
+                                                self.record_write(user_name, action)
 
                                             logger.success(
                                                 f"{'[DRYRUN] ' if dryrun else ''}{msg}"
@@ -784,7 +1236,7 @@ class JellyfinEmby:
                                                 jellyfin_episode.get("SeriesName"),
                                                 jellyfin_episode.get("Name"),
                                                 duration=floor(
-                                                    stored_ep.status.time / 60_000
+                                                    action.position / 60_000
                                                 ),
                                                 mark_file=get_env_value(
                                                     self.env, "MARK_FILE", "mark.log"
@@ -806,12 +1258,12 @@ class JellyfinEmby:
 
     def update_watched(
         self,
-        watched_list: dict[str, UserData],
+        actions: list[SyncAction],
         user_mapping: dict[str, str] | None = None,
         library_mapping: dict[str, str] | None = None,
         dryrun: bool = False,
     ) -> None:
-        for user, user_data in watched_list.items():
+        for user, user_actions in group_actions(actions).items():
             user_other = None
             user_name = None
             if user_mapping:
@@ -835,10 +1287,7 @@ class JellyfinEmby:
                 logger.info(f"{user} {user_other} not found in Jellyfin")
                 continue
 
-            jellyfin_libraries = self.query(
-                f"/Users/{user_id}/Views",
-                "get",
-            )
+            jellyfin_libraries = self.get_user_views(user_id)
 
             if not jellyfin_libraries or not isinstance(jellyfin_libraries, dict):
                 logger.debug(
@@ -848,8 +1297,7 @@ class JellyfinEmby:
 
             jellyfin_libraries = [x for x in jellyfin_libraries.get("Items", [])]
 
-            for library_name in user_data.libraries:
-                library_data = user_data.libraries[library_name]
+            for library_name, library_actions in user_actions.items():
                 library_other = None
                 if library_mapping:
                     if library_name in library_mapping.keys():
@@ -890,7 +1338,7 @@ class JellyfinEmby:
                         self.update_user_watched(
                             user_name,
                             user_id,
-                            library_data,
+                            library_actions,
                             library_name,
                             library_id,
                             dryrun,
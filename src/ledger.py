@@ -0,0 +1,214 @@
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Any
+from loguru import logger
+
+from src.actions import POSITION_TOLERANCE, SyncAction
+from src.activity import get_server_key
+from src.functions import get_env_value, str_to_bool
+
+
+def same_state(
+    action_1: str, position_1: int, action_2: str, position_2: int | None
+) -> bool:
+    if action_1 != action_2:
+        return False
+
+    if action_1 == "mark_watched":
+        return True
+
+    return position_2 is not None and abs(position_1 - position_2) <= POSITION_TOLERANCE
+
+
+class WriteLedger:
+    """
+    SQLite record of the last state written to every server item. Items whose state
+    keeps flipping back and forth between two states are not written for damping
+    seconds. The current state of the target decides whether a write is needed, the
+    ledger is only consulted for items that differ from the action.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        oscillation_window: float = 86400,
+        oscillation_limit: int = 3,
+        damping: float = 86400,
+    ) -> None:
+        self.path: str = path
+        self.oscillation_window: float = oscillation_window
+        self.oscillation_limit: int = oscillation_limit
+        self.damping: float = damping
+        # Writers run from the sync loop, the webhook and the session threads
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS writes ("
+            "server TEXT, user TEXT, item TEXT, action TEXT, position INTEGER, "
+            "previous_action TEXT, previous_position INTEGER, written REAL, "
+            "flips INTEGER, damped_until REAL, PRIMARY KEY (server, user, item))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS metrics (name TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self.connection.commit()
+        self.writes: int = 0
+        self.damped: int = 0
+
+    def get_row(self, server: Any, user: str, item: str) -> tuple | None:
+        return self.connection.execute(
+            "SELECT action, position, previous_action, previous_position, written, "
+            "flips, damped_until FROM writes WHERE server = ? AND user = ? AND item = ?",
+            (get_server_key(server), user.lower(), item),
+        ).fetchone()
+
+    def should_write(
+        self, server: Any, user: str, action: SyncAction, now: float | None = None
+    ) -> bool:
+        """
+        Whether to write an action whose target item is_satisfied found to differ.
+        A state written before is not skipped, the item was changed since.
+        """
+        if action.target_id is None:
+            return True
+
+        now = time() if now is None else now
+        with self.lock:
+            row = self.get_row(server, user, action.target_id)
+            if row is None:
+                return True
+
+            damped_until = row[6]
+            if damped_until and now < damped_until:
+                self.damped += 1
+                logger.debug(
+                    f"Write ledger: {action.identifiers.title} for {user} on {server.info()} is oscillating, skipping"
+                )
+                return False
+
+        return True
+
+    def record(
+        self, server: Any, user: str, action: SyncAction, now: float | None = None
+    ) -> None:
+        if action.target_id is None:
+            return
+
+        now = time() if now is None else now
+        with self.lock:
+            row = self.get_row(server, user, action.target_id)
+            previous_action, previous_position = None, None
+            flips, damped_until = 0, None
+            if row is not None:
+                last_action, last_position, before_action, before_position = row[:4]
+                written, flips = row[4], row[5]
+                if same_state(
+                    action.action, action.position, last_action, last_position
+                ):
+                    previous_action, previous_position = (
+                        before_action,
+                        before_position,
+                    )
+                else:
+                    previous_action, previous_position = last_action, last_position
+                    # Going back to the state before the last one is a flip,
+                    # moving on to a new state like further progress is not
+                    if (
+                        before_action
+                        and same_state(
+                            action.action,
+                            action.position,
+                            before_action,
+                            before_position,
+                        )
+                        and now - written <= self.oscillation_window
+                    ):
+                        flips += 1
+                    else:
+                        flips = 0
+
+                if flips >= self.oscillation_limit:
+                    logger.warning(
+                        f"Write ledger: {action.identifiers.title} for {user} on {server.info()} flipped {flips} times, not writing it for {self.damping} seconds"
+                    )
+                    damped_until = now + self.damping
+                    flips = 0
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    get_server_key(server),
+                    user.lower(),
+                    action.target_id,
+                    action.action,
+                    action.position,
+                    previous_action,
+                    previous_position,
+                    now,
+                    flips,
+                    damped_until,
+                ),
+            )
+            self.connection.commit()
+            self.writes += 1
+
+    def log_metrics(self) -> None:
+        """
+        Log the writes of this run and add them to the totals stored in the ledger.
+        """
+        with self.lock:
+            for name, value in [
+                ("writes", self.writes),
+                ("damped", self.damped),
+            ]:
+                self.connection.execute(
+                    "INSERT INTO metrics VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    (name, value),
+                )
+            self.connection.commit()
+            totals = dict(
+                self.connection.execute("SELECT name, value FROM metrics").fetchall()
+            )
+
+            attempted = self.writes + self.damped
+            logger.info(
+                f"Write ledger: {self.writes} writes, {self.damped} oscillating writes skipped"
+                + (f", {self.damped / attempted:.0%} saved" if attempted else "")
+            )
+            logger.info(
+                f"Write ledger: {totals.get('writes', 0)} writes, {totals.get('damped', 0)} writes saved in total"
+            )
+            self.writes = 0
+            self.damped = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def load_write_ledger(env) -> WriteLedger | None:
+    if not str_to_bool(get_env_value(env, "WRITE_LEDGER", "False")):
+        return None
+
+    return WriteLedger(
+        get_env_value(env, "WRITE_LEDGER_FILE", "ledger.db"),
+        oscillation_window=float(
+            get_env_value(env, "WRITE_LEDGER_OSCILLATION_WINDOW", "86400")
+        ),
+        oscillation_limit=int(
+            get_env_value(env, "WRITE_LEDGER_OSCILLATION_LIMIT", "3")
+        ),
+        damping=float(get_env_value(env, "WRITE_LEDGER_DAMPING", "86400")),
+    )
+
+
+def log_ledger_metrics(servers: list[Any]) -> None:
+    ledgers: list[WriteLedger] = []
+    for server in servers:
+        if server.ledger and all(server.ledger is not other for other in ledgers):
+            ledgers.append(server.ledger)
+
+    for ledger in ledgers:
+        ledger.log_metrics()
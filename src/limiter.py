@@ -0,0 +1,242 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Condition
+from time import monotonic
+from typing import Any, Mapping
+import requests
+from requests.adapters import BaseAdapter
+from loguru import logger
+
+from src.functions import get_env_value, str_to_bool
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Seconds to wait from a Retry-After header, given either as seconds or as a date.
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+class AdaptiveLimiter:
+    """
+    Limits the requests in flight to a server with additive increase and
+    multiplicative decrease. The limit grows by one per round of requests while
+    latency stays close to the lowest latency seen and is cut on rising latency,
+    timeouts, 5xx and 429 responses. Retry-After pauses all new requests.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        latency_tolerance: float = 3.0,
+        backoff: float = 0.5,
+        max_retry_after: float = 300,
+    ) -> None:
+        self.name: str = name
+        self.min_limit: int = max(1, min_limit)
+        self.max_limit: int = max(self.min_limit, max_limit)
+        self.limit: float = float(min(max(initial, self.min_limit), self.max_limit))
+        self.latency_tolerance: float = latency_tolerance
+        self.backoff: float = backoff
+        self.max_retry_after: float = max_retry_after
+        self.in_flight: int = 0
+        # Lowest latency seen, slowly drifting up so a slower server is relearned
+        self.baseline: float | None = None
+        self.recent: float | None = None
+        self.last_decrease: float = 0
+        self.paused_until: float = 0
+        self.overloads: int = 0
+        self.condition = Condition()
+
+    @property
+    def current_limit(self) -> int:
+        return int(self.limit)
+
+    def acquire(self) -> None:
+        with self.condition:
+            while True:
+                wait = self.paused_until - monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    break
+
+            self.in_flight += 1
+
+    def release(
+        self,
+        latency: float | None = None,
+        overloaded: bool = False,
+        retry_after: float | None = None,
+    ) -> None:
+        """
+        Finish a request, latency is None when the request did not complete.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = monotonic()
+
+            if retry_after is not None:
+                retry_after = min(retry_after, self.max_retry_after)
+                if now + retry_after > self.paused_until:
+                    self.paused_until = now + retry_after
+                    logger.warning(
+                        f"Limiter: {self.name} asked to retry after {retry_after:.0f} seconds, pausing requests"
+                    )
+
+            if overloaded:
+                self.overloads += 1
+                self.decrease(now)
+            elif latency is not None:
+                self.baseline = (
+                    latency
+                    if self.baseline is None
+                    else min(latency, self.baseline + (latency - self.baseline) * 0.01)
+                )
+                self.recent = (
+                    latency
+                    if self.recent is None
+                    else self.recent * 0.8 + latency * 0.2
+                )
+                if self.recent > self.baseline * self.latency_tolerance:
+                    self.decrease(now)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+    def decrease(self, now: float) -> None:
+        # Requests sent before the last cut still report the old load, only cut once per round trip
+        if now - self.last_decrease < (self.recent or 0):
+            return
+
+        limit = max(self.min_limit, self.limit * self.backoff)
+        if int(limit) != int(self.limit):
+            logger.debug(
+                f"Limiter: {self.name} lowering concurrency from {int(self.limit)} to {int(limit)}"
+            )
+        self.limit = limit
+        self.last_decrease = now
+
+    def metrics(self) -> dict[str, Any]:
+        with self.condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "overloads": self.overloads,
+                "latency": self.recent,
+            }
+
+
+class LimitedAdapter(BaseAdapter):
+    """
+    Transport adapter that sends every request through a limiter, wrapping the
+    adapter that was mounted before so the ssl bypass keeps working.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, adapter: BaseAdapter) -> None:
+        super().__init__()
+        self.limiter: AdaptiveLimiter = limiter
+        self.adapter: BaseAdapter = adapter
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: Any = None,
+        verify: bool | str = True,
+        cert: Any = None,
+        proxies: Mapping[str, str] | None = None,
+    ) -> requests.Response:
+        self.limiter.acquire()
+        start = monotonic()
+        try:
+            response = self.adapter.send(
+                request,
+                stream=stream,
+                timeout=timeout,
+                verify=verify,
+                cert=cert,
+                proxies=proxies,
+            )
+            # Count the download of the body, the session would read it right away anyway
+            if not stream:
+                response.content
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            self.limiter.release(overloaded=True)
+            raise
+        except Exception:
+            self.limiter.release()
+            raise
+
+        retry_after = None
+        if response.status_code in [429, 503]:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        self.limiter.release(
+            monotonic() - start,
+            response.status_code == 429 or response.status_code >= 500,
+            retry_after,
+        )
+
+        return response
+
+    def close(self) -> None:
+        self.adapter.close()
+
+
+def limit_session(
+    session: requests.Session, limiter: AdaptiveLimiter | None
+) -> requests.Session:
+    if limiter is None:
+        return session
+
+    for prefix, adapter in list(session.adapters.items()):
+        if not isinstance(adapter, LimitedAdapter):
+            session.mount(prefix, LimitedAdapter(limiter, adapter))
+
+    return session
+
+
+def load_limiter(env, name: str) -> AdaptiveLimiter | None:
+    if not str_to_bool(get_env_value(env, "ADAPTIVE_CONCURRENCY", "False")):
+        return None
+
+    return AdaptiveLimiter(
+        name,
+        initial=int(get_env_value(env, "ADAPTIVE_CONCURRENCY_INITIAL", "4")),
+        min_limit=int(get_env_value(env, "ADAPTIVE_CONCURRENCY_MIN", "1")),
+        max_limit=int(get_env_value(env, "ADAPTIVE_CONCURRENCY_MAX", "32")),
+        latency_tolerance=float(
+            get_env_value(env, "ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE", "3")
+        ),
+        max_retry_after=float(
+            get_env_value(env, "ADAPTIVE_CONCURRENCY_MAX_RETRY_AFTER", "300")
+        ),
+    )
+
+
+def log_limiter_metrics(servers: list[Any]) -> None:
+    for server in servers:
+        if server.limiter:
+            metrics = server.limiter.metrics()
+            logger.info(
+                f"Limiter: {server.info()} concurrency {metrics['limit']}, {metrics['overloads']} overloaded responses"
+            )
@@ -1,7 +1,8 @@
 import os
 import traceback
-import json
 import sys
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable
 from dotenv import dotenv_values
 from time import sleep, perf_counter
 from loguru import logger
@@ -11,20 +12,64 @@ from src.jellyfin import Jellyfin
 from src.plex import Plex
 from src.library import setup_libraries
 from src.functions import (
-    parse_string_to_list,
     str_to_bool,
     get_env_value,
 )
-from src.users import setup_users
+from src.config import SyncConfig, load_sync_config
+from src.users import pair_server_users, setup_users, split_server_users
 from src.watched import (
+    UserData,
     cleanup_watched,
     merge_server_watched,
 )
-from src.black_white import setup_black_white_lists
-from src.connection import generate_server_connections
+from src.actions import (
+    PendingWrites,
+    SyncAction,
+    build_actions,
+    log_action_results,
+    log_actions,
+    write_actions,
+)
+from src.activity import (
+    get_idle_users,
+    get_pair_key,
+    get_user_names,
+    order_users_by_activity,
+    record_user_sync,
+    save_activity,
+    setup_activity,
+)
+from src.budget import RunBudget, load_run_budget
+from src.checkpoint import Checkpoint, load_checkpoint
+from src.connection import (
+    generate_server_connections,
+    get_server_connections,
+    setup_servers,
+)
+from src.daemon import reconnect_servers, refresh_servers
+from src.diff import cleanup_watched_parallel
+from src.ledger import log_ledger_metrics
+from src.limiter import log_limiter_metrics
+from src.outbox import drain_outbox
+from src.pipeline import Pipeline, Stage
+from src.scheduler import Scheduler
+from src.store import WatchedBuffer
+from src.sessions import start_session_poller
+from src.shard import (
+    filter_shard_users,
+    get_shard_env,
+    load_shard_leases,
+    log_shard_summary,
+    run_shards,
+)
+from src.topology import load_sync_plan
+from src.webhook import start_webhook_listener
+from src.websocket import start_websocket_listeners
 
 
-def configure_logger(log_file: str = "log.log", debug_level: str = "INFO") -> None:
+def configure_logger(
+    log_file: str = "log.log", debug_level: str = "INFO", mode: str = "w"
+) -> None:
     # Remove default logger to configure our own
     logger.remove()
 
@@ -38,244 +83,819 @@ def configure_logger(log_file: str = "log.log", debug_level: str = "INFO") -> No
         )
 
     # Add a sink for file logging and the console.
-    logger.add(log_file, level=debug_level, mode="w")
+    logger.add(log_file, level=debug_level, mode=mode)
     logger.add(sys.stdout, level=debug_level)
 
 
-def should_sync_server(
-    env,
+def gather_watched(
     server_1: Plex | Jellyfin | Emby,
     server_2: Plex | Jellyfin | Emby,
-) -> bool:
-    sync_from_plex_to_jellyfin = str_to_bool(
-        get_env_value(env, "SYNC_FROM_PLEX_TO_JELLYFIN", "True")
-    )
-    sync_from_plex_to_plex = str_to_bool(
-        get_env_value(env, "SYNC_FROM_PLEX_TO_PLEX", "True")
+    server_1_users: Any,
+    server_2_users: Any,
+    server_1_libraries: list[str],
+    server_2_libraries: list[str],
+    server_1_watched: dict[str, UserData] | None = None,
+    checkpoint: Checkpoint | None = None,
+    since: datetime | None = None,
+) -> tuple[dict[str, UserData], dict[str, UserData]]:
+    logger.info("Creating watched lists", 1)
+    if server_1_watched is None and checkpoint:
+        server_1_watched = checkpoint.get_watched(
+            server_1, server_1_users, server_1_libraries
+        )
+    server_1_watched = server_1.get_watched(
+        server_1_users, server_1_libraries, server_1_watched, checkpoint, since
     )
-    sync_from_plex_to_emby = str_to_bool(
-        get_env_value(env, "SYNC_FROM_PLEX_TO_EMBY", "True")
+    logger.info("Finished creating watched list server 1")
+
+    server_2_watched = server_2.get_watched(
+        server_2_users,
+        server_2_libraries,
+        checkpoint.get_watched(server_2, server_2_users, server_2_libraries)
+        if checkpoint
+        else None,
+        checkpoint,
+        since,
     )
+    logger.info("Finished creating watched list server 2")
 
-    sync_from_jelly_to_plex = str_to_bool(
-        get_env_value(env, "SYNC_FROM_JELLYFIN_TO_PLEX", "True")
-    )
-    sync_from_jelly_to_jellyfin = str_to_bool(
-        get_env_value(env, "SYNC_FROM_JELLYFIN_TO_JELLYFIN", "True")
-    )
-    sync_from_jelly_to_emby = str_to_bool(
-        get_env_value(env, "SYNC_FROM_JELLYFIN_TO_EMBY", "True")
-    )
+    logger.trace(f"Server 1 watched: {server_1_watched}")
+    logger.trace(f"Server 2 watched: {server_2_watched}")
+
+    return server_1_watched, server_2_watched
+
+
+def diff_watched(
+    env: dict[str, str | float | None],
+    config: SyncConfig,
+    server_1: Plex | Jellyfin | Emby,
+    server_2: Plex | Jellyfin | Emby,
+    server_1_watched: dict[str, UserData],
+    server_2_watched: dict[str, UserData],
+) -> tuple[dict[str, UserData], list[SyncAction], list[SyncAction]]:
+    """
+    Returns the watched list of server 1 with the changes from server 2 merged in
+    and the actions to write to server 2 and server 1. With more than one diff
+    process every user library is diffed in a process pool.
+    """
+
+    def cleanup(
+        watched_list_1: dict[str, UserData], watched_list_2: dict[str, UserData]
+    ) -> dict[str, UserData]:
+        if config.diff_processes > 1:
+            return cleanup_watched_parallel(
+                watched_list_1,
+                watched_list_2,
+                env,
+                config.user_mapping,
+                config.library_mapping,
+                config.diff_processes,
+            )
+
+        return cleanup_watched(
+            watched_list_1,
+            watched_list_2,
+            env,
+            config.user_mapping,
+            config.library_mapping,
+        )
 
-    sync_from_emby_to_plex = str_to_bool(
-        get_env_value(env, "SYNC_FROM_EMBY_TO_PLEX", "True")
+    logger.info("Cleaning Server 1 Watched", 1)
+    server_1_watched_filtered = cleanup(server_1_watched, server_2_watched)
+
+    logger.info("Cleaning Server 2 Watched", 1)
+    server_2_watched_filtered = cleanup(server_2_watched, server_1_watched)
+
+    logger.trace(
+        f"server 1 watched that needs to be synced to server 2:\n{server_1_watched_filtered}",
     )
-    sync_from_emby_to_jellyfin = str_to_bool(
-        get_env_value(env, "SYNC_FROM_EMBY_TO_JELLYFIN", "True")
+    logger.trace(
+        f"server 2 watched that needs to be synced to server 1:\n{server_2_watched_filtered}",
     )
-    sync_from_emby_to_emby = str_to_bool(
-        get_env_value(env, "SYNC_FROM_EMBY_TO_EMBY", "True")
+
+    # Add server_2_watched_filtered to server_1_watched that way the stored version isn't stale for the next server
+    if config.sync_matrix.allows(server_2, server_1) and not config.dryrun:
+        server_1_watched = merge_server_watched(
+            server_1_watched,
+            server_2_watched_filtered,
+            env,
+            config.user_mapping,
+            config.library_mapping,
+        )
+
+    return (
+        server_1_watched,
+        build_actions(server_1_watched_filtered),
+        build_actions(server_2_watched_filtered),
     )
 
-    if isinstance(server_1, Plex):
-        if isinstance(server_2, Jellyfin) and not sync_from_plex_to_jellyfin:
-            logger.info("Sync from plex -> jellyfin is disabled")
-            return False
 
-        if isinstance(server_2, Emby) and not sync_from_plex_to_emby:
-            logger.info("Sync from plex -> emby is disabled")
-            return False
+def write_watched(
+    config: SyncConfig,
+    server_1: Plex | Jellyfin | Emby,
+    server_2: Plex | Jellyfin | Emby,
+    server_1_actions: list[SyncAction],
+    server_2_actions: list[SyncAction],
+    pending_writes: PendingWrites | None = None,
+    checkpoint: Checkpoint | None = None,
+) -> int:
+    """
+    Write the actions in both directions, returns the number of changed items.
+    """
+    for source, target, actions in (
+        (server_2, server_1, server_2_actions),
+        (server_1, server_2, server_1_actions),
+    ):
+        if not config.sync_matrix.allows(source, target):
+            continue
+
+        logger.info(f"Syncing {source.info()} -> {target.info()}")
+        log_actions(actions, str(source.info()), str(target.info()))
+        if pending_writes is not None:
+            pending_writes.add(target, actions)
+        else:
+            write_actions(
+                target,
+                actions,
+                config.user_mapping,
+                config.library_mapping,
+                config.dryrun,
+                checkpoint,
+                source,
+            )
+            log_action_results(actions, str(target.info()))
+
+    # Actions the target already satisfied did not change anything
+    return sum(
+        1
+        for action in server_1_actions + server_2_actions
+        if action.outcome != "satisfied"
+    )
 
-        if isinstance(server_2, Plex) and not sync_from_plex_to_plex:
-            logger.info("Sync from plex -> plex is disabled")
-            return False
 
-    if isinstance(server_1, Jellyfin):
-        if isinstance(server_2, Plex) and not sync_from_jelly_to_plex:
-            logger.info("Sync from jellyfin -> plex is disabled")
-            return False
+def sync_watched(
+    env: dict[str, str | float | None],
+    config: SyncConfig,
+    server_1: Plex | Jellyfin | Emby,
+    server_2: Plex | Jellyfin | Emby,
+    server_1_users: Any,
+    server_2_users: Any,
+    server_1_libraries: list[str],
+    server_2_libraries: list[str],
+    server_1_watched: dict[str, UserData] | None = None,
+    pending_writes: PendingWrites | None = None,
+    checkpoint: Checkpoint | None = None,
+    since: datetime | None = None,
+) -> tuple[dict[str, UserData] | None, int]:
+    """
+    Gather, diff and write the watched state of the given users in both directions.
+    Returns the watched list of server 1 and the number of changed items. With
+    since only items played at or after it are synced.
+    """
+    server_1_watched, server_2_watched = gather_watched(
+        server_1,
+        server_2,
+        server_1_users,
+        server_2_users,
+        server_1_libraries,
+        server_2_libraries,
+        server_1_watched,
+        checkpoint,
+        since,
+    )
+    server_1_watched, server_1_actions, server_2_actions = diff_watched(
+        env, config, server_1, server_2, server_1_watched, server_2_watched
+    )
+    changes = write_watched(
+        config,
+        server_1,
+        server_2,
+        server_1_actions,
+        server_2_actions,
+        pending_writes,
+        checkpoint,
+    )
 
-        if isinstance(server_2, Jellyfin) and not sync_from_jelly_to_jellyfin:
-            logger.info("Sync from jellyfin -> jellyfin is disabled")
-            return False
+    return server_1_watched, changes
 
-        if isinstance(server_2, Emby) and not sync_from_jelly_to_emby:
-            logger.info("Sync from jellyfin -> emby is disabled")
-            return False
 
-    if isinstance(server_1, Emby):
-        if isinstance(server_2, Plex) and not sync_from_emby_to_plex:
-            logger.info("Sync from emby -> plex is disabled")
-            return False
+def sync_watched_store(
+    env: dict[str, str | float | None],
+    config: SyncConfig,
+    server_1: Plex | Jellyfin | Emby,
+    server_2: Plex | Jellyfin | Emby,
+    server_1_users: Any,
+    server_2_users: Any,
+    server_1_libraries: list[str],
+    server_2_libraries: list[str],
+    pending_writes: PendingWrites | None = None,
+    checkpoint: Checkpoint | None = None,
+    since: datetime | None = None,
+) -> int:
+    """
+    Sync the given users with the watched lists moved to a sqlite store once they
+    grow past the threshold of the watched store, users are gathered one at a time
+    and the cleanup runs against the store one user at a time. Small watched lists
+    are diffed in memory as usual. Returns the number of changed items.
+    """
+    threshold = (
+        0 if config.watched_store == "sqlite" else config.watched_store_threshold
+    )
+    buffer = WatchedBuffer(threshold, config.watched_store_dir)
+    try:
+        logger.info("Creating watched lists", 1)
+        for side, server, users, libraries in (
+            (1, server_1, server_1_users, server_1_libraries),
+            (2, server_2, server_2_users, server_2_libraries),
+        ):
+            for user in split_server_users(users):
+                buffer.add(
+                    side,
+                    server.get_watched(
+                        user,
+                        libraries,
+                        checkpoint.get_watched(server, user, libraries)
+                        if checkpoint
+                        else None,
+                        checkpoint,
+                        since,
+                    ),
+                )
+            logger.info(f"Finished creating watched list server {side}")
 
-        if isinstance(server_2, Jellyfin) and not sync_from_emby_to_jellyfin:
-            logger.info("Sync from emby -> jellyfin is disabled")
-            return False
+        if buffer.store is None:
+            _, server_1_actions, server_2_actions = diff_watched(
+                env, config, server_1, server_2, buffer.watched[1], buffer.watched[2]
+            )
+            return write_watched(
+                config,
+                server_1,
+                server_2,
+                server_1_actions,
+                server_2_actions,
+                pending_writes,
+                checkpoint,
+            )
 
-        if isinstance(server_2, Emby) and not sync_from_emby_to_emby:
-            logger.info("Sync from emby -> emby is disabled")
-            return False
+        changes = 0
+        for side, source, target in ((2, server_2, server_1), (1, server_1, server_2)):
+            if not config.sync_matrix.allows(source, target):
+                continue
 
-    return True
+            logger.info(f"Syncing {source.info()} -> {target.info()}")
+            for user_name, user_data in buffer.store.cleanup(
+                side, env, config.user_mapping, config.library_mapping
+            ):
+                actions = build_actions({user_name: user_data})
+                log_actions(actions, str(source.info()), str(target.info()))
+                if pending_writes is not None:
+                    pending_writes.add(target, actions)
+                else:
+                    write_actions(
+                        target,
+                        actions,
+                        config.user_mapping,
+                        config.library_mapping,
+                        config.dryrun,
+                        checkpoint,
+                        source,
+                    )
+                    log_action_results(actions, str(target.info()))
+                changes += sum(1 for action in actions if action.outcome != "satisfied")
 
+        return changes
+    finally:
+        buffer.close()
 
-def main_loop(env: dict[str, str | float | None]) -> None:
-    dryrun = str_to_bool(get_env_value(env, "DRYRUN", "False"))
-    logger.info(f"Dryrun: {dryrun}")
 
-    user_mapping_env = get_env_value(env, "USER_MAPPING", None)
-    user_mapping = None
-    if user_mapping_env:
-        user_mapping = json.loads(user_mapping_env.lower())
-    logger.info(f"User Mapping: {user_mapping}")
+def sync_users_pipeline(
+    env: dict[str, str | float | None],
+    config: SyncConfig,
+    server_1: Plex | Jellyfin | Emby,
+    server_2: Plex | Jellyfin | Emby,
+    server_1_users: Any,
+    server_2_users: Any,
+    server_1_libraries: list[str],
+    server_2_libraries: list[str],
+    pending_writes: PendingWrites | None = None,
+    checkpoint: Checkpoint | None = None,
+    since: datetime | None = None,
+    budget: RunBudget | None = None,
+) -> int:
+    """
+    Sync one user at a time, so only the watched data of a few users is held in
+    memory instead of the data of every user on both servers. Gathering, diffing
+    and writing run as overlapping stages, while one user is written the next
+    ones are already diffed and gathered. Once the budget runs low no new users
+    are gathered, the ones already gathered are still written.
+    """
+
+    def budget_users(pairs: list[tuple[Any, Any]]):
+        for index, users in enumerate(pairs):
+            if budget and budget.exhausted():
+                budget.defer_users(
+                    server_1, [get_user_names(user)[0] for user, _ in pairs[index:]]
+                )
+                budget.defer_users(
+                    server_2, [get_user_names(user)[0] for _, user in pairs[index:]]
+                )
+                return
+
+            yield users
+
+    def gather(users: tuple[Any, Any]) -> tuple[dict[str, UserData], ...]:
+        logger.info(f"Syncing user {get_user_names(users[0])[0]}")
+        return gather_watched(
+            server_1,
+            server_2,
+            users[0],
+            users[1],
+            server_1_libraries,
+            server_2_libraries,
+            None,
+            checkpoint,
+            since,
+        )
 
-    library_mapping_env = get_env_value(env, "LIBRARY_MAPPING", None)
-    library_mapping = None
-    if library_mapping_env:
-        library_mapping = json.loads(library_mapping_env)
-    logger.info(f"Library Mapping: {library_mapping}")
+    def diff(watched: tuple[dict[str, UserData], ...]) -> tuple[list[SyncAction], ...]:
+        # The merged watched list of server 1 is not kept in this mode
+        _, server_1_actions, server_2_actions = diff_watched(
+            env, config, server_1, server_2, *watched
+        )
+        return server_1_actions, server_2_actions
+
+    def write(actions: tuple[list[SyncAction], ...]) -> int:
+        server_1_actions, server_2_actions = actions
+        return write_watched(
+            config,
+            server_1,
+            server_2,
+            server_1_actions,
+            server_2_actions,
+            pending_writes,
+            checkpoint,
+        )
 
-    # Create (black/white)lists
-    logger.info("Creating (black/white)lists")
-    blacklist_library = parse_string_to_list(
-        get_env_value(env, "BLACKLIST_LIBRARY", None)
-    )
-    whitelist_library = parse_string_to_list(
-        get_env_value(env, "WHITELIST_LIBRARY", None)
-    )
-    blacklist_library_type = parse_string_to_list(
-        get_env_value(env, "BLACKLIST_LIBRARY_TYPE", None)
-    )
-    whitelist_library_type = parse_string_to_list(
-        get_env_value(env, "WHITELIST_LIBRARY_TYPE", None)
+    pipeline = Pipeline(
+        [
+            Stage("gather", gather, config.gather_workers),
+            Stage("diff", diff, config.diff_workers),
+            Stage("write", write, config.write_workers),
+        ],
+        config.pipeline_queue_size,
     )
-    blacklist_users = parse_string_to_list(get_env_value(env, "BLACKLIST_USERS", None))
-    whitelist_users = parse_string_to_list(get_env_value(env, "WHITELIST_USERS", None))
-
-    (
-        blacklist_library,
-        whitelist_library,
-        blacklist_library_type,
-        whitelist_library_type,
-        blacklist_users,
-        whitelist_users,
-    ) = setup_black_white_lists(
-        blacklist_library,
-        whitelist_library,
-        blacklist_library_type,
-        whitelist_library_type,
-        blacklist_users,
-        whitelist_users,
-        library_mapping,
-        user_mapping,
+    changes = sum(
+        pipeline.run(
+            budget_users(
+                pair_server_users(server_1_users, server_2_users, config.user_mapping)
+            )
+        )
     )
+    pipeline.log_occupancy()
 
-    # Create server connections
-    logger.info("Creating server connections")
-    servers = generate_server_connections(env)
+    return changes
 
-    for server_1 in servers:
-        # If server is the final server in the list, then we are done with the loop
-        if server_1 == servers[-1]:
-            break
 
-        # Store a copy of server_1_watched that way it can be used multiple times without having to regather everyones watch history every single time
+def sync_server_pair(
+    env: dict[str, str | float | None],
+    config: SyncConfig,
+    server_1: Plex | Jellyfin | Emby,
+    server_2: Plex | Jellyfin | Emby,
+    server_1_watched: dict[str, UserData] | None = None,
+    activity_state: dict[str, Any] | None = None,
+    full_sync: bool = True,
+    run_start: datetime | None = None,
+    pending_writes: PendingWrites | None = None,
+    checkpoint: Checkpoint | None = None,
+    budget: RunBudget | None = None,
+    shard: tuple[int, int] | None = None,
+) -> tuple[dict[str, UserData] | None, int]:
+    """
+    Sync a single pair of servers in both directions. Returns the watched list of
+    server 1 so it can be reused for the next pair and the number of items that
+    needed to be synced. With pending_writes the writes are collected there instead
+    of being written right away. With a checkpoint, libraries gathered or written
+    earlier in the run are reused. With a sync window only recent activity is synced
+    between full passes. With a shard, given as (shard, shards), only the users of
+    that shard are synced.
+    """
+    logger.info(f"Server 1: {type(server_1)}: {server_1.info()}")
+    logger.info(f"Server 2: {type(server_2)}: {server_2.info()}")
+
+    # Create users list
+    logger.info("Creating users list")
+    server_1_idle_users = None
+    server_2_idle_users = None
+    if activity_state is not None and config.skip_idle_users and not full_sync:
+        server_1_idle_users = get_idle_users(server_1, activity_state)
+        server_2_idle_users = get_idle_users(server_2, activity_state)
+
+    server_1_users, server_2_users = setup_users(
+        server_1,
+        server_2,
+        config.blacklist_users,
+        config.whitelist_users,
+        config.user_mapping,
+        server_1_idle_users,
+        server_2_idle_users,
+    )
+
+    if shard is not None:
+        server_1_users = filter_shard_users(server_1_users, *shard, config.user_mapping)
+        server_2_users = filter_shard_users(server_2_users, *shard, config.user_mapping)
+
+    if not server_1_users or not server_2_users:
+        logger.info("No active users found, skipping")
+        return server_1_watched, 0
+
+    # Recently active users first, so fresh changes are synced early in long runs
+    if config.prioritize_recent:
+        now = run_start or datetime.now(timezone.utc)
+        server_1_users = order_users_by_activity(server_1, server_1_users, now)
+        server_2_users = order_users_by_activity(server_2, server_2_users, now)
+    # Users the previous run ran out of time for go first
+    if budget:
+        server_1_users = budget.prioritize_users(server_1, server_1_users)
+        server_2_users = budget.prioritize_users(server_2, server_2_users)
+
+    server_1_libraries, server_2_libraries = setup_libraries(
+        server_1,
+        server_2,
+        config.blacklist_library,
+        config.blacklist_library_type,
+        config.whitelist_library,
+        config.whitelist_library_type,
+        config.library_mapping,
+    )
+    logger.info(f"Server 1 syncing libraries: {server_1_libraries}")
+    logger.info(f"Server 2 syncing libraries: {server_2_libraries}")
+
+    # Between full passes only recent activity is gathered and compared
+    since = None
+    if (
+        config.sync_window
+        and activity_state is not None
+        and not full_sync
+        and run_start is not None
+    ):
+        since = run_start - timedelta(seconds=config.sync_window)
+        logger.info(f"Syncing items played since {since.isoformat()}")
+
+    if config.sync_per_user:
+        changes = sync_users_pipeline(
+            env,
+            config,
+            server_1,
+            server_2,
+            server_1_users,
+            server_2_users,
+            server_1_libraries,
+            server_2_libraries,
+            pending_writes,
+            checkpoint,
+            since,
+            budget,
+        )
+        # Nothing is kept between pairs, server 1 is gathered again for the next one
+        server_1_watched = None
+    elif config.watched_store != "memory":
+        changes = sync_watched_store(
+            env,
+            config,
+            server_1,
+            server_2,
+            server_1_users,
+            server_2_users,
+            server_1_libraries,
+            server_2_libraries,
+            pending_writes,
+            checkpoint,
+            since,
+        )
         server_1_watched = None
+    else:
+        server_1_watched, changes = sync_watched(
+            env,
+            config,
+            server_1,
+            server_2,
+            server_1_users,
+            server_2_users,
+            server_1_libraries,
+            server_2_libraries,
+            server_1_watched,
+            pending_writes,
+            checkpoint,
+            since,
+        )
 
-        # Start server_2 at the next server in the list
-        for server_2 in servers[servers.index(server_1) + 1 :]:
-            # Check if server 1 and server 2 are going to be synced in either direction, skip if not
-            if not should_sync_server(
-                env, server_1, server_2
-            ) and not should_sync_server(env, server_2, server_1):
-                continue
+    if activity_state is not None and run_start is not None:
+        # Deferred users were not synced and must not be skipped as idle next run
+        for server, users in ((server_1, server_1_users), (server_2, server_2_users)):
+            record_user_sync(
+                activity_state,
+                server,
+                [
+                    user_name
+                    for user_name in get_user_names(users)
+                    if not budget or not budget.is_deferred(server, user_name)
+                ],
+                run_start,
+            )
 
-            logger.info(f"Server 1: {type(server_1)}: {server_1.info()}")
-            logger.info(f"Server 2: {type(server_2)}: {server_2.info()}")
+    return server_1_watched, changes
+
+
+def main_loop(
+    env: dict[str, str | float | None],
+    config: SyncConfig | None = None,
+    servers: list[Plex | Jellyfin | Emby] | None = None,
+    shard: tuple[int, int] | None = None,
+) -> int:
+    """
+    Sync every server pair once, returns the number of changed items. With a
+    shard only its users are synced and the outbox is left to the parent.
+    """
+    if config is None:
+        config = load_sync_config(env)
+
+    # Load the last sync time of every user so idle users can be skipped
+    run_start = datetime.now(timezone.utc)
+    activity_state, full_sync = setup_activity(env, run_start)
+    budget = load_run_budget(env)
+
+    if servers is None:
+        # Create server connections
+        logger.info("Creating server connections")
+        servers = generate_server_connections(env)
+
+    # Retry the writes that failed in previous runs before diffing again
+    if shard is None:
+        drain_outbox(servers, config.dryrun)
+
+    plan = load_sync_plan(env, servers, config.sync_matrix)
+    plan.log()
+
+    # Writes of all pairs are collected first so every target item is written once.
+    # Syncing per user writes right away so nothing is held for the whole run, the
+    # pairs are synced one after another so a target item written by several pairs
+    # is written by each of them, the last pair wins
+    pending_writes = (
+        None
+        if config.sync_per_user
+        else PendingWrites(env, config.user_mapping, config.library_mapping)
+    )
+    server_1_watched = None
+    previous_server_1 = None
+    changes = 0
+    checkpoint = load_checkpoint(env)
+    pairs = budget.prioritize_pairs(plan.pairs) if budget else plan.pairs
+    try:
+        for server_1, server_2 in pairs:
+            # Running low on time, leave the remaining pairs to the next run
+            if budget and budget.exhausted():
+                budget.defer_pair(server_1, server_2)
+                continue
 
-            # Create users list
-            logger.info("Creating users list")
-            server_1_users, server_2_users = setup_users(
-                server_1, server_2, blacklist_users, whitelist_users, user_mapping
-            )
+            if server_1 is not previous_server_1:
+                server_1_watched = None
+                previous_server_1 = server_1
 
-            server_1_libraries, server_2_libraries = setup_libraries(
+            server_1_watched, pair_changes = sync_server_pair(
+                env,
+                config,
                 server_1,
                 server_2,
-                blacklist_library,
-                blacklist_library_type,
-                whitelist_library,
-                whitelist_library_type,
-                library_mapping,
+                server_1_watched,
+                activity_state,
+                full_sync,
+                run_start,
+                pending_writes,
+                checkpoint,
+                budget,
+                shard,
             )
-            logger.info(f"Server 1 syncing libraries: {server_1_libraries}")
-            logger.info(f"Server 2 syncing libraries: {server_2_libraries}")
+            changes += pair_changes
+
+        if pending_writes:
+            pending_writes.flush(config.dryrun, checkpoint)
+    except Exception:
+        # Keep the checkpoint so the next run resumes from it
+        if checkpoint:
+            checkpoint.close()
+        raise
+
+    if checkpoint:
+        checkpoint.complete()
+    if budget:
+        budget.report()
+        budget.save()
+    log_ledger_metrics(servers)
+    log_limiter_metrics(servers)
+    # A full pass that deferred work is not complete, the next run is full again
+    save_activity(
+        env,
+        activity_state,
+        full_sync and not (budget and budget.has_deferred()),
+        run_start,
+    )
 
-            logger.info("Creating watched lists", 1)
-            server_1_watched = server_1.get_watched(
-                server_1_users, server_1_libraries, server_1_watched
-            )
-            logger.info("Finished creating watched list server 1")
+    return changes
+
+
+def sync_shard(
+    env: dict[str, str | float | None],
+    config: SyncConfig,
+    servers: list[Plex | Jellyfin | Emby],
+    shard: int,
+    shards: int,
+) -> dict[str, Any]:
+    """
+    Sync the users of one shard, with its own activity, checkpoint and budget
+    files. Returns the summary of the shard, failures are reported in it instead
+    of raised so the other shards keep running.
+    """
+    leases = load_shard_leases(env)
+    if leases and not leases.acquire(shard):
+        logger.info(f"Shard: {shard} is synced by another worker, skipping")
+        return {"shard": shard, "status": "skipped", "changes": 0, "elapsed": 0}
+
+    start = perf_counter()
+    try:
+        logger.info(f"Shard: Syncing shard {shard} of {shards}")
+        changes = main_loop(get_shard_env(env, shard), config, servers, (shard, shards))
+    except Exception as error:
+        logger.error(traceback.format_exc())
+        if leases:
+            leases.release(shard, False)
+        return {
+            "shard": shard,
+            "status": "failed",
+            "changes": 0,
+            "elapsed": perf_counter() - start,
+            "error": str(error),
+        }
+
+    if leases:
+        leases.release(shard, True)
+    return {
+        "shard": shard,
+        "status": "synced",
+        "changes": changes,
+        "elapsed": perf_counter() - start,
+    }
+
+
+def _sync_shard_process(
+    task: tuple[
+        dict[str, str | float | None],
+        int,
+        int,
+        list[tuple[str, Callable[[], Plex | Jellyfin | Emby]]],
+    ],
+) -> dict[str, Any]:
+    env, shard, shards, connections = task
+    debug_level = get_env_value(env, "DEBUG_LEVEL", "INFO").upper()
+    # The parent already rotated the log, the workers append to it
+    configure_logger(get_env_value(env, "LOG_FILE", "log.log"), debug_level, "a")
+
+    try:
+        config = load_sync_config(env)
+        servers = setup_servers(
+            env, connections, float(get_env_value(env, "CONNECTION_TIMEOUT", 60))
+        )
+    except Exception as error:
+        logger.error(traceback.format_exc())
+        return {
+            "shard": shard,
+            "status": "failed",
+            "changes": 0,
+            "elapsed": 0,
+            "error": str(error),
+        }
+
+    return sync_shard(env, config, servers, shard, shards)
+
+
+def sync_shards(
+    env: dict[str, str | float | None],
+    config: SyncConfig | None = None,
+    servers: list[Plex | Jellyfin | Emby] | None = None,
+) -> None:
+    """
+    Split the users into SYNC_SHARDS shards by a stable hash of their name and
+    sync every shard in its own worker process. The parent connects to the
+    servers and drains the outbox once, the workers connect to the addresses and
+    tokens the parent resolved with their own sessions, ledger and outbox.
+    """
+    if config is None:
+        config = load_sync_config(env)
+
+    if servers is None:
+        logger.info("Creating server connections")
+        servers = generate_server_connections(env)
+
+    drain_outbox(servers, config.dryrun)
+
+    shards = int(get_env_value(env, "SYNC_SHARDS", "1"))
+    workers = int(get_env_value(env, "SYNC_SHARD_WORKERS", None) or shards)
+    start = perf_counter()
+    if workers <= 1:
+        results = [
+            sync_shard(env, config, servers, shard, shards) for shard in range(shards)
+        ]
+    else:
+        connections = get_server_connections(servers)
+        results = run_shards(
+            _sync_shard_process,
+            [(env, shard, shards, connections) for shard in range(shards)],
+            workers,
+        )
+    log_shard_summary(results, perf_counter() - start)
+
+
+def scheduler_loop(env: dict[str, str | float | None], sleep_duration: float) -> None:
+    """
+    Run every server pair on its own cadence instead of syncing everything every
+    SLEEP_DURATION seconds. Pairs with changes are synced more often, idle pairs
+    less often and failing pairs are retried with a jittered exponential backoff.
+    """
+    config = load_sync_config(env)
+    metadata_cache_ttl = float(get_env_value(env, "METADATA_CACHE_TTL", "0"))
+    scheduler = Scheduler(
+        interval=sleep_duration,
+        min_interval=float(get_env_value(env, "SCHEDULER_MIN_INTERVAL", "300")),
+        max_interval=float(
+            get_env_value(env, "SCHEDULER_MAX_INTERVAL", sleep_duration * 4)
+        ),
+        retry_interval=float(get_env_value(env, "SCHEDULER_RETRY_INTERVAL", "60")),
+    )
+    servers: list[Plex | Jellyfin | Emby] | None = None
+    times: list[float] = []
 
-            server_2_watched = server_2.get_watched(server_2_users, server_2_libraries)
-            logger.info("Finished creating watched list server 2")
+    while True:
+        try:
+            servers = refresh_servers(env, servers, metadata_cache_ttl)
+            plan = load_sync_plan(env, servers, config.sync_matrix)
+            pairs = {
+                get_pair_key(server_1, server_2): (server_1, server_2)
+                for server_1, server_2 in plan.pairs
+            }
+            if set(pairs) != set(scheduler.pairs):
+                plan.log()
+            scheduler.update(list(pairs.keys()))
+            drain_outbox(servers, config.dryrun)
+        except Exception as error:
+            logger.error(f"Failed to set up servers, Error: {error}")
+            logger.error(traceback.format_exc())
+            servers = reconnect_servers(servers)
+            sleep(scheduler.retry_interval)
+            continue
 
-            logger.trace(f"Server 1 watched: {server_1_watched}")
-            logger.trace(f"Server 2 watched: {server_2_watched}")
+        key, wait = scheduler.next_due()
+        if key is None:
+            logger.info(f"No servers to sync, retrying in {sleep_duration}")
+            sleep(sleep_duration)
+            continue
 
-            logger.info("Cleaning Server 1 Watched", 1)
-            server_1_watched_filtered = cleanup_watched(
-                server_1_watched,
-                server_2_watched,
-                env,
-                user_mapping,
-                library_mapping,
-            )
+        if wait > 0:
+            logger.info(f"Next sync {key} in {wait:.0f}")
+            sleep(wait)
 
-            logger.info("Cleaning Server 2 Watched", 1)
-            server_2_watched_filtered = cleanup_watched(
-                server_2_watched,
-                server_1_watched,
+        server_1, server_2 = pairs[key]
+        run_start = datetime.now(timezone.utc)
+        start = perf_counter()
+        try:
+            activity_state, full_sync = setup_activity(env, run_start, key)
+            _, changes = sync_server_pair(
                 env,
-                user_mapping,
-                library_mapping,
-            )
-
-            logger.debug(
-                f"server 1 watched that needs to be synced to server 2:\n{server_1_watched_filtered}",
-            )
-            logger.debug(
-                f"server 2 watched that needs to be synced to server 1:\n{server_2_watched_filtered}",
+                config,
+                server_1,
+                server_2,
+                None,
+                activity_state,
+                full_sync,
+                run_start,
             )
-
-            if should_sync_server(env, server_2, server_1):
-                logger.info(f"Syncing {server_2.info()} -> {server_1.info()}")
-
-                # Add server_2_watched_filtered to server_1_watched that way the stored version isn't stale for the next server
-                if not dryrun:
-                    server_1_watched = merge_server_watched(
-                        server_1_watched,
-                        server_2_watched_filtered,
-                        env,
-                        user_mapping,
-                        library_mapping,
+            save_activity(env, activity_state, full_sync, run_start, key)
+        except Exception as error:
+            logger.error(f"Failed to sync {key}, Error: {error}")
+            logger.error(traceback.format_exc())
+            scheduler.record_failure(key)
+            for server in (server_1, server_2):
+                try:
+                    server.reconnect()
+                except Exception as e:
+                    logger.error(
+                        f"{server.server_type}: Failed to reconnect, Error: {e}"
                     )
+            continue
 
-                server_1.update_watched(
-                    server_2_watched_filtered,
-                    user_mapping,
-                    library_mapping,
-                    dryrun,
-                )
-
-            if should_sync_server(env, server_1, server_2):
-                logger.info(f"Syncing {server_1.info()} -> {server_2.info()}")
-                server_2.update_watched(
-                    server_1_watched_filtered,
-                    user_mapping,
-                    library_mapping,
-                    dryrun,
-                )
+        times.append(perf_counter() - start)
+        env["AVERAGE_TIME"] = sum(times) / len(times)
+        scheduler.record_success(key, changes)
+        log_ledger_metrics([server_1, server_2])
+        log_limiter_metrics([server_1, server_2])
 
 
 @logger.catch
@@ -291,13 +911,66 @@ def main() -> None:
     if debug_level:
         debug_level = debug_level.upper()
 
+    webhook_enabled = str_to_bool(get_env_value(env, "WEBHOOK_ENABLED", "False"))
+    websocket_enabled = str_to_bool(get_env_value(env, "WEBSOCKET_ENABLED", "False"))
+    session_sync_enabled = str_to_bool(
+        get_env_value(env, "SESSION_SYNC_ENABLED", "False")
+    )
+    listeners_enabled = webhook_enabled or websocket_enabled or session_sync_enabled
+    if listeners_enabled and not run_only_once:
+        configure_logger(log_file, debug_level)
+        # The event processors share the sync matrix compiled by the config
+        event_config = load_sync_config(env)
+        should_sync = event_config.sync_matrix.allows
+
+        # Sync single items as soon as the media servers report them, next to the regular sync
+        if webhook_enabled:
+            start_webhook_listener(env, event_config, should_sync)
+
+        # Jellyfin and emby can also push user data changes over their websocket
+        if websocket_enabled:
+            start_websocket_listeners(env, event_config, should_sync)
+
+        # Mirror the position of currently playing items between the regular syncs
+        if session_sync_enabled:
+            start_session_poller(env, event_config, should_sync)
+
+    # The adaptive scheduler replaces the fixed loop, fixed keeps the original behavior
+    scheduler = get_env_value(env, "SCHEDULER", "fixed").lower()
+    if scheduler not in ["fixed", "adaptive"]:
+        raise Exception(
+            f"Invalid SCHEDULER {scheduler}, please choose between fixed, adaptive"
+        )
+
+    if scheduler == "adaptive" and not run_only_once:
+        configure_logger(log_file, debug_level)
+        try:
+            scheduler_loop(env, sleep_duration)
+        except KeyboardInterrupt:
+            logger.info("Exiting")
+            os._exit(0)
+
+    # In daemon mode the config and server connections are kept between loops
+    daemon_mode = str_to_bool(get_env_value(env, "DAEMON_MODE", "False"))
+    metadata_cache_ttl = float(get_env_value(env, "METADATA_CACHE_TTL", "0"))
+    config: SyncConfig | None = None
+    servers: list[Plex | Jellyfin | Emby] | None = None
+
     times: list[float] = []
     while True:
         try:
             start = perf_counter()
             # Reconfigure the logger on each loop so the logs are rotated on each run
             configure_logger(log_file, debug_level)
-            main_loop(env)
+            if daemon_mode:
+                if config is None:
+                    config = load_sync_config(env)
+                servers = refresh_servers(env, servers, metadata_cache_ttl)
+
+            if int(get_env_value(env, "SYNC_SHARDS", "1")) > 1:
+                sync_shards(env, config, servers)
+            else:
+                main_loop(env, config, servers)
             end = perf_counter()
             times.append(end - start)
 
@@ -324,6 +997,9 @@ def main() -> None:
             if run_only_once:
                 break
 
+            if daemon_mode:
+                servers = reconnect_servers(servers)
+
             logger.info(f"Retrying in {sleep_duration}")
             sleep(sleep_duration)
 
@@ -0,0 +1,178 @@
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Any
+from loguru import logger
+
+from src.actions import SyncAction
+from src.activity import get_server_key
+from src.functions import get_env_value, str_to_bool
+
+
+class WriteOutbox:
+    """
+    SQLite queue of writes that failed after their item was matched on the target.
+    They are retried straight against the item with an exponential backoff, so a
+    failed write does not have to wait for the next full diff to be generated again.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        retry_interval: float = 60,
+        max_retry_interval: float = 3600,
+        max_attempts: int = 10,
+    ) -> None:
+        self.path: str = path
+        self.retry_interval: float = retry_interval
+        self.max_retry_interval: float = max_retry_interval
+        self.max_attempts: int = max_attempts
+        # Writers run from the sync loop, the webhook and the session threads
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "server TEXT, user TEXT, item TEXT, action TEXT, attempts INTEGER, "
+            "next_attempt REAL, error TEXT, PRIMARY KEY (server, user, item))"
+        )
+        self.connection.commit()
+
+    def add(
+        self,
+        server: Any,
+        user: str,
+        action: SyncAction,
+        error: str,
+        now: float | None = None,
+    ) -> None:
+        """
+        Queue a failed write, or push back the next attempt of a queued one.
+        A newer action for the same item replaces the queued one.
+        """
+        if action.target_id is None:
+            return
+
+        now = time() if now is None else now
+        key = (get_server_key(server), user.lower(), action.target_id)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT attempts FROM outbox WHERE server = ? AND user = ? AND item = ?",
+                key,
+            ).fetchone()
+            attempts = row[0] + 1 if row else 1
+            if attempts >= self.max_attempts:
+                logger.error(
+                    f"Outbox: Giving up on {action.identifiers.title} for {user} on {server.info()} after {self.max_attempts} attempts, Error: {error}"
+                )
+                self.connection.execute(
+                    "DELETE FROM outbox WHERE server = ? AND user = ? AND item = ?", key
+                )
+                self.connection.commit()
+                return
+
+            delay = min(
+                self.retry_interval * 2 ** (attempts - 1), self.max_retry_interval
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, action.model_dump_json(), attempts, now + delay, error),
+            )
+            self.connection.commit()
+            logger.info(
+                f"Outbox: Retrying {action.identifiers.title} for {user} on {server.info()} in {delay:.0f} seconds, attempt {attempts}"
+            )
+
+    def remove(self, server: Any, user: str, action: SyncAction) -> None:
+        if action.target_id is None:
+            return
+
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM outbox WHERE server = ? AND user = ? AND item = ?",
+                (get_server_key(server), user.lower(), action.target_id),
+            )
+            self.connection.commit()
+
+    def due(
+        self, server: Any, now: float | None = None
+    ) -> list[tuple[str, SyncAction]]:
+        now = time() if now is None else now
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT user, action FROM outbox WHERE server = ? AND next_attempt <= ?",
+                (get_server_key(server), now),
+            ).fetchall()
+
+        return [(user, SyncAction.model_validate_json(action)) for user, action in rows]
+
+    def size(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def drain(self, servers: list[Any], now: float | None = None) -> int:
+        """
+        Retry the writes that are due on every server, returns how many succeeded.
+        Writes whose item already has their state or a newer one are dropped.
+        """
+        written = 0
+        for server in servers:
+            for user, action in self.due(server, now):
+                try:
+                    changed = server.retry_write(user, action)
+                except Exception as e:
+                    logger.error(
+                        f"Outbox: Failed to write {action.identifiers.title} for {user} on {server.info()}, Error: {e}"
+                    )
+                    self.add(server, user, action, str(e), now)
+                    continue
+
+                # Replaying it would regress the item or bump its viewed date
+                if not changed:
+                    logger.info(
+                        f"Outbox: Dropping {action.identifiers.title} for {user} on {server.info()}, the item already has this or a newer state"
+                    )
+                    self.remove(server, user, action)
+                    continue
+
+                logger.success(
+                    f"Outbox: {action.identifiers.title} as {action.action.replace('_', ' ')} for {user} on {server.info()}"
+                )
+                server.record_write(user, action)
+                written += 1
+
+        if written:
+            logger.info(f"Outbox: {written} writes retried, {self.size()} remaining")
+
+        return written
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def load_write_outbox(env) -> WriteOutbox | None:
+    if not str_to_bool(get_env_value(env, "WRITE_OUTBOX", "False")):
+        return None
+
+    return WriteOutbox(
+        get_env_value(env, "WRITE_OUTBOX_FILE", "outbox.db"),
+        retry_interval=float(get_env_value(env, "WRITE_OUTBOX_RETRY_INTERVAL", "60")),
+        max_retry_interval=float(
+            get_env_value(env, "WRITE_OUTBOX_MAX_RETRY_INTERVAL", "3600")
+        ),
+        max_attempts=int(get_env_value(env, "WRITE_OUTBOX_MAX_ATTEMPTS", "10")),
+    )
+
+
+def drain_outbox(servers: list[Any], dryrun: bool) -> None:
+    # Nothing is written in dryrun, so nothing can have failed either
+    if dryrun:
+        return
+
+    outboxes: list[WriteOutbox] = []
+    for server in servers:
+        if server.outbox and all(server.outbox is not other for other in outboxes):
+            outboxes.append(server.outbox)
+
+    for outbox in outboxes:
+        outbox.drain(servers)
@@ -0,0 +1,177 @@
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Iterable
+from loguru import logger
+
+# Marks the end of the items for the workers of a stage
+_Done = object()
+
+
+class Stage:
+    """
+    Step of a pipeline, run by its own workers that take items from the queue in
+    front of it and put their results into the queue of the next stage.
+    """
+
+    def __init__(
+        self, name: str, function: Callable[[Any], Any], workers: int = 1
+    ) -> None:
+        self.name: str = name
+        self.function: Callable[[Any], Any] = function
+        self.workers: int = max(1, workers)
+        self.busy: int = 0
+        self.processed: int = 0
+        self.busy_time: float = 0
+        self.peak_queue: int = 0
+        self.running: int = 0
+
+
+class Pipeline:
+    """
+    Runs items through stages connected by bounded queues, so every stage works on
+    a different item at the same time and the run takes about as long as its
+    slowest stage instead of the sum of all stages. The results of the last stage
+    are returned in the order they finished.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 2) -> None:
+        self.stages: list[Stage] = stages
+        self.queues: list[Queue] = [Queue(maxsize=max(1, queue_size)) for _ in stages]
+        self.lock = Lock()
+        self.stop = Event()
+        self.error: Exception | None = None
+        self.results: list[Any] = []
+        self.started: float = 0
+        self.elapsed: float = 0
+
+    def put(self, index: int, item: Any) -> bool:
+        # Never block forever, a failed stage would stop taking items
+        while not self.stop.is_set():
+            try:
+                self.queues[index].put(item, timeout=0.1)
+            except Full:
+                continue
+
+            with self.lock:
+                stage = self.stages[index]
+                stage.peak_queue = max(stage.peak_queue, self.queues[index].qsize())
+            return True
+
+        return False
+
+    def get(self, index: int) -> tuple[bool, Any]:
+        while not self.stop.is_set():
+            try:
+                return True, self.queues[index].get(timeout=0.1)
+            except Empty:
+                continue
+
+        return False, None
+
+    def finish_worker(self, index: int) -> None:
+        with self.lock:
+            stage = self.stages[index]
+            stage.running -= 1
+            last = stage.running == 0
+
+        # The last worker of a stage tells every worker of the next one to stop
+        if last and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self.put(index + 1, _Done)
+
+    def worker(self, index: int) -> None:
+        stage = self.stages[index]
+        try:
+            while True:
+                found, item = self.get(index)
+                if not found or item is _Done:
+                    break
+
+                with self.lock:
+                    stage.busy += 1
+                start = perf_counter()
+                try:
+                    result = stage.function(item)
+                finally:
+                    with self.lock:
+                        stage.busy -= 1
+                        stage.busy_time += perf_counter() - start
+
+                with self.lock:
+                    stage.processed += 1
+
+                if index + 1 < len(self.stages):
+                    if not self.put(index + 1, result):
+                        break
+                else:
+                    with self.lock:
+                        self.results.append(result)
+        except Exception as e:
+            logger.error(f"Pipeline: {stage.name} failed, Error: {e}")
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+            self.stop.set()
+        finally:
+            self.finish_worker(index)
+
+    def feed(self, items: Iterable[Any]) -> None:
+        for item in items:
+            if not self.put(0, item):
+                return
+
+        for _ in range(self.stages[0].workers):
+            self.put(0, _Done)
+
+    def run(self, items: Iterable[Any]) -> list[Any]:
+        self.started = perf_counter()
+        threads: list[Thread] = []
+        for index, stage in enumerate(self.stages):
+            stage.running = stage.workers
+            for number in range(stage.workers):
+                thread = Thread(
+                    target=self.worker,
+                    args=(index,),
+                    name=f"pipeline-{stage.name}-{number}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        self.feed(items)
+        for thread in threads:
+            thread.join()
+        self.elapsed = perf_counter() - self.started
+
+        if self.error is not None:
+            raise self.error
+
+        return self.results
+
+    def occupancy(self) -> dict[str, dict[str, float]]:
+        """
+        Current and overall load of every stage, utilization is the share of the
+        run its workers spent working instead of waiting on the queues.
+        """
+        elapsed = (
+            self.elapsed if self.elapsed else perf_counter() - self.started
+        ) or 1e-9
+        with self.lock:
+            return {
+                stage.name: {
+                    "workers": stage.workers,
+                    "busy": stage.busy,
+                    "queued": self.queues[index].qsize(),
+                    "peak_queue": stage.peak_queue,
+                    "processed": stage.processed,
+                    "utilization": stage.busy_time / (elapsed * stage.workers),
+                }
+                for index, stage in enumerate(self.stages)
+            }
+
+    def log_occupancy(self) -> None:
+        for name, stats in self.occupancy().items():
+            logger.info(
+                f"Pipeline: {name} processed {stats['processed']} with {stats['workers']} workers, {stats['utilization']:.0%} busy, peak queue {stats['peak_queue']}"
+            )
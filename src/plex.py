@@ -1,4 +1,6 @@
 from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic
 import requests
 from loguru import logger
 
@@ -12,6 +14,7 @@ from plexapi.server import PlexServer
 from plexapi.myplex import MyPlexAccount, MyPlexUser
 from plexapi.library import MovieSection, ShowSection
 
+from src.cache import MetadataCache
 from src.functions import (
     filename_from_any_path,
     search_mapping,
@@ -19,6 +22,17 @@ from src.functions import (
     str_to_bool,
     get_env_value,
 )
+from src.actions import (
+    SyncAction,
+    group_actions,
+    group_series_actions,
+    is_satisfied,
+    is_superseded,
+)
+from src.checkpoint import Checkpoint
+from src.ledger import WriteLedger
+from src.limiter import AdaptiveLimiter, limit_session, load_limiter
+from src.outbox import WriteOutbox
 from src.watched import (
     LibraryData,
     MediaIdentifiers,
@@ -27,6 +41,7 @@ from src.watched import (
     Series,
     UserData,
     check_same_identifiers,
+    filter_watched_since,
 )
 
 
@@ -93,20 +108,24 @@ def extract_identifiers_from_item(
     )
 
 
+def get_viewed_date(item: Movie | Episode) -> datetime | None:
+    last_viewed_at = item.lastViewedAt
+    if not last_viewed_at:
+        return None
+
+    # PlexAPI returns naive datetime in local system timezone
+    # Get the local timezone and convert to UTC for consistent comparison
+    local_tz = datetime.now().astimezone().tzinfo
+    return last_viewed_at.replace(tzinfo=local_tz).astimezone(timezone.utc)
+
+
 def get_mediaitem(
     item: Movie | Episode,
     completed: bool,
     generate_guids: bool = True,
     generate_locations: bool = True,
 ) -> MediaItem:
-    last_viewed_at = item.lastViewedAt
-    viewed_date = datetime.today()
-
-    if last_viewed_at:
-        # PlexAPI returns naive datetime in local system timezone
-        # Get the local timezone and convert to UTC for consistent comparison
-        local_tz = datetime.now().astimezone().tzinfo
-        viewed_date = last_viewed_at.replace(tzinfo=local_tz).astimezone(timezone.utc)
+    viewed_date = get_viewed_date(item) or datetime.today()
 
     # Plex does not remove completion status if a user has watched it before but then rewatches but does not finish.
     # So if the item is marked as complete but the view status is not less than 60 seconds, we will consider it as not completed.
@@ -145,21 +164,62 @@ class Plex:
             session = requests.Session()
             # By pass ssl hostname check https://github.com/pkkid/python-plexapi/issues/143#issuecomment-775485186
             session.mount("https://", HostNameIgnoringAdapter())
+        # Adapts the number of requests in flight to how the server copes
+        self.limiter: AdaptiveLimiter | None = load_limiter(
+            self.env, f"Plex {base_url or server_name}"
+        )
+        if self.limiter:
+            session = limit_session(session or requests.Session(), self.limiter)
         self.session = session
-        self.plex: PlexServer = self.login(
-            base_url, token, user_name, password, server_name
+        self.cache: MetadataCache = MetadataCache(self.server_type)
+        # Ledger of the states written to this server, shared by all servers
+        self.ledger: WriteLedger | None = None
+        # Failed writes that are retried on their own, shared by all servers
+        self.outbox: WriteOutbox | None = None
+        # Position in the configured connections, set once connected
+        self.connection_index: int | None = None
+        # Keep the credentials around so the server can be reconnected in daemon mode
+        self.credentials: tuple[str | None, ...] = (
+            base_url,
+            token,
+            user_name,
+            password,
+            server_name,
         )
+        self.plex: PlexServer = self.login(*self.credentials)
 
         self.base_url: str = self.plex._baseurl
+        self.server_id: str = self.plex.machineIdentifier
 
         self.admin_user: MyPlexAccount = self.plex.myPlexAccount()
-        self.users: list[MyPlexUser | MyPlexAccount] = self.get_users()
+        self.users: list[MyPlexUser | MyPlexAccount] = self.cache.get(
+            "users", self.get_users
+        )
         self.generate_guids: bool = str_to_bool(
             get_env_value(self.env, "GENERATE_GUIDS", "True")
         )
         self.generate_locations: bool = str_to_bool(
             get_env_value(self.env, "GENERATE_LOCATIONS", "True")
         )
+        # Incrementally update the watched state from the server wide watch history
+        self.history_gather: bool = str_to_bool(
+            get_env_value(self.env, "PLEX_HISTORY_GATHER", "False")
+        )
+        self.history_max_entries: int = int(
+            get_env_value(self.env, "PLEX_HISTORY_MAX_ENTRIES", "10000")
+        )
+        self.history_full_interval: float = float(
+            get_env_value(self.env, "FULL_SYNC_INTERVAL", "86400")
+        )
+        self.history_watched: dict[str, UserData] = {}
+        # Gather workers of the per user pipeline share the history
+        self.history_lock = Lock()
+        # Items this tool wrote per user title, partial progress and unwatching
+        # never show up in the history so they are fetched again before reuse
+        self.history_written: dict[str, set[str]] = {}
+        self.history_watermark: datetime | None = None
+        self.history_full_time: float | None = None
+        self.history_updated: bool = False
 
     def login(
         self,
@@ -188,22 +248,145 @@ class Plex:
                 logger.error(f"Plex: Failed to login, Error: {e}")
             raise Exception(e)
 
+    def refresh(self) -> None:
+        # Pick up added or removed users once the cached user list has expired
+        self.users = self.cache.get("users", self.get_users)
+        self.history_updated = False
+
+    def reconnect(self) -> None:
+        logger.info(f"Plex: Reconnecting to {self.base_url}")
+        self.cache.clear()
+        self.plex = self.login(*self.credentials)
+        self.base_url = self.plex._baseurl
+        self.server_id = self.plex.machineIdentifier
+        self.admin_user = self.plex.myPlexAccount()
+        self.users = self.cache.get("users", self.get_users)
+        self.history_watched = {}
+        self.history_written = {}
+        self.history_watermark = None
+        self.history_updated = False
+
     def info(self) -> str:
         return f"Plex {self.plex.friendlyName}: {self.plex.version}"
 
     def get_users(self) -> list[MyPlexUser | MyPlexAccount]:
         try:
-            users: list[MyPlexUser | MyPlexAccount] = self.plex.myPlexAccount().users()
+            users: list[MyPlexUser | MyPlexAccount] = self.admin_user.users()
 
             # append self to users
-            users.append(self.plex.myPlexAccount())
+            users.append(self.admin_user)
 
             return users
         except Exception as e:
             logger.error(f"Plex: Failed to get users, Error: {e}")
             raise Exception(e)
 
+    def get_account_names(self) -> dict[int, str]:
+        account_names: dict[int, str] = {}
+        for user in self.users:
+            user_name = user.username.lower() if user.username else user.title.lower()
+            # The admin account is always accountID 1 on the local server
+            account_names[1 if self.admin_user == user else user.id] = user_name
+
+        return account_names
+
+    def get_users_activity(
+        self, since: datetime | None = None
+    ) -> dict[str, datetime | None]:
+        # Plex only exposes finished views through its history, users without any
+        # are checked for items they are in the middle of
+        if since is None:
+            return {}
+
+        try:
+            account_names = self.get_account_names()
+
+            # Users without history since the last sync get the epoch as last activity
+            no_activity = datetime.fromtimestamp(0, timezone.utc)
+            activity: dict[str, datetime | None] = {
+                user_name: no_activity for user_name in account_names.values()
+            }
+
+            local_tz = datetime.now().astimezone().tzinfo
+            for entry in self.plex.history(mindate=since):
+                user_name = account_names.get(entry.accountID)
+                if not user_name:
+                    continue
+
+                if not entry.viewedAt:
+                    activity[user_name] = None
+                    continue
+
+                viewed_at = entry.viewedAt.replace(tzinfo=local_tz).astimezone(
+                    timezone.utc
+                )
+                last_activity = activity[user_name]
+                if last_activity is not None and viewed_at > last_activity:
+                    activity[user_name] = viewed_at
+
+            for user in self.users:
+                user_name = (
+                    user.username.lower() if user.username else user.title.lower()
+                )
+                if activity.get(user_name) == no_activity:
+                    activity[user_name] = self.get_progress_activity(user)
+
+            return activity
+        except Exception as e:
+            logger.error(f"Plex: Failed to get users activity, Error: {e}")
+            return {}
+
+    def get_progress_activity(
+        self, user: MyPlexUser | MyPlexAccount
+    ) -> datetime | None:
+        """
+        Last view of the items a user is in the middle of, None when it is unknown.
+        """
+        try:
+            user_plex = self.get_user_plex(user)
+            if not user_plex:
+                return None
+
+            viewed_dates = [
+                get_viewed_date(item)
+                for item in user_plex.library.onDeck()
+                if item.viewOffset
+            ]
+        except Exception as e:
+            logger.debug(f"Plex: Failed to get progress of {user.title}, {e}")
+            return None
+
+        return max(
+            (viewed_date for viewed_date in viewed_dates if viewed_date),
+            default=datetime.fromtimestamp(0, timezone.utc),
+        )
+
+    def get_user_plex(self, user: MyPlexUser | MyPlexAccount) -> PlexServer | None:
+        if self.admin_user == user:
+            return self.plex
+
+        user_name: str = user.username.lower() if user.username else user.title.lower()
+
+        def login_user() -> PlexServer | None:
+            token = user.get_token(self.plex.machineIdentifier)
+            if not token:
+                return None
+
+            return self.login(self.base_url, token, None, None, None)
+
+        return self.cache.get(("user_plex", user_name), login_user)
+
+    def get_user_sections(
+        self, user_name: str, user_plex: PlexServer
+    ) -> list[MovieSection | ShowSection]:
+        return self.cache.get(
+            ("sections", user_name.lower()), lambda: user_plex.library.sections()
+        )
+
     def get_libraries(self) -> dict[str, str]:
+        return self.cache.get("libraries", self.fetch_libraries)
+
+    def fetch_libraries(self) -> dict[str, str]:
         try:
             output = {}
 
@@ -230,7 +413,11 @@ class Plex:
             raise Exception(e)
 
     def get_user_library_watched(
-        self, user_name: str, user_plex: PlexServer, library: MovieSection | ShowSection
+        self,
+        user_name: str,
+        user_plex: PlexServer,
+        library: MovieSection | ShowSection,
+        since: datetime | None = None,
     ) -> LibraryData:
         try:
             logger.info(
@@ -239,11 +426,13 @@ class Plex:
             watched = LibraryData(title=library.title)
 
             library_videos = user_plex.library.section(library.title)
+            # Let the server skip everything not played since
+            filters = {"lastViewedAt>>": since} if since else {}
 
             if library.type == "movie":
                 for video in library_videos.search(
-                    unwatched=False
-                ) + library_videos.search(inProgress=True):
+                    unwatched=False, filters=filters
+                ) + library_videos.search(inProgress=True, filters=filters):
                     if video.isWatched or video.viewOffset >= 60000:
                         watched.movies.append(
                             get_mediaitem(
@@ -257,9 +446,11 @@ class Plex:
             elif library.type == "show":
                 # Keep track of processed shows to reduce duplicate shows
                 processed_shows = []
+                if since:
+                    filters = {"episode.lastViewedAt>>": since}
                 for show in library_videos.search(
-                    unwatched=False
-                ) + library_videos.search(inProgress=True):
+                    unwatched=False, filters=filters
+                ) + library_videos.search(inProgress=True, filters=filters):
                     if show.key in processed_shows:
                         continue
                     processed_shows.append(show.key)
@@ -310,34 +501,257 @@ class Plex:
             )
             return LibraryData(title=library.title)
 
+    def get_active_sessions(self) -> list[tuple[str, str | None, str, int]]:
+        """
+        Get the movies and episodes that are currently playing as
+        (user name, user id, item id, position in milliseconds).
+        """
+        try:
+            sessions: list[tuple[str, str | None, str, int]] = []
+            for session in self.plex.sessions():
+                if not isinstance(session, (Movie, Episode)) or not session.usernames:
+                    continue
+
+                sessions.append(
+                    (
+                        session.usernames[0],
+                        None,
+                        str(session.ratingKey),
+                        session.viewOffset,
+                    )
+                )
+
+            return sessions
+        except Exception as e:
+            logger.error(f"Plex: Failed to get active sessions, Error: {e}")
+            raise Exception(e)
+
+    def get_item_watched(
+        self, user_name: str, item_id: str, user_id: str | None = None
+    ) -> tuple[str, str, str, LibraryData] | None:
+        """
+        Get the watched status of a single item for a user, used to sync webhook events.
+        Returns the user name, library title, library type and the item as LibraryData.
+        """
+        try:
+            for user in self.users:
+                if user_name.lower() in [
+                    (user.username or "").lower(),
+                    (user.title or "").lower(),
+                ]:
+                    break
+            else:
+                logger.info(f"Plex: User {user_name} not found")
+                return None
+
+            user_name = user.username.lower() if user.username else user.title.lower()
+            user_plex = self.get_user_plex(user)
+            if not user_plex:
+                logger.error(f"Plex: Failed to get token for {user.title}, skipping")
+                return None
+
+            item = user_plex.fetchItem(int(item_id))
+            library_title = item.librarySectionTitle
+            library_type = "movie" if isinstance(item, Movie) else "show"
+            watched = LibraryData(title=library_title)
+
+            # Skip if not watched or watched less than a minute
+            if not item.isWatched and item.viewOffset < 60_000:
+                return user_name, library_title, library_type, watched
+
+            mediaitem = get_mediaitem(
+                item, item.isWatched, self.generate_guids, self.generate_locations
+            )
+            if isinstance(item, Movie):
+                watched.movies.append(mediaitem)
+            elif isinstance(item, Episode):
+                watched.series.append(
+                    Series(
+                        identifiers=extract_identifiers_from_item(
+                            item.show(), self.generate_guids, self.generate_locations
+                        ),
+                        episodes=[mediaitem],
+                    )
+                )
+
+            return user_name, library_title, library_type, watched
+        except Exception as e:
+            logger.error(
+                f"Plex: Failed to get item {item_id} for {user_name}, Error: {e}"
+            )
+            return None
+
+    def get_history_changes(self, since: datetime) -> dict[str, set[str]] | None:
+        """
+        Get the rating keys every user viewed since the given date from the server
+        wide watch history. Returns None if the history is truncated.
+        """
+        entries = self.plex.history(maxresults=self.history_max_entries, mindate=since)
+        if len(entries) >= self.history_max_entries:
+            logger.info(
+                f"Plex: Watch history since {since} has more than {self.history_max_entries} entries"
+            )
+            return None
+
+        account_names = self.get_account_names()
+        changes: dict[str, set[str]] = {}
+        for entry in entries:
+            user_name = account_names.get(entry.accountID)
+            if not user_name or not entry.ratingKey:
+                continue
+
+            changes.setdefault(user_name, set()).add(str(entry.ratingKey))
+
+        return changes
+
+    def update_history_item(
+        self, user_name: str, user_plex: PlexServer, rating_key: str
+    ) -> None:
+        try:
+            item = user_plex.fetchItem(int(rating_key))
+        except Exception as e:
+            logger.debug(f"Plex: Failed to fetch {rating_key} for {user_name}, {e}")
+            return
+
+        if not isinstance(item, (Movie, Episode)):
+            return
+
+        library = self.history_watched[user_name].libraries.get(
+            item.librarySectionTitle
+        )
+        if library is None:
+            # Libraries that were never gathered are gathered in full
+            return
+
+        mediaitem = get_mediaitem(
+            item, item.isWatched, self.generate_guids, self.generate_locations
+        )
+        watched = item.isWatched or item.viewOffset >= 60_000
+
+        if isinstance(item, Movie):
+            library.movies = [
+                movie
+                for movie in library.movies
+                if not check_same_identifiers(movie.identifiers, mediaitem.identifiers)
+            ]
+            if watched:
+                library.movies.append(mediaitem)
+            return
+
+        show_identifiers = extract_identifiers_from_item(
+            item.show(), self.generate_guids, self.generate_locations
+        )
+        series = next(
+            (
+                series
+                for series in library.series
+                if check_same_identifiers(series.identifiers, show_identifiers)
+            ),
+            None,
+        )
+        if series is None:
+            if watched:
+                library.series.append(
+                    Series(identifiers=show_identifiers, episodes=[mediaitem])
+                )
+            return
+
+        series.episodes = [
+            episode
+            for episode in series.episodes
+            if not check_same_identifiers(episode.identifiers, mediaitem.identifiers)
+        ]
+        if watched:
+            series.episodes.append(mediaitem)
+
+    def update_history_watched(self) -> None:
+        """
+        Bring the watched state gathered in the previous run up to date by only
+        fetching the items that show up in the watch history since then. Everything
+        is gathered again on the first run, when the history is truncated and every
+        FULL_SYNC_INTERVAL, as partial progress and unwatching are not in the history.
+        """
+        since = self.history_watermark
+        self.history_watermark = datetime.now(timezone.utc)
+
+        full_due = (
+            self.history_full_time is None
+            or monotonic() - self.history_full_time >= self.history_full_interval
+        )
+        changes = None
+        if since is not None and not full_due:
+            changes = self.get_history_changes(since)
+
+        if changes is None:
+            logger.info("Plex: Gathering the full watched history")
+            self.history_watched = {}
+            self.history_written = {}
+            self.history_full_time = monotonic()
+            return
+
+        logger.info(
+            f"Plex: {sum(len(keys) for keys in changes.values())} items viewed since {since}"
+        )
+        for user in self.users:
+            user_name = user.username.lower() if user.username else user.title.lower()
+            if user_name not in changes or user_name not in self.history_watched:
+                continue
+
+            user_plex = self.get_user_plex(user)
+            if not user_plex:
+                continue
+
+            for rating_key in changes[user_name]:
+                self.update_history_item(user_name, user_plex, rating_key)
+
+    def apply_history_writes(
+        self, user: MyPlexUser | MyPlexAccount, user_name: str, user_plex: PlexServer
+    ) -> None:
+        written = self.history_written.pop(user.title.lower(), set())
+        if not written or user_name not in self.history_watched:
+            return
+
+        logger.debug(f"Plex: Updating {len(written)} written items for {user_name}")
+        for rating_key in written:
+            self.update_history_item(user_name, user_plex, rating_key)
+
     def get_watched(
         self,
         users: list[MyPlexUser | MyPlexAccount],
         sync_libraries: list[str],
         users_watched: dict[str, UserData] | None = None,
+        checkpoint: Checkpoint | None = None,
+        since: datetime | None = None,
     ) -> dict[str, UserData]:
+        """
+        With since only items played at or after it are gathered.
+        """
         try:
             if not users_watched:
                 users_watched: dict[str, UserData] = {}
 
+            # Only once per run, refresh resets it between runs in daemon mode
+            with self.history_lock:
+                if self.history_gather and not self.history_updated:
+                    self.update_history_watched()
+                    self.history_updated = True
+
             for user in users:
-                if self.admin_user == user:
-                    user_plex = self.plex
-                else:
-                    token = user.get_token(self.plex.machineIdentifier)
-                    if token:
-                        user_plex = self.login(self.base_url, token, None, None, None)
-                    else:
-                        logger.error(
-                            f"Plex: Failed to get token for {user.title}, skipping",
-                        )
-                        continue
+                user_plex = self.get_user_plex(user)
+                if not user_plex:
+                    logger.error(
+                        f"Plex: Failed to get token for {user.title}, skipping",
+                    )
+                    continue
 
                 user_name: str = (
                     user.username.lower() if user.username else user.title.lower()
                 )
 
-                libraries = user_plex.library.sections()
+                libraries = self.get_user_sections(user_name, user_plex)
+                if self.history_gather:
+                    with self.history_lock:
+                        self.apply_history_writes(user, user_name, user_plex)
 
                 for library in libraries:
                     if library.title not in sync_libraries:
@@ -352,29 +766,112 @@ class Plex:
                         )
                         continue
 
-                    library_data = self.get_user_library_watched(
-                        user_name, user_plex, library
-                    )
+                    history_library = None
+                    if self.history_gather:
+                        with self.history_lock:
+                            history_library = self.history_watched.get(
+                                user_name, UserData()
+                            ).libraries.get(library.title)
+                            if history_library is not None:
+                                history_library = history_library.model_copy(deep=True)
+                    if history_library is not None:
+                        library_data = history_library
+                    else:
+                        library_data = self.get_user_library_watched(
+                            user_name, user_plex, library, since
+                        )
+                        # Only a full gather can seed the history
+                        if self.history_gather and since is None:
+                            with self.history_lock:
+                                self.history_watched.setdefault(
+                                    user_name, UserData()
+                                ).libraries[library.title] = library_data.model_copy(
+                                    deep=True
+                                )
+
+                    if since is not None:
+                        library_data = filter_watched_since(library_data, since)
 
                     users_watched[user_name].libraries[library.title] = library_data
+                    if checkpoint:
+                        checkpoint.record_gather(
+                            self, user_name, library.title, library_data
+                        )
 
             return users_watched
         except Exception as e:
             logger.error(f"Plex: Failed to get users watched, Error: {e}")
             return {}
 
+    def retry_write(self, user_name: str, action: SyncAction) -> bool:
+        """
+        Write an action from the outbox straight to its item, without searching
+        the library again. Returns False without writing when the item already
+        has the state or was played since.
+        """
+        for user in self.users:
+            if user.title.lower() != user_name.lower():
+                continue
+
+            user_plex = self.get_user_plex(user)
+            if not user_plex:
+                raise Exception(f"Failed to get PlexServer for {user_name}")
+
+            item = user_plex.fetchItem(int(str(action.target_id)))
+            # Plex keeps the watched flag while rewatching, see get_mediaitem
+            if is_superseded(
+                action,
+                item.isWatched and item.viewOffset < 60_000,
+                item.viewOffset,
+                get_viewed_date(item),
+            ):
+                return False
+
+            if action.action == "mark_watched":
+                item.markWatched()
+            else:
+                # Same as update_user_watched, only movies are unmarked first
+                if action.series is None:
+                    item.markUnwatched()
+                item.updateTimeline(action.position)
+            return True
+
+        raise Exception(f"User {user_name} not found")
+
+    def record_write(self, user_name: str, action: SyncAction) -> None:
+        action.outcome = "written"
+        if self.ledger:
+            self.ledger.record(self, user_name, action)
+        if self.outbox:
+            self.outbox.remove(self, user_name, action)
+        if self.history_gather and action.target_id is not None:
+            with self.history_lock:
+                self.history_written.setdefault(user_name.lower(), set()).add(
+                    action.target_id
+                )
+
+    def record_failed_write(
+        self, user_name: str, action: SyncAction, error: Exception
+    ) -> None:
+        action.outcome = "failed"
+        if self.outbox:
+            self.outbox.add(self, user_name, action, str(error))
+
     def update_user_watched(
         self,
         user: MyPlexAccount,
         user_plex: PlexServer,
-        library_data: LibraryData,
+        actions: list[SyncAction],
         library_name: str,
         dryrun: bool,
     ) -> None:
         # If there are no movies or shows to update, exit early.
-        if not library_data.series and not library_data.movies:
+        if not actions:
             return
 
+        movie_actions = [action for action in actions if action.series is None]
+        series_actions = group_series_actions(actions)
+
         logger.info(
             f"Plex: Updating watched for {user.title} in library {library_name}"
         )
@@ -386,20 +883,40 @@ class Plex:
             return
 
         # Update movies.
-        if library_data.movies:
-            # Search for Plex movies that are currently marked as unwatched.
-            for plex_movie in library_section.search():
-                plex_identifiers = extract_identifiers_from_item(
-                    plex_movie, self.generate_guids, self.generate_locations
+        if movie_actions:
+            plex_movies = [
+                (
+                    plex_movie,
+                    extract_identifiers_from_item(
+                        plex_movie, self.generate_guids, self.generate_locations
+                    ),
                 )
-                # Check each stored movie for a match.
-                for stored_movie in library_data.movies:
-                    if check_same_identifiers(
-                        plex_identifiers, stored_movie.identifiers
-                    ):
+                for plex_movie in library_section.search()
+            ]
+
+            # Check each stored movie for a match, most recently viewed first.
+            for action in movie_actions:
+                for plex_movie, plex_identifiers in plex_movies:
+                    if check_same_identifiers(plex_identifiers, action.identifiers):
+                        action.target_id = str(plex_movie.ratingKey)
+                        # Plex keeps the watched flag while rewatching, see get_mediaitem
+                        if is_satisfied(
+                            action,
+                            plex_movie.isWatched and plex_movie.viewOffset < 60_000,
+                            plex_movie.viewOffset,
+                        ):
+                            action.outcome = "satisfied"
+                            break
+
+                        if self.ledger and not self.ledger.should_write(
+                            self, user.title, action
+                        ):
+                            action.outcome = "skipped"
+                            break
+
                         # If the stored movie is marked as watched (or has enough progress),
                         # update the Plex movie accordingly.
-                        if stored_movie.status.completed:
+                        if action.action == "mark_watched":
                             msg = f"Plex: {plex_movie.title} as watched for {user.title} in {library_name}"
                             if not dryrun:
                                 try:
@@ -408,8 +925,11 @@ class Plex:
                                     logger.error(
                                         f"Plex: Failed to mark {plex_movie.title} as watched, Error: {e}"
                                     )
+                                    self.record_failed_write(user.title, action, e)
                                     continue
 
+                                self.record_write(user.title, action)
+
                             logger.success(f"{'[DRYRUN] ' if dryrun else ''}{msg}")
                             log_marked(
                                 "Plex",
@@ -424,17 +944,20 @@ class Plex:
                                 ),
                             )
                         else:
-                            msg = f"Plex: {plex_movie.title} as partially watched for {floor(stored_movie.status.time / 60_000)} minutes for {user.title} in {library_name}"
+                            msg = f"Plex: {plex_movie.title} as partially watched for {floor(action.position / 60_000)} minutes for {user.title} in {library_name}"
                             if not dryrun:
                                 try:
                                     plex_movie.markUnwatched()  # Unmark as watched first so completed status is set to false
-                                    plex_movie.updateTimeline(stored_movie.status.time)
+                                    plex_movie.updateTimeline(action.position)
                                 except Exception as e:
                                     logger.error(
                                         f"Plex: Failed to update {plex_movie.title} timeline, Error: {e}"
                                     )
+                                    self.record_failed_write(user.title, action, e)
                                     continue
 
+                                self.record_write(user.title, action)
+
                             logger.success(f"{'[DRYRUN] ' if dryrun else ''}{msg}")
                             log_marked(
                                 "Plex",
@@ -442,7 +965,7 @@ class Plex:
                                 user.title,
                                 library_name,
                                 plex_movie.title,
-                                duration=stored_movie.status.time,
+                                duration=action.position,
                                 mark_file=get_env_value(
                                     self.env, "MARK_FILE", "mark.log"
                                 ),
@@ -451,34 +974,59 @@ class Plex:
                         break
 
         # Update TV Shows (series/episodes).
-        if library_data.series:
-            # For each Plex show in the library section:
-            plex_shows = library_section.search()
-            for plex_show in plex_shows:
-                # Extract identifiers from the Plex show.
-                plex_show_identifiers = extract_identifiers_from_item(
-                    plex_show, self.generate_guids, self.generate_locations
+        if series_actions:
+            plex_shows = [
+                (
+                    plex_show,
+                    extract_identifiers_from_item(
+                        plex_show, self.generate_guids, self.generate_locations
+                    ),
                 )
-                # Try to find a matching series in your stored library.
-                for stored_series in library_data.series:
+                for plex_show in library_section.search()
+            ]
+
+            # Try to find each stored series, most recently viewed first.
+            for series_identifiers, episode_actions in series_actions:
+                for plex_show, plex_show_identifiers in plex_shows:
                     if check_same_identifiers(
-                        plex_show_identifiers, stored_series.identifiers
+                        plex_show_identifiers, series_identifiers
                     ):
                         logger.trace(f"Found matching show for '{plex_show.title}'")
                         # Now update episodes.
                         # Get the list of Plex episodes for this show.
-                        plex_episodes = plex_show.episodes()
-                        for plex_episode in plex_episodes:
-                            plex_episode_identifiers = extract_identifiers_from_item(
+                        plex_episodes = [
+                            (
                                 plex_episode,
-                                self.generate_guids,
-                                self.generate_locations,
+                                extract_identifiers_from_item(
+                                    plex_episode,
+                                    self.generate_guids,
+                                    self.generate_locations,
+                                ),
                             )
-                            for stored_ep in stored_series.episodes:
+                            for plex_episode in plex_show.episodes()
+                        ]
+                        for action in episode_actions:
+                            for plex_episode, plex_episode_identifiers in plex_episodes:
                                 if check_same_identifiers(
-                                    plex_episode_identifiers, stored_ep.identifiers
+                                    plex_episode_identifiers, action.identifiers
                                 ):
-                                    if stored_ep.status.completed:
+                                    action.target_id = str(plex_episode.ratingKey)
+                                    if is_satisfied(
+                                        action,
+                                        plex_episode.isWatched
+                                        and plex_episode.viewOffset < 60_000,
+                                        plex_episode.viewOffset,
+                                    ):
+                                        action.outcome = "satisfied"
+                                        break
+
+                                    if self.ledger and not self.ledger.should_write(
+                                        self, user.title, action
+                                    ):
+                                        action.outcome = "skipped"
+                                        break
+
+                                    if action.action == "mark_watched":
                                         msg = f"Plex: {plex_show.title} {plex_episode.title} as watched for {user.title} in {library_name}"
                                         if not dryrun:
                                             try:
@@ -487,8 +1035,13 @@ class Plex:
                                                 logger.error(
                                                     f"Plex: Failed to mark {plex_show.title} {plex_episode.title} as watched, Error: {e}"
                                                 )
+                                                self.record_failed_write(
+                                                    user.title, action, e
+                                                )
                                                 continue
 
+                                            self.record_write(user.title, action)
+
                                         logger.success(
                                             f"{'[DRYRUN] ' if dryrun else ''}{msg}"
                                         )
@@ -504,18 +1057,23 @@ class Plex:
                                             ),
                                         )
                                     else:
-                                        msg = f"Plex: {plex_show.title} {plex_episode.title} as partially watched for {floor(stored_ep.status.time / 60_000)} minutes for {user.title} in {library_name}"
+                                        msg = f"Plex: {plex_show.title} {plex_episode.title} as partially watched for {floor(action.position / 60_000)} minutes for {user.title} in {library_name}"
                                         if not dryrun:
                                             try:
                                                 plex_episode.updateTimeline(
-                                                    stored_ep.status.time
+                                                    action.position
                                                 )
                                             except Exception as e:
                                                 logger.error(
                                                     f"Plex: Failed to update {plex_show.title} {plex_episode.title} timeline, Error: {e}"
                                                 )
+                                                self.record_failed_write(
+                                                    user.title, action, e
+                                                )
                                                 continue
 
+                                            self.record_write(user.title, action)
+
                                         logger.success(
                                             f"{'[DRYRUN] ' if dryrun else ''}{msg}"
                                         )
@@ -526,7 +1084,7 @@ class Plex:
                                             library_name,
                                             plex_show.title,
                                             plex_episode.title,
-                                            stored_ep.status.time,
+                                            action.position,
                                             mark_file=get_env_value(
                                                 self.env, "MARK_FILE", "mark.log"
                                             ),
@@ -536,12 +1094,12 @@ class Plex:
 
     def update_watched(
         self,
-        watched_list: dict[str, UserData],
+        actions: list[SyncAction],
         user_mapping: dict[str, str] | None = None,
         library_mapping: dict[str, str] | None = None,
         dryrun: bool = False,
     ) -> None:
-        for user, user_data in watched_list.items():
+        for user, user_actions in group_actions(actions).items():
             user_other = None
             # If type of user is dict
             if user_mapping:
@@ -559,43 +1117,32 @@ class Plex:
                     user = self.users[index]
                     break
 
-            if self.admin_user == user:
-                user_plex = self.plex
-            else:
+            if self.admin_user != user:
                 if isinstance(user, str):
                     logger.debug(
                         f"Plex: {user} is not a plex object, attempting to get object for user",
                     )
-                    user = self.plex.myPlexAccount().user(user)
+                    user = self.admin_user.user(user)
 
                 if not isinstance(user, MyPlexUser):
                     logger.error(f"Plex: {user} failed to get PlexUser")
                     continue
 
-                token = user.get_token(self.plex.machineIdentifier)
-                if token:
-                    user_plex = PlexServer(
-                        self.base_url,
-                        token,
-                        session=self.session,
-                    )
-                else:
-                    logger.error(
-                        f"Plex: Failed to get token for {user.title}, skipping",
-                    )
-                    continue
-
+            user_plex = self.get_user_plex(user)
             if not user_plex:
                 logger.error(f"Plex: {user} Failed to get PlexServer")
                 continue
 
-            for library_name in user_data.libraries:
-                library_data = user_data.libraries[library_name]
+            user_name: str = (
+                user.username.lower() if user.username else user.title.lower()
+            )
+
+            for library_name, library_actions in user_actions.items():
                 library_other = None
                 if library_mapping:
                     library_other = search_mapping(library_mapping, library_name)
                 # if library in plex library list
-                library_list = user_plex.library.sections()
+                library_list = self.get_user_sections(user_name, user_plex)
                 if library_name.lower() not in [x.title.lower() for x in library_list]:
                     if library_other:
                         if library_other.lower() in [
@@ -620,7 +1167,7 @@ class Plex:
                     self.update_user_watched(
                         user,
                         user_plex,
-                        library_data,
+                        library_actions,
                         library_name,
                         dryrun,
                     )
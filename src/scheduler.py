@@ -0,0 +1,102 @@
+import random
+from time import monotonic
+from loguru import logger
+
+
+class PairSchedule:
+    def __init__(self, key: str, interval: float, next_run: float) -> None:
+        self.key: str = key
+        self.interval: float = interval
+        self.next_run: float = next_run
+        self.failures: int = 0
+
+
+class Scheduler:
+    """
+    Keeps a separate cadence for every server pair.
+    Pairs that had changes are synced more often, pairs without changes back off
+    towards max_interval and failing pairs are retried with a jittered exponential
+    backoff without affecting the other pairs.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        min_interval: float,
+        max_interval: float,
+        retry_interval: float,
+        jitter: float = 0.1,
+    ) -> None:
+        self.interval: float = interval
+        self.min_interval: float = min(min_interval, interval)
+        self.max_interval: float = max(max_interval, interval)
+        self.retry_interval: float = retry_interval
+        self.jitter: float = jitter
+        self.pairs: dict[str, PairSchedule] = {}
+
+    def update(self, keys: list[str], now: float | None = None) -> None:
+        """
+        Add new pairs and drop pairs that no longer exist. New pairs are spread
+        evenly across the interval so the servers do not all get hit at once.
+        """
+        if now is None:
+            now = monotonic()
+
+        for key in list(self.pairs):
+            if key not in keys:
+                logger.debug(f"Scheduler: Removing {key}")
+                del self.pairs[key]
+
+        new_keys = [key for key in keys if key not in self.pairs]
+        for index, key in enumerate(new_keys):
+            offset = self.interval * index / len(new_keys)
+            self.pairs[key] = PairSchedule(key, self.interval, now + offset)
+            logger.debug(f"Scheduler: Adding {key} in {offset:.0f} seconds")
+
+    def next_due(self, now: float | None = None) -> tuple[str | None, float]:
+        if not self.pairs:
+            return None, 0.0
+
+        if now is None:
+            now = monotonic()
+
+        pair = min(self.pairs.values(), key=lambda pair: pair.next_run)
+        return pair.key, max(0.0, pair.next_run - now)
+
+    def add_jitter(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def record_success(self, key: str, changes: int, now: float | None = None) -> None:
+        if key not in self.pairs:
+            return
+
+        if now is None:
+            now = monotonic()
+
+        pair = self.pairs[key]
+        pair.failures = 0
+        if changes > 0:
+            pair.interval = max(self.min_interval, pair.interval / 2)
+        else:
+            pair.interval = min(self.max_interval, pair.interval * 1.5)
+
+        pair.next_run = now + self.add_jitter(pair.interval)
+        logger.info(
+            f"Scheduler: {key} had {changes} changes, next sync in {pair.next_run - now:.0f} seconds"
+        )
+
+    def record_failure(self, key: str, now: float | None = None) -> None:
+        if key not in self.pairs:
+            return
+
+        if now is None:
+            now = monotonic()
+
+        pair = self.pairs[key]
+        pair.failures += 1
+        delay = min(self.max_interval, self.retry_interval * 2 ** (pair.failures - 1))
+        # Equal jitter, at least half the backoff so failing pairs do not retry in lockstep
+        pair.next_run = now + random.uniform(delay / 2, delay)
+        logger.info(
+            f"Scheduler: {key} failed {pair.failures} times, retrying in {pair.next_run - now:.0f} seconds"
+        )
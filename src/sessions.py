@@ -0,0 +1,133 @@
+import threading
+from time import monotonic
+from typing import Any, Callable
+from loguru import logger
+
+from src.config import SyncConfig
+from src.connection import generate_server_connections
+from src.functions import get_env_value
+from src.webhook import WebhookEvent, WebhookProcessor
+
+
+class SessionProgress:
+    def __init__(self, position: int, pushed: float) -> None:
+        self.position: int = position
+        self.pushed: float = pushed
+
+
+class SessionPoller:
+    """
+    Mirrors the playback position of the items that are currently playing to the
+    other servers. A position is only pushed once it moved at least min_delta
+    milliseconds and at most once every min_interval seconds per user and item,
+    so a long playback does not turn into a stream of writes.
+    """
+
+    def __init__(
+        self,
+        processor: WebhookProcessor,
+        min_delta: int = 60_000,
+        min_interval: float = 60,
+    ) -> None:
+        self.processor: WebhookProcessor = processor
+        self.min_delta: int = min_delta
+        self.min_interval: float = min_interval
+        self.progress: dict[tuple[str, str, str, str], SessionProgress] = {}
+
+    def should_push(
+        self, key: tuple[str, str, str, str], position: int, now: float
+    ) -> bool:
+        # Less than a minute is not considered watched by the regular sync either
+        if position < 60_000:
+            return False
+
+        last = self.progress.get(key)
+        if last is None:
+            return True
+
+        if now - last.pushed < self.min_interval:
+            return False
+
+        return abs(position - last.position) >= self.min_delta
+
+    def poll(self, now: float | None = None) -> int:
+        if now is None:
+            now = monotonic()
+
+        pushed = 0
+        active: set[tuple[str, str, str, str]] = set()
+        for server in self.processor.servers:
+            try:
+                sessions = server.get_active_sessions()
+            except Exception as e:
+                logger.error(
+                    f"Sessions: Failed to get sessions from {server.info()}, Error: {e}"
+                )
+                continue
+
+            for user_name, user_id, item_id, position in sessions:
+                key = (server.server_type, server.server_id, user_name.lower(), item_id)
+                active.add(key)
+                if not self.should_push(key, position, now):
+                    continue
+
+                logger.debug(
+                    f"Sessions: {user_name} is playing {item_id} at {position // 1000} seconds on {server.info()}"
+                )
+                self.progress[key] = SessionProgress(position, now)
+                self.processor.process(
+                    WebhookEvent(
+                        server_type=server.server_type,
+                        server_id=server.server_id,
+                        event="SessionProgress",
+                        user_name=user_name,
+                        user_id=user_id,
+                        item_id=item_id,
+                        position=position,
+                    )
+                )
+                pushed += 1
+
+        # Stopped sessions are handled by the regular sync, forget them
+        for key in list(self.progress):
+            if key not in active:
+                del self.progress[key]
+
+        return pushed
+
+    def run(self, poll_interval: float, stop: threading.Event | None = None) -> None:
+        if stop is None:
+            stop = threading.Event()
+
+        while not stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Sessions: Failed to sync session progress, Error: {e}")
+
+            stop.wait(poll_interval)
+
+
+def start_session_poller(
+    env,
+    config: SyncConfig,
+    should_sync: Callable[[Any, Any], bool],
+) -> SessionPoller:
+    # Like the webhook listener the poller uses its own server connections
+    servers = generate_server_connections(env)
+
+    poller = SessionPoller(
+        WebhookProcessor(env, config, servers, should_sync),
+        min_delta=int(float(get_env_value(env, "SESSION_SYNC_MIN_DELTA", "60")) * 1000),
+        min_interval=float(get_env_value(env, "SESSION_SYNC_MIN_INTERVAL", "60")),
+    )
+    poll_interval = float(get_env_value(env, "SESSION_POLL_INTERVAL", "30"))
+    threading.Thread(
+        target=poller.run,
+        args=(poll_interval,),
+        name="session-poller",
+        daemon=True,
+    ).start()
+    logger.info(f"Sessions: Polling active sessions every {poll_interval} seconds")
+
+    return poller
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+from time import time
+from typing import Any, Callable
+from loguru import logger
+
+from src.actions import get_mapping_key
+from src.activity import get_user_names
+from src.functions import get_env_value
+
+# State files written during a run, every shard keeps its own copy
+SHARD_FILES = {
+    "ACTIVITY_FILE": "activity.json",
+    "CHECKPOINT_FILE": "checkpoint.jsonl",
+    "RUN_BUDGET_FILE": "deferred.json",
+}
+
+
+def get_user_shard(
+    user_name: str, shards: int, user_mapping: dict[str, str] | None = None
+) -> int:
+    """
+    Shard of a user, stable across runs, processes and containers. A user and the
+    user it is mapped to on the other server always end up in the same shard.
+    """
+    key = get_mapping_key(user_mapping, user_name)
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def filter_shard_users(
+    users: Any,
+    shard: int,
+    shards: int,
+    user_mapping: dict[str, str] | None = None,
+) -> Any:
+    """
+    Keep the users returned by setup_users that belong to the shard.
+    """
+    if isinstance(users, dict):
+        return {
+            user_name: user_id
+            for user_name, user_id in users.items()
+            if get_user_shard(user_name, shards, user_mapping) == shard
+        }
+
+    return [
+        user
+        for user in users
+        if get_user_shard(get_user_names([user])[0], shards, user_mapping) == shard
+    ]
+
+
+def get_shard_env(
+    env: dict[str, str | float | None], shard: int
+) -> dict[str, str | float | None]:
+    shard_env = dict(env)
+    for key, default in SHARD_FILES.items():
+        root, extension = os.path.splitext(get_env_value(env, key, default))
+        shard_env[key] = f"{root}.shard-{shard}{extension}"
+
+    return shard_env
+
+
+class ShardLeases:
+    """
+    Lease files in a directory shared by every container syncing the same servers.
+    A shard is synced by whoever creates its lease first and is not synced again
+    by anyone until interval seconds after it finished. Leases of workers that
+    died are taken over after ttl seconds, so ttl has to be longer than a run.
+    """
+
+    def __init__(self, directory: str, interval: float, ttl: float = 7200) -> None:
+        self.directory: str = directory
+        self.interval: float = interval
+        self.ttl: float = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, shard: int, kind: str) -> str:
+        return os.path.join(self.directory, f"shard-{shard}.{kind}")
+
+    def get_owner(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def finished_recently(self, shard: int) -> bool:
+        try:
+            finished = os.path.getmtime(self.get_path(shard, "done"))
+        except FileNotFoundError:
+            return False
+
+        return time() - finished < self.interval
+
+    def create(self, path: str) -> bool:
+        try:
+            handle = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(handle, "w", encoding="utf-8") as file:
+            json.dump({"owner": self.get_owner(), "acquired": time()}, file)
+        return True
+
+    def take_over(self, path: str) -> bool:
+        try:
+            if time() - os.path.getmtime(path) < self.ttl:
+                return False
+        except FileNotFoundError:
+            return self.create(path)
+
+        # Only one of the workers racing for a stale lease wins the rename
+        stale = f"{path}.{self.get_owner().replace(':', '-')}.stale"
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+
+        if time() - os.path.getmtime(stale) < self.ttl:
+            # Someone else took it over first, put their lease back
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+
+        logger.warning(f"Shard: Taking over the stale lease {path}")
+        os.remove(stale)
+        return self.create(path)
+
+    def acquire(self, shard: int) -> bool:
+        if self.finished_recently(shard):
+            return False
+
+        path = self.get_path(shard, "lease")
+        if not self.create(path) and not self.take_over(path):
+            return False
+
+        # Another worker may have finished the shard while the lease was taken
+        if self.finished_recently(shard):
+            os.remove(path)
+            return False
+
+        return True
+
+    def release(self, shard: int, finished: bool) -> None:
+        if finished:
+            done = self.get_path(shard, "done")
+            temp_file = f"{done}.{os.getpid()}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as file:
+                json.dump({"owner": self.get_owner(), "finished": time()}, file)
+            os.replace(temp_file, done)
+
+        try:
+            os.remove(self.get_path(shard, "lease"))
+        except FileNotFoundError:
+            pass
+
+
+def load_shard_leases(env) -> ShardLeases | None:
+    directory = get_env_value(env, "SHARD_LEASE_DIR", None)
+    if not directory:
+        return None
+
+    return ShardLeases(
+        directory,
+        interval=float(get_env_value(env, "SLEEP_DURATION", "3600")),
+        ttl=float(get_env_value(env, "SHARD_LEASE_TTL", "7200")),
+    )
+
+
+def run_shards(
+    job: Callable[[Any], dict[str, Any]], tasks: list[Any], workers: int
+) -> list[dict[str, Any]]:
+    """
+    Run the job for the task of every shard on a pool of worker processes, every
+    shard gets a fresh process. The parent runs the webhook, websocket and session
+    threads, so the workers are started from a clean forkserver or spawned instead
+    of forked with locks those threads may hold. The job and the tasks are pickled,
+    everything a worker needs has to be passed in its task.
+    """
+    method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    context = multiprocessing.get_context(method)
+    with context.Pool(min(workers, len(tasks)), maxtasksperchild=1) as pool:
+        return pool.map(job, tasks, chunksize=1)
+
+
+def log_shard_summary(results: list[dict[str, Any]], elapsed: float) -> None:
+    for result in results:
+        if result["status"] == "synced":
+            logger.info(
+                f"Shard: {result['shard']} synced {result['changes']} changes in {result['elapsed']:.0f} seconds"
+            )
+        elif result["status"] == "failed":
+            logger.error(f"Shard: {result['shard']} failed, Error: {result['error']}")
+
+    synced = sum(1 for result in results if result["status"] == "synced")
+    skipped = sum(1 for result in results if result["status"] == "skipped")
+    failed = [result["shard"] for result in results if result["status"] == "failed"]
+    logger.info(
+        f"Shard: {synced} shards synced, {skipped} skipped, {len(failed)} failed, {sum(result['changes'] for result in results)} changes in {elapsed:.0f} seconds"
+    )
+    if failed:
+        raise Exception(f"Shards {failed} failed")
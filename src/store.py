@@ -0,0 +1,310 @@
+import os
+import sqlite3
+import tempfile
+from typing import Iterator
+from loguru import logger
+
+from src.actions import get_identifier_keys
+from src.functions import search_mapping
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    Series,
+    UserData,
+    check_remove_entry,
+    count_watched,
+    get_other,
+)
+
+
+def get_store_keys(identifiers: MediaIdentifiers) -> list[str]:
+    """
+    Normalized keys of the identifiers, two items share a key exactly when
+    check_same_identifiers considers them the same.
+    """
+    return list(
+        dict.fromkeys(
+            f"{kind}:{value}" for kind, value in get_identifier_keys(identifiers)
+        )
+    )
+
+
+class WatchedStore:
+    """
+    SQLite copy of the watched lists of both servers of a pair, for installations
+    where they do not fit in memory. Movies, series and episodes are indexed on the
+    keys of their identifiers, so cleanup finds the matching items of the other
+    server with indexed joins and only holds a single user in memory. Without a
+    path the database is a temporary file that is removed on close.
+    """
+
+    def __init__(self, path: str | None = None, directory: str | None = None) -> None:
+        self.temporary: bool = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(
+                prefix="watched-", suffix=".db", dir=directory
+            )
+            os.close(handle)
+        self.path: str = path
+        self.connection = sqlite3.connect(path)
+        # Scratch data that is gathered again after a crash, durability is not needed
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS libraries ("
+            "id INTEGER PRIMARY KEY, side INTEGER, user TEXT, title TEXT);"
+            "CREATE TABLE IF NOT EXISTS series ("
+            "id INTEGER PRIMARY KEY, library_id INTEGER, data TEXT);"
+            "CREATE TABLE IF NOT EXISTS series_keys ("
+            "library_id INTEGER, key TEXT, series_id INTEGER);"
+            "CREATE TABLE IF NOT EXISTS items ("
+            "id INTEGER PRIMARY KEY, library_id INTEGER, series_id INTEGER, data TEXT);"
+            "CREATE TABLE IF NOT EXISTS item_keys ("
+            "library_id INTEGER, key TEXT, item_id INTEGER);"
+            "CREATE INDEX IF NOT EXISTS libraries_user ON libraries (side, user);"
+            "CREATE INDEX IF NOT EXISTS series_library ON series (library_id);"
+            "CREATE INDEX IF NOT EXISTS series_keys_key ON series_keys (library_id, key);"
+            "CREATE INDEX IF NOT EXISTS items_library ON items (library_id);"
+            "CREATE INDEX IF NOT EXISTS item_keys_key ON item_keys (library_id, key);"
+            "CREATE TEMP TABLE IF NOT EXISTS matches ("
+            "series_1 INTEGER PRIMARY KEY, series_2 INTEGER);"
+        )
+        self.items: int = 0
+
+    def add_watched(self, side: int, watched: dict[str, UserData]) -> None:
+        for user, user_data in watched.items():
+            for library_key, library in user_data.libraries.items():
+                self.add_library(side, user, library_key, library)
+        self.connection.commit()
+
+    def add_library(
+        self, side: int, user: str, library_key: str, library: LibraryData
+    ) -> None:
+        library_id = self.get_library_id(side, user, library_key)
+
+        for movie in library.movies:
+            self.add_item(library_id, None, movie)
+
+        for series in library.series:
+            series_id = self.connection.execute(
+                "INSERT INTO series (library_id, data) VALUES (?, ?)",
+                (library_id, series.identifiers.model_dump_json()),
+            ).lastrowid
+            self.connection.executemany(
+                "INSERT INTO series_keys (library_id, key, series_id) VALUES (?, ?, ?)",
+                [
+                    (library_id, key, series_id)
+                    for key in get_store_keys(series.identifiers)
+                ],
+            )
+            for episode in series.episodes:
+                self.add_item(library_id, series_id, episode)
+
+    def get_library_id(self, side: int, user: str, library_key: str) -> int:
+        row = self.connection.execute(
+            "SELECT id FROM libraries WHERE side = ? AND user = ? AND title = ?",
+            (side, user, library_key),
+        ).fetchone()
+        if row:
+            return row[0]
+
+        library_id = self.connection.execute(
+            "INSERT INTO libraries (side, user, title) VALUES (?, ?, ?)",
+            (side, user, library_key),
+        ).lastrowid
+        assert library_id is not None
+        return library_id
+
+    def add_item(self, library_id: int, series_id: int | None, item: MediaItem) -> None:
+        item_id = self.connection.execute(
+            "INSERT INTO items (library_id, series_id, data) VALUES (?, ?, ?)",
+            (library_id, series_id, item.model_dump_json()),
+        ).lastrowid
+        self.connection.executemany(
+            "INSERT INTO item_keys (library_id, key, item_id) VALUES (?, ?, ?)",
+            [(library_id, key, item_id) for key in get_store_keys(item.identifiers)],
+        )
+        self.items += 1
+
+    def get_libraries(self, side: int) -> dict[str, dict[str, int]]:
+        """
+        Library ids of every user of a side, by user and library key.
+        """
+        users: dict[str, dict[str, int]] = {}
+        for library_id, user, title in self.connection.execute(
+            "SELECT id, user, title FROM libraries WHERE side = ? ORDER BY id",
+            (side,),
+        ):
+            users.setdefault(user, {})[title] = library_id
+
+        return users
+
+    def get_removed(
+        self, library_id: int, other_id: int, env: dict[str, str | float | None]
+    ) -> tuple[set[int], set[int]]:
+        """
+        Items of library_id that the other library has in the same or a better
+        state, along with the series that matched a series of the other library.
+        """
+        # Like cleanup_watched, episodes are only compared to the first matching series
+        self.connection.execute("DELETE FROM matches")
+        self.connection.execute(
+            "INSERT INTO matches (series_1, series_2) "
+            "SELECT a.series_id, MIN(b.series_id) FROM series_keys a "
+            "JOIN series_keys b ON b.library_id = ? AND b.key = a.key "
+            "WHERE a.library_id = ? GROUP BY a.series_id",
+            (other_id, library_id),
+        )
+        matched = {
+            row[0] for row in self.connection.execute("SELECT series_1 FROM matches")
+        }
+
+        removed: set[int] = set()
+        candidates = self.connection.execute(
+            "SELECT DISTINCT ia.id, ia.data, ib.data FROM item_keys a "
+            "JOIN item_keys b ON b.library_id = ? AND b.key = a.key "
+            "JOIN items ia ON ia.id = a.item_id "
+            "JOIN items ib ON ib.id = b.item_id "
+            "LEFT JOIN matches m ON m.series_1 = ia.series_id "
+            "WHERE a.library_id = ? AND ("
+            "(ia.series_id IS NULL AND ib.series_id IS NULL) "
+            "OR ib.series_id = m.series_2) ORDER BY ia.id",
+            (other_id, library_id),
+        )
+        for item_id, data_1, data_2 in candidates:
+            if item_id in removed:
+                continue
+
+            if check_remove_entry(
+                MediaItem.model_validate_json(data_1),
+                MediaItem.model_validate_json(data_2),
+                env,
+            ):
+                removed.add(item_id)
+
+        return removed, matched
+
+    def get_library(
+        self,
+        library_id: int,
+        title: str,
+        removed: set[int] | None = None,
+        matched: set[int] | None = None,
+    ) -> LibraryData:
+        removed = removed or set()
+        matched = matched or set()
+        library = LibraryData(title=title)
+        series_list: dict[int, Series] = {}
+        for series_id, data in self.connection.execute(
+            "SELECT id, data FROM series WHERE library_id = ? ORDER BY id",
+            (library_id,),
+        ):
+            series_list[series_id] = Series(
+                identifiers=MediaIdentifiers.model_validate_json(data)
+            )
+
+        for item_id, series_id, data in self.connection.execute(
+            "SELECT id, series_id, data FROM items WHERE library_id = ? ORDER BY id",
+            (library_id,),
+        ):
+            if item_id in removed:
+                continue
+
+            item = MediaItem.model_validate_json(data)
+            if series_id is None:
+                library.movies.append(item)
+            else:
+                series_list[series_id].episodes.append(item)
+
+        # A matched series is only kept while it has episodes left
+        library.series = [
+            series
+            for series_id, series in series_list.items()
+            if series.episodes or series_id not in matched
+        ]
+
+        return library
+
+    def cleanup(
+        self,
+        side: int,
+        env: dict[str, str | float | None],
+        user_mapping: dict[str, str] | None = None,
+        library_mapping: dict[str, str] | None = None,
+    ) -> Iterator[tuple[str, UserData]]:
+        """
+        Same result as cleanup_watched of side against the other side, one user at
+        a time.
+        """
+        other_users = self.get_libraries(2 if side == 1 else 1)
+
+        for user_1, libraries in self.get_libraries(side).items():
+            user_other = None
+            if user_mapping:
+                user_other = search_mapping(user_mapping, user_1)
+            user_2 = get_other(other_users, user_1, user_other)
+
+            user_data = UserData()
+            for library_1_key, library_id in libraries.items():
+                library_2_key = None
+                if user_2 is not None:
+                    library_other = None
+                    if library_mapping:
+                        library_other = search_mapping(library_mapping, library_1_key)
+                    library_2_key = get_other(
+                        other_users[user_2], library_1_key, library_other
+                    )
+
+                removed: set[int] = set()
+                matched: set[int] = set()
+                if user_2 is not None and library_2_key is not None:
+                    removed, matched = self.get_removed(
+                        library_id, other_users[user_2][library_2_key], env
+                    )
+
+                library = self.get_library(library_id, library_1_key, removed, matched)
+                if library.movies or library.series:
+                    user_data.libraries[library_1_key] = library
+
+            yield user_1, user_data
+
+    def close(self) -> None:
+        self.connection.close()
+        if self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class WatchedBuffer:
+    """
+    Gathered watched lists of both servers of a pair. They are kept in memory
+    until they hold more than threshold items, then everything is moved to a
+    WatchedStore and gathered users go straight to disk.
+    """
+
+    def __init__(self, threshold: int, directory: str | None = None) -> None:
+        self.threshold: int = threshold
+        self.directory: str | None = directory
+        self.watched: dict[int, dict[str, UserData]] = {1: {}, 2: {}}
+        self.items: int = 0
+        self.store: WatchedStore | None = None
+
+    def add(self, side: int, watched: dict[str, UserData]) -> None:
+        if self.store is not None:
+            self.store.add_watched(side, watched)
+            return
+
+        self.watched[side].update(watched)
+        self.items += count_watched(watched)
+        if self.items > self.threshold:
+            logger.info(
+                f"Store: {self.items} watched items gathered, moving them to disk"
+            )
+            self.store = WatchedStore(directory=self.directory)
+            for stored_side, stored_watched in self.watched.items():
+                self.store.add_watched(stored_side, stored_watched)
+            self.watched = {1: {}, 2: {}}
+
+    def close(self) -> None:
+        if self.store is not None:
+            self.store.close()
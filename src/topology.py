@@ -0,0 +1,152 @@
+from typing import Any, Literal
+from pydantic import BaseModel, Field
+from loguru import logger
+
+from src.functions import get_env_value, str_to_bool
+
+SERVER_TYPES = ["Plex", "Jellyfin", "Emby"]
+
+
+class SyncMatrix(BaseModel):
+    """
+    The SYNC_FROM_*_TO_* flags compiled once, keyed by (source type, target type).
+    """
+
+    directions: dict[tuple[str, str], bool] = Field(default_factory=dict)
+
+    def allows(self, source: Any, target: Any) -> bool:
+        allowed = self.directions.get((source.server_type, target.server_type), True)
+        if not allowed:
+            logger.debug(
+                f"Sync from {source.server_type.lower()} -> {target.server_type.lower()} is disabled"
+            )
+
+        return allowed
+
+
+def load_sync_matrix(env) -> SyncMatrix:
+    return SyncMatrix(
+        directions={
+            (source, target): str_to_bool(
+                get_env_value(
+                    env, f"SYNC_FROM_{source.upper()}_TO_{target.upper()}", "True"
+                )
+            )
+            for source in SERVER_TYPES
+            for target in SERVER_TYPES
+        }
+    )
+
+
+def get_server_name(server: Any) -> str:
+    if server.server_type == "Plex":
+        return server.plex.friendlyName
+
+    return server.server_name
+
+
+class SyncPlan:
+    """
+    The server pairs synced in a loop, in the order they are synced. Consecutive
+    pairs share server 1 so its watched list is only gathered once for all of them.
+    """
+
+    def __init__(
+        self,
+        mode: Literal["mesh", "primary"],
+        pairs: list[tuple[Any, Any]],
+        matrix: SyncMatrix,
+        primary: Any | None = None,
+    ) -> None:
+        self.mode: Literal["mesh", "primary"] = mode
+        self.pairs: list[tuple[Any, Any]] = pairs
+        self.matrix: SyncMatrix = matrix
+        self.primary: Any | None = primary
+
+    def gathers(self) -> list[Any]:
+        gathers: list[Any] = []
+        previous_server_1 = None
+        for server_1, server_2 in self.pairs:
+            if server_1 is not previous_server_1:
+                gathers.append(server_1)
+                previous_server_1 = server_1
+            gathers.append(server_2)
+
+        return gathers
+
+    def writes(self) -> list[tuple[Any, Any]]:
+        writes: list[tuple[Any, Any]] = []
+        for server_1, server_2 in self.pairs:
+            if self.matrix.allows(server_2, server_1):
+                writes.append((server_2, server_1))
+            if self.matrix.allows(server_1, server_2):
+                writes.append((server_1, server_2))
+
+        return writes
+
+    def log(self) -> None:
+        primary = f", primary {self.primary.info()}" if self.primary else ""
+        logger.info(
+            f"Sync plan: {self.mode}{primary}, {len(self.pairs)} pairs, {len(self.gathers())} gathers, {len(self.writes())} writes"
+        )
+        for source, target in self.writes():
+            logger.info(f"Sync plan: {source.info()} -> {target.info()}")
+
+
+def find_primary_server(servers: list[Any], primary: str | None) -> Any:
+    """
+    Find the server matching SYNC_PRIMARY_SERVER by name or base url,
+    the first configured server is the primary if it is not set.
+    """
+    if not primary:
+        return servers[0]
+
+    for server in servers:
+        if primary.lower() in [
+            get_server_name(server).lower(),
+            server.base_url.rstrip("/").lower(),
+        ]:
+            return server
+
+    raise Exception(f"SYNC_PRIMARY_SERVER {primary} does not match any server")
+
+
+def plan_sync(
+    servers: list[Any],
+    matrix: SyncMatrix,
+    mode: Literal["mesh", "primary"] = "mesh",
+    primary: str | None = None,
+) -> SyncPlan:
+    if mode == "primary" and servers:
+        # Spokes only sync with the primary, changes reach the other spokes through it
+        # as the primary watched list is updated after every pair
+        hub = find_primary_server(servers, primary)
+        pairs = [
+            (hub, server)
+            for server in servers
+            if server is not hub
+            and (matrix.allows(hub, server) or matrix.allows(server, hub))
+        ]
+        return SyncPlan(mode, pairs, matrix, hub)
+
+    pairs = []
+    for index, server_1 in enumerate(servers):
+        # Start server_2 at the next server in the list
+        for server_2 in servers[index + 1 :]:
+            # Check if server 1 and server 2 are going to be synced in either direction, skip if not
+            if matrix.allows(server_1, server_2) or matrix.allows(server_2, server_1):
+                pairs.append((server_1, server_2))
+
+    return SyncPlan(mode, pairs, matrix)
+
+
+def load_sync_plan(env, servers: list[Any], matrix: SyncMatrix) -> SyncPlan:
+    mode = get_env_value(env, "SYNC_TOPOLOGY", "mesh").lower()
+    if mode not in ["mesh", "primary"]:
+        raise Exception(
+            f"Invalid SYNC_TOPOLOGY {mode}, please choose between mesh, primary"
+        )
+
+    return plan_sync(
+        servers, matrix, mode, get_env_value(env, "SYNC_PRIMARY_SERVER", None)
+    )
@@ -5,6 +5,7 @@ from src.emby import Emby
 from src.jellyfin import Jellyfin
 from src.plex import Plex
 from src.functions import search_mapping
+from src.activity import filter_idle_user_lists, get_user_names
 
 
 def generate_user_list(server: Plex | Jellyfin | Emby) -> list[str]:
@@ -109,6 +110,8 @@ def setup_users(
     blacklist_users: list[str],
     whitelist_users: list[str],
     user_mapping: dict[str, str] | None = None,
+    server_1_idle_users: set[str] | None = None,
+    server_2_idle_users: set[str] | None = None,
 ) -> tuple[
     list[MyPlexAccount | MyPlexUser] | dict[str, str],
     list[MyPlexAccount | MyPlexUser] | dict[str, str],
@@ -146,7 +149,57 @@ def setup_users(
     ):
         raise Exception("No users found for one or both servers")
 
+    if server_1_idle_users is not None and server_2_idle_users is not None:
+        users_filtered = filter_idle_user_lists(
+            users_filtered, server_1_idle_users, server_2_idle_users
+        )
+        logger.debug(f"Active user list {users_filtered}")
+
+        output_server_1_users = generate_server_users(server_1, users_filtered)
+        output_server_2_users = generate_server_users(server_2, users_filtered)
+
     logger.info(f"Server 1 users: {output_server_1_users}")
     logger.info(f"Server 2 users: {output_server_2_users}")
 
     return output_server_1_users, output_server_2_users
+
+
+def split_server_users(
+    users: list[MyPlexAccount | MyPlexUser] | dict[str, str],
+) -> list[list[MyPlexAccount | MyPlexUser] | dict[str, str]]:
+    if isinstance(users, dict):
+        return [{user_name: user_id} for user_name, user_id in users.items()]
+
+    return [[user] for user in users]
+
+
+def pair_server_users(
+    server_1_users: list[MyPlexAccount | MyPlexUser] | dict[str, str],
+    server_2_users: list[MyPlexAccount | MyPlexUser] | dict[str, str],
+    user_mapping: dict[str, str] | None = None,
+) -> list[
+    tuple[
+        list[MyPlexAccount | MyPlexUser] | dict[str, str],
+        list[MyPlexAccount | MyPlexUser] | dict[str, str],
+    ]
+]:
+    """
+    Split the users returned by setup_users into pairs of single users that are
+    the same person on both servers, in the format get_watched expects.
+    """
+    server_2_split = [
+        (get_user_names(user)[0], user) for user in split_server_users(server_2_users)
+    ]
+
+    pairs = []
+    for user_1 in split_server_users(server_1_users):
+        user_name = get_user_names(user_1)[0]
+        mapped_user = search_mapping(user_mapping, user_name) if user_mapping else None
+        for user_name_2, user_2 in server_2_split:
+            if user_name_2 == user_name or (
+                mapped_user and user_name_2 == mapped_user.lower()
+            ):
+                pairs.append((user_1, user_2))
+                break
+
+    return pairs
@@ -52,6 +52,43 @@ class UserData(BaseModel):
     libraries: dict[str, LibraryData] = Field(default_factory=dict)
 
 
+def count_watched(watched_list: dict[str, UserData]) -> int:
+    return sum(
+        len(library.movies) + sum(len(series.episodes) for series in library.series)
+        for user_data in watched_list.values()
+        for library in user_data.libraries.values()
+    )
+
+
+def filter_watched_since(library: LibraryData, since: datetime) -> LibraryData:
+    """
+    Keep only the items last played at or after since, series without any recent
+    episode are dropped.
+    """
+    since_utc = to_aware_utc(since)
+
+    def is_recent(item: MediaItem) -> bool:
+        viewed_date = to_aware_utc(item.status.viewed_date)
+        return (
+            viewed_date is not None
+            and since_utc is not None
+            and viewed_date >= since_utc
+        )
+
+    return LibraryData(
+        title=library.title,
+        movies=[movie for movie in library.movies if is_recent(movie)],
+        series=[
+            Series(
+                identifiers=series.identifiers,
+                episodes=[episode for episode in series.episodes if is_recent(episode)],
+            )
+            for series in library.series
+            if any(is_recent(episode) for episode in series.episodes)
+        ],
+    )
+
+
 def compare_media_items(
     media1: MediaItem, media2: MediaItem, env: dict[str, str | float | None]
 ) -> Ord:
@@ -0,0 +1,365 @@
+import json
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from typing import Any, Callable, Literal
+from urllib.parse import parse_qs, urlparse
+from pydantic import BaseModel
+from loguru import logger
+
+from src.actions import build_actions
+from src.config import SyncConfig
+from src.connection import generate_server_connections
+from src.functions import get_env_value
+from src.library import filter_libaries
+from src.users import filter_user_lists
+from src.watched import UserData
+
+# Events that mean the watched status or playback position of an item changed
+PLEX_EVENTS = ["media.scrobble", "media.stop"]
+JELLYFIN_EVENTS = ["PlaybackStop", "UserDataSaved"]
+EMBY_EVENTS = ["playback.stop", "item.markplayed"]
+
+
+class WebhookEvent(BaseModel):
+    server_type: Literal["Plex", "Jellyfin", "Emby"]
+    server_id: str | None = None
+    event: str
+    user_name: str
+    user_id: str | None = None
+    item_id: str
+    # Live playback position in milliseconds, overrides the position stored on the server
+    position: int | None = None
+
+
+def get_multipart_field(body: bytes, content_type: str, field: str) -> bytes | None:
+    message = BytesParser(policy=default_policy).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    if not message.is_multipart():
+        return None
+
+    for part in message.iter_parts():
+        if part.get_param("name", header="content-disposition") == field:
+            payload = part.get_payload(decode=True)
+            # Nested multipart parts have no bytes payload of their own
+            return payload if isinstance(payload, bytes) else None
+
+    return None
+
+
+def parse_plex_webhook(body: bytes, content_type: str) -> WebhookEvent | None:
+    # Plex sends the json payload as a field of a multipart form
+    payload = get_multipart_field(body, content_type, "payload")
+    if payload is None:
+        payload = body
+
+    data: dict[str, Any] = json.loads(payload)
+    if data.get("event") not in PLEX_EVENTS:
+        logger.trace(f"Plex: Ignoring webhook event {data.get('event')}")
+        return None
+
+    metadata = data.get("Metadata", {})
+    if metadata.get("type") not in ["movie", "episode"]:
+        return None
+
+    return WebhookEvent(
+        server_type="Plex",
+        server_id=data.get("Server", {}).get("uuid"),
+        event=data["event"],
+        user_name=data.get("Account", {}).get("title", ""),
+        user_id=str(data.get("Account", {}).get("id", "")) or None,
+        item_id=str(metadata.get("ratingKey")),
+    )
+
+
+def parse_jellyfin_webhook(body: bytes) -> WebhookEvent | None:
+    # Default generic destination template of the jellyfin webhook plugin
+    data: dict[str, Any] = json.loads(body)
+    if data.get("NotificationType") not in JELLYFIN_EVENTS:
+        logger.trace(f"Jellyfin: Ignoring webhook event {data.get('NotificationType')}")
+        return None
+
+    if data.get("ItemType") not in ["Movie", "Episode"]:
+        return None
+
+    return WebhookEvent(
+        server_type="Jellyfin",
+        server_id=data.get("ServerId"),
+        event=data["NotificationType"],
+        user_name=data.get("NotificationUsername", ""),
+        user_id=data.get("UserId"),
+        item_id=data["ItemId"],
+    )
+
+
+def parse_emby_webhook(body: bytes, content_type: str) -> WebhookEvent | None:
+    # Older emby versions send the json payload as the data field of a multipart form
+    payload = get_multipart_field(body, content_type, "data")
+    if payload is None:
+        payload = body
+
+    data: dict[str, Any] = json.loads(payload)
+    if data.get("Event") not in EMBY_EVENTS:
+        logger.trace(f"Emby: Ignoring webhook event {data.get('Event')}")
+        return None
+
+    item = data.get("Item", {})
+    if item.get("Type") not in ["Movie", "Episode"]:
+        return None
+
+    return WebhookEvent(
+        server_type="Emby",
+        server_id=data.get("Server", {}).get("Id"),
+        event=data["Event"],
+        user_name=data.get("User", {}).get("Name", ""),
+        user_id=data.get("User", {}).get("Id"),
+        item_id=item["Id"],
+    )
+
+
+def parse_webhook(path: str, body: bytes, content_type: str) -> WebhookEvent | None:
+    if path == "/plex":
+        return parse_plex_webhook(body, content_type)
+    elif path == "/jellyfin":
+        return parse_jellyfin_webhook(body)
+    elif path == "/emby":
+        return parse_emby_webhook(body, content_type)
+
+    raise Exception(f"Unknown webhook path {path}")
+
+
+class WebhookQueue:
+    """
+    Debounces and coalesces webhook events. Events for the same item and user
+    replace each other and are only released once no new event arrived for
+    debounce seconds, so a burst of stop/scrobble events turns into a single sync.
+    """
+
+    def __init__(self, debounce: float) -> None:
+        self.debounce: float = debounce
+        self.pending: dict[
+            tuple[str, str | None, str, str], tuple[float, WebhookEvent]
+        ] = {}
+        self.condition = threading.Condition()
+
+    def put(self, event: WebhookEvent) -> None:
+        key = (
+            event.server_type,
+            event.server_id,
+            event.user_name.lower(),
+            event.item_id,
+        )
+        with self.condition:
+            if key in self.pending:
+                logger.debug(f"Webhook: Coalescing {event.event} for {key}")
+            self.pending[key] = (monotonic() + self.debounce, event)
+            self.condition.notify()
+
+    def get(self, timeout: float | None = None) -> WebhookEvent | None:
+        end = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            while True:
+                now = monotonic()
+                wait = None if end is None else end - now
+                if self.pending:
+                    key, (due, event) = min(
+                        self.pending.items(), key=lambda entry: entry[1][0]
+                    )
+                    if due <= now:
+                        del self.pending[key]
+                        return event
+                    wait = due - now if wait is None else min(wait, due - now)
+
+                if wait is not None and wait <= 0:
+                    return None
+
+                self.condition.wait(wait)
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.pending)
+
+
+class WebhookProcessor:
+    """
+    Resolves the item and user of a webhook event on the server that sent it and
+    pushes just that item to the other servers through their update_watched.
+    """
+
+    def __init__(
+        self,
+        env,
+        config: SyncConfig,
+        servers: list[Any],
+        should_sync: Callable[[Any, Any], bool],
+    ) -> None:
+        self.env = env
+        self.config: SyncConfig = config
+        self.servers: list[Any] = servers
+        self.should_sync: Callable[[Any, Any], bool] = should_sync
+
+    def find_server(self, event: WebhookEvent) -> Any | None:
+        servers = [
+            server for server in self.servers if server.server_type == event.server_type
+        ]
+        for server in servers:
+            if event.server_id and server.server_id == event.server_id:
+                return server
+
+        # Fallback to the only server of that type if the payload has no server id
+        if len(servers) == 1 and not event.server_id:
+            return servers[0]
+
+        return None
+
+    def process(self, event: WebhookEvent) -> None:
+        source = self.find_server(event)
+        if source is None:
+            logger.info(
+                f"Webhook: {event.server_type} server {event.server_id} not found, skipping"
+            )
+            return
+
+        result = source.get_item_watched(event.user_name, event.item_id, event.user_id)
+        if result is None:
+            return
+
+        user_name, library_title, library_type, library_data = result
+        if not library_data.movies and not library_data.series:
+            logger.debug(
+                f"Webhook: {event.item_id} for {user_name} has not been watched, skipping"
+            )
+            return
+
+        if event.position is not None:
+            items = library_data.movies + [
+                episode for series in library_data.series for episode in series.episodes
+            ]
+            # Only push live progress, never turn a watched item back into a partial one
+            if any(item.status.completed for item in items):
+                logger.debug(
+                    f"Webhook: {event.item_id} for {user_name} is already watched, skipping progress"
+                )
+                return
+
+            for item in items:
+                item.status.time = event.position
+
+        if not filter_user_lists(
+            {user_name: user_name},
+            self.config.blacklist_users,
+            self.config.whitelist_users,
+        ):
+            return
+
+        if not filter_libaries(
+            {library_title: library_type},
+            self.config.blacklist_library,
+            self.config.blacklist_library_type,
+            self.config.whitelist_library,
+            self.config.whitelist_library_type,
+            self.config.library_mapping,
+        ):
+            return
+
+        actions = build_actions(
+            {user_name.lower(): UserData(libraries={library_title: library_data})}
+        )
+        for target in self.servers:
+            if target is source or not self.should_sync(source, target):
+                continue
+
+            logger.info(
+                f"Webhook: Syncing {event.event} for {user_name} in {library_title} from {source.info()} -> {target.info()}"
+            )
+            target.update_watched(
+                actions,
+                self.config.user_mapping,
+                self.config.library_mapping,
+                self.config.dryrun,
+            )
+
+
+def create_webhook_server(
+    host: str, port: int, queue: WebhookQueue, token: str | None = None
+) -> ThreadingHTTPServer:
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            url = urlparse(self.path)
+            if token and parse_qs(url.query).get("token", [None])[0] != token:
+                self.send_response(403)
+                self.end_headers()
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                event = parse_webhook(
+                    url.path, body, self.headers.get("Content-Type", "")
+                )
+            except Exception as e:
+                logger.error(f"Webhook: Failed to parse {url.path} payload, Error: {e}")
+                self.send_response(400)
+                self.end_headers()
+                return
+
+            if event:
+                logger.debug(f"Webhook: Received {event}")
+                queue.put(event)
+
+            # Respond right away, the event is processed in the background
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format: str, *args: Any) -> None:
+            logger.trace(f"Webhook: {format % args}")
+
+    return ThreadingHTTPServer((host, port), WebhookHandler)
+
+
+def process_webhook_queue(
+    queue: WebhookQueue,
+    processor: WebhookProcessor,
+    stop: threading.Event | None = None,
+) -> None:
+    while stop is None or not stop.is_set():
+        event = queue.get(timeout=1)
+        if event is None:
+            continue
+
+        try:
+            processor.process(event)
+        except Exception as e:
+            logger.error(f"Webhook: Failed to process {event}, Error: {e}")
+
+
+def start_webhook_listener(
+    env,
+    config: SyncConfig,
+    should_sync: Callable[[Any, Any], bool],
+) -> ThreadingHTTPServer:
+    # The listener uses its own server connections so it never shares sessions with the sync loop
+    servers = generate_server_connections(env)
+
+    host = get_env_value(env, "WEBHOOK_HOST", "0.0.0.0")
+    port = int(get_env_value(env, "WEBHOOK_PORT", "8090"))
+    queue = WebhookQueue(float(get_env_value(env, "WEBHOOK_DEBOUNCE", "10")))
+    processor = WebhookProcessor(env, config, servers, should_sync)
+    webhook_server = create_webhook_server(
+        host, port, queue, get_env_value(env, "WEBHOOK_TOKEN", None)
+    )
+
+    threading.Thread(
+        target=webhook_server.serve_forever, name="webhook-server", daemon=True
+    ).start()
+    threading.Thread(
+        target=process_webhook_queue,
+        args=(queue, processor),
+        name="webhook-worker",
+        daemon=True,
+    ).start()
+    logger.info(f"Webhook: Listening on {host}:{port}")
+
+    return webhook_server
@@ -0,0 +1,396 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import ssl
+import struct
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable
+from time import monotonic
+from urllib.parse import urlparse
+from loguru import logger
+
+from src.config import SyncConfig
+from src.connection import generate_server_connections
+from src.functions import get_env_value
+from src.webhook import (
+    WebhookEvent,
+    WebhookProcessor,
+    WebhookQueue,
+    process_webhook_queue,
+)
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class WebSocketClient:
+    """
+    Minimal websocket client (RFC 6455) for the jellyfin and emby event socket,
+    only supports what these servers send: text frames, ping and close.
+    """
+
+    def __init__(
+        self, url: str, headers: dict[str, str] | None = None, timeout: float = 30
+    ) -> None:
+        self.url: str = url
+        self.headers: dict[str, str] = headers or {}
+        self.timeout: float = timeout
+        self.sock: socket.socket | None = None
+        self.buffer: bytes = b""
+
+    def connect(self) -> None:
+        url = urlparse(self.url)
+        secure = url.scheme == "wss"
+        port = url.port or (443 if secure else 80)
+        path = url.path or "/"
+        if url.query:
+            path += f"?{url.query}"
+
+        sock = socket.create_connection((url.hostname, port), timeout=self.timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(
+                sock, server_hostname=url.hostname
+            )
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = [
+            f"GET {path} HTTP/1.1",
+            f"Host: {url.netloc}",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            f"Sec-WebSocket-Key: {key}",
+            "Sec-WebSocket-Version: 13",
+        ]
+        request += [f"{name}: {value}" for name, value in self.headers.items()]
+        sock.sendall(("\r\n".join(request) + "\r\n\r\n").encode())
+
+        response = b""
+        while b"\r\n\r\n" not in response:
+            data = sock.recv(4096)
+            if not data:
+                sock.close()
+                raise WebSocketClosed("Connection closed during handshake")
+            response += data
+
+        header, self.buffer = response.split(b"\r\n\r\n", 1)
+        lines = header.decode(errors="replace").split("\r\n")
+        if len(lines[0].split(" ")) < 2 or lines[0].split(" ")[1] != "101":
+            sock.close()
+            raise Exception(f"Websocket handshake failed: {lines[0]}")
+
+        headers = {
+            name.strip().lower(): value.strip()
+            for name, value in (line.split(":", 1) for line in lines[1:] if ":" in line)
+        }
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+        if headers.get("sec-websocket-accept") != accept:
+            sock.close()
+            raise Exception("Websocket handshake failed: invalid Sec-WebSocket-Accept")
+
+        self.sock = sock
+
+    def read_exact(self, size: int) -> bytes:
+        if self.sock is None:
+            raise WebSocketClosed("Not connected")
+
+        while len(self.buffer) < size:
+            data = self.sock.recv(max(4096, size - len(self.buffer)))
+            if not data:
+                raise WebSocketClosed("Connection closed")
+            self.buffer += data
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send_frame(self, opcode: int, payload: bytes = b"") -> None:
+        if self.sock is None:
+            raise WebSocketClosed("Not connected")
+
+        # Frames sent by a client always have to be masked
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 2**16:
+            header += bytes([0x80 | 126]) + struct.pack("!H", length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def send(self, message: str) -> None:
+        self.send_frame(OPCODE_TEXT, message.encode())
+
+    def recv_frame(self) -> tuple[bool, int, bytes]:
+        first, second = self.read_exact(2)
+        try:
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", self.read_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self.read_exact(8))[0]
+
+            mask = self.read_exact(4) if second & 0x80 else None
+            payload = self.read_exact(length)
+        except TimeoutError:
+            # The start of the frame is already consumed so the stream can not be resumed
+            raise WebSocketClosed("Timed out in the middle of a frame")
+        if mask:
+            payload = bytes(
+                byte ^ mask[index % 4] for index, byte in enumerate(payload)
+            )
+
+        return bool(first & 0x80), first & 0x0F, payload
+
+    def recv(self) -> str:
+        """
+        Receive the next text message, answering pings along the way.
+        Raises TimeoutError if nothing arrived within the timeout and
+        WebSocketClosed once the server closed the connection.
+        """
+        message = b""
+        while True:
+            final, opcode, payload = self.recv_frame()
+            if opcode == OPCODE_PING:
+                self.send_frame(OPCODE_PONG, payload)
+                continue
+            elif opcode == OPCODE_PONG:
+                continue
+            elif opcode == OPCODE_CLOSE:
+                # Answer with the status code of the server, it closes the socket
+                self.close(payload[:2], wait=False)
+                raise WebSocketClosed("Connection closed by server")
+
+            message += payload
+            if final:
+                return message.decode(errors="replace")
+
+    def close(self, status: bytes = struct.pack("!H", 1000), wait: bool = True) -> None:
+        """
+        Send a close frame and close the socket. When the client starts the closing
+        handshake it waits a short while for the close frame of the server.
+        """
+        if self.sock is None:
+            return
+
+        try:
+            self.send_frame(OPCODE_CLOSE, status)
+            if wait:
+                self.sock.settimeout(min(self.timeout, 5))
+                while self.recv_frame()[1] != OPCODE_CLOSE:
+                    pass
+        except (OSError, WebSocketClosed):
+            pass
+
+        self.sock.close()
+        self.sock = None
+
+
+def parse_user_data_message(server: Any, message: dict[str, Any]) -> list[WebhookEvent]:
+    """
+    Turn a UserDataChanged socket message into one event per changed item,
+    the user id is resolved to a name with the users already known for the server.
+    """
+    if message.get("MessageType") != "UserDataChanged":
+        return []
+
+    data = message.get("Data") or {}
+    user_id = data.get("UserId")
+    user_name = next((name for name, id in server.users.items() if id == user_id), None)
+    if user_name is None:
+        logger.debug(f"{server.server_type}: User {user_id} not found, skipping")
+        return []
+
+    return [
+        WebhookEvent(
+            server_type=server.server_type,
+            server_id=server.server_id,
+            event="UserDataChanged",
+            user_name=user_name,
+            user_id=user_id,
+            item_id=user_data["ItemId"],
+        )
+        for user_data in data.get("UserDataList", [])
+        if user_data.get("ItemId")
+    ]
+
+
+class UserDataListener:
+    """
+    Listens on the websocket of a jellyfin or emby server for UserDataChanged
+    messages and queues a sync for every changed item. The socket is reconnected
+    with backoff and while it is down the recently played items are polled instead
+    so no change is missed.
+    """
+
+    def __init__(
+        self,
+        server: Any,
+        queue: WebhookQueue,
+        poll_interval: float = 60,
+        retry_interval: float = 5,
+        max_retry_interval: float = 300,
+    ) -> None:
+        self.server: Any = server
+        self.queue: WebhookQueue = queue
+        self.poll_interval: float = poll_interval
+        self.retry_interval: float = retry_interval
+        self.max_retry_interval: float = max_retry_interval
+        self.failures: int = 0
+        # Last time the socket was known to be up, polling picks up changes after it
+        self.last_seen: datetime = datetime.now(timezone.utc)
+        self.stop_event = threading.Event()
+        self.socket: WebSocketClient | None = None
+
+    def listen(self) -> None:
+        self.socket = WebSocketClient(
+            self.server.get_socket_url(), timeout=self.poll_interval
+        )
+        self.socket.connect()
+        self.failures = 0
+        logger.info(f"{self.server.server_type}: Connected to websocket")
+
+        # Changes made while the socket was down are only picked up by polling
+        self.poll()
+
+        keep_alive_interval: float | None = None
+        last_keep_alive = monotonic()
+        while not self.stop_event.is_set():
+            # A busy socket never times out, so the keep alive is sent on its own clock
+            if (
+                keep_alive_interval is not None
+                and monotonic() - last_keep_alive >= keep_alive_interval
+            ):
+                self.socket.send(json.dumps({"MessageType": "KeepAlive"}))
+                last_keep_alive = monotonic()
+
+            try:
+                message = json.loads(self.socket.recv())
+            except TimeoutError:
+                self.last_seen = datetime.now(timezone.utc)
+                continue
+
+            self.last_seen = datetime.now(timezone.utc)
+            if message.get("MessageType") == "ForceKeepAlive":
+                # The server drops the connection if no keep alive is sent within Data seconds
+                keep_alive_interval = float(message.get("Data") or 60) / 2
+                if self.socket.sock:
+                    # Wake up often enough to send the keep alive in time on a quiet socket
+                    self.socket.sock.settimeout(
+                        min(keep_alive_interval / 2, self.poll_interval)
+                    )
+                self.socket.send(json.dumps({"MessageType": "KeepAlive"}))
+                last_keep_alive = monotonic()
+                continue
+
+            for event in parse_user_data_message(self.server, message):
+                logger.debug(f"{self.server.server_type}: Received {event}")
+                self.queue.put(event)
+
+    def poll(self) -> None:
+        now = datetime.now(timezone.utc)
+        for user_name, user_id, item_id in self.server.get_recent_user_data(
+            self.last_seen
+        ):
+            self.queue.put(
+                WebhookEvent(
+                    server_type=self.server.server_type,
+                    server_id=self.server.server_id,
+                    event="UserDataPolled",
+                    user_name=user_name,
+                    user_id=user_id,
+                    item_id=item_id,
+                )
+            )
+        self.last_seen = now
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                self.listen()
+            except Exception as e:
+                if self.stop_event.is_set():
+                    break
+
+                self.failures += 1
+                logger.warning(
+                    f"{self.server.server_type}: Websocket disconnected {self.failures} times, Error: {e}"
+                )
+            finally:
+                if self.socket:
+                    self.socket.close()
+                    self.socket = None
+
+            # Fall back to polling until it is time to reconnect
+            delay = min(
+                self.max_retry_interval, self.retry_interval * 2 ** (self.failures - 1)
+            )
+            end = monotonic() + delay
+            while not self.stop_event.is_set():
+                try:
+                    self.poll()
+                except Exception as e:
+                    logger.error(
+                        f"{self.server.server_type}: Failed to poll user data, Error: {e}"
+                    )
+
+                remaining = end - monotonic()
+                if remaining <= 0:
+                    break
+                self.stop_event.wait(min(self.poll_interval, remaining))
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.socket and self.socket.sock:
+            self.socket.sock.close()
+
+
+def start_websocket_listeners(
+    env,
+    config: SyncConfig,
+    should_sync: Callable[[Any, Any], bool],
+) -> list[UserDataListener]:
+    # Like the webhook listener the websocket listeners use their own server connections
+    servers = generate_server_connections(env)
+
+    queue = WebhookQueue(float(get_env_value(env, "WEBSOCKET_DEBOUNCE", "30")))
+    processor = WebhookProcessor(env, config, servers, should_sync)
+    poll_interval = float(get_env_value(env, "WEBSOCKET_POLL_INTERVAL", "60"))
+
+    listeners: list[UserDataListener] = []
+    for server in servers:
+        if server.server_type not in ["Jellyfin", "Emby"]:
+            continue
+
+        listener = UserDataListener(server, queue, poll_interval)
+        threading.Thread(
+            target=listener.run,
+            name=f"websocket-{server.server_type}-{server.server_id}",
+            daemon=True,
+        ).start()
+        listeners.append(listener)
+
+    if listeners:
+        threading.Thread(
+            target=process_webhook_queue,
+            args=(queue, processor),
+            name="websocket-worker",
+            daemon=True,
+        ).start()
+
+    return listeners
@@ -0,0 +1,98 @@
+import argparse
+import os
+import sys
+from time import perf_counter
+from loguru import logger
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from benchmark_pipeline import LIBRARIES, SyntheticServer
+from src.diff import cleanup_watched_parallel
+from src.watched import UserData, cleanup_watched
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare the time of cleanup_watched with diffing every user library in a pool of processes (DIFF_PROCESSES)"
+    )
+    parser.add_argument("--users", type=int, default=32, help="Users on both servers")
+    parser.add_argument(
+        "--movies", type=int, default=2000, help="Watched movies per user"
+    )
+    parser.add_argument(
+        "--shows",
+        type=int,
+        default=100,
+        help="Watched shows per user, 20 episodes each",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Highest number of diff processes to measure",
+    )
+    parser.add_argument(
+        "--skip-serial",
+        action="store_true",
+        help="Skip cleanup_watched, which compares every item with every item",
+    )
+
+    return parser.parse_args()
+
+
+def generate_watched(
+    users: int, movies: int, shows: int, step: int
+) -> dict[str, UserData]:
+    server = SyntheticServer("Jellyfin", f"server{step}", movies, shows, step)
+    return server.get_watched([f"user{index}" for index in range(users)], LIBRARIES)
+
+
+def run_benchmark(
+    users: int, movies: int, shows: int, processes: int, serial: bool = True
+) -> dict[str, float]:
+    env = {"DRYRUN": "True"}
+    watched_list_1 = generate_watched(users, movies, shows, 1)
+    watched_list_2 = generate_watched(users, movies, shows, 2)
+    results = {}
+
+    if serial:
+        start = perf_counter()
+        cleanup_watched(watched_list_1, watched_list_2, env)
+        results["cleanup_watched"] = perf_counter() - start
+
+    count = 1
+    while count <= processes:
+        # Start the pool outside of the measured time
+        cleanup_watched_parallel(watched_list_1, watched_list_2, env, processes=count)
+        start = perf_counter()
+        cleanup_watched_parallel(watched_list_1, watched_list_2, env, processes=count)
+        results[f"{count} processes"] = perf_counter() - start
+        count *= 2
+
+    return results
+
+
+def main():
+    args = parse_args()
+    logger.remove()
+
+    results = run_benchmark(
+        args.users, args.movies, args.shows, args.processes, not args.skip_serial
+    )
+    baseline = results["1 processes"]
+    for mode, elapsed in results.items():
+        print(f"{mode}: {elapsed:.2f} seconds, {baseline / elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
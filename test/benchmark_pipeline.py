@@ -0,0 +1,195 @@
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+from loguru import logger
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.config import SyncConfig
+from src.main import sync_users_pipeline, sync_watched
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    Series,
+    UserData,
+    WatchedStatus,
+)
+
+LIBRARIES = ["Movies", "TV Shows"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare the peak memory of syncing all users at once with syncing one user at a time (SYNC_PER_USER)"
+    )
+    parser.add_argument("--users", type=int, default=50, help="Users on both servers")
+    parser.add_argument(
+        "--movies", type=int, default=1000, help="Watched movies per user"
+    )
+    parser.add_argument(
+        "--shows", type=int, default=50, help="Watched shows per user, 20 episodes each"
+    )
+
+    return parser.parse_args()
+
+
+class SyntheticServer:
+    """
+    Server that generates the watched history of every user on request, server 1
+    has everything watched and server 2 only every other item.
+    """
+
+    def __init__(
+        self, server_type: str, name: str, movies: int, shows: int, step: int
+    ) -> None:
+        self.server_type = server_type
+        self.base_url = f"http://{name}:8096"
+        self.movies = movies
+        self.shows = shows
+        self.step = step
+        self.writes = 0
+
+    def info(self) -> str:
+        return f"{self.server_type} {self.base_url}"
+
+    def generate_library(self, user_name: str, title: str) -> LibraryData:
+        viewed_date = datetime(2024, 1, 1) + timedelta(days=len(user_name))
+        status = WatchedStatus(completed=True, time=0, viewed_date=viewed_date)
+        library = LibraryData(title=title)
+        if title == "Movies":
+            for index in range(0, self.movies, self.step):
+                library.movies.append(
+                    MediaItem(
+                        identifiers=MediaIdentifiers(
+                            title=f"{user_name} Movie {index}",
+                            locations=(f"{user_name} Movie {index}.mkv",),
+                            imdb_id=f"tt{index:07d}",
+                        ),
+                        status=status,
+                    )
+                )
+        else:
+            for index in range(0, self.shows, self.step):
+                library.series.append(
+                    Series(
+                        identifiers=MediaIdentifiers(
+                            title=f"Show {index}",
+                            locations=(f"Show {index}",),
+                            tvdb_id=str(index),
+                        ),
+                        episodes=[
+                            MediaItem(
+                                identifiers=MediaIdentifiers(
+                                    title=f"Episode {episode}",
+                                    locations=(f"Show {index} S01E{episode:02d}.mkv",),
+                                ),
+                                status=status,
+                            )
+                            for episode in range(20)
+                        ],
+                    )
+                )
+
+        return library
+
+    def get_watched(
+        self, users, sync_libraries, users_watched=None, checkpoint=None, since=None
+    ):
+        users_watched = users_watched or {}
+        for user_name in users:
+            users_watched[user_name.lower()] = UserData(
+                libraries={
+                    title: self.generate_library(user_name, title)
+                    for title in sync_libraries
+                }
+            )
+
+        return users_watched
+
+    def update_watched(self, actions, user_mapping, library_mapping, dryrun):
+        self.writes += len(actions)
+
+
+def setup_servers(users: int, movies: int, shows: int):
+    server_1 = SyntheticServer("Jellyfin", "server1", movies, shows, 1)
+    server_2 = SyntheticServer("Emby", "server2", movies, shows, 2)
+    user_list = {f"user{index}": str(index) for index in range(users)}
+    return server_1, server_2, user_list
+
+
+def measure(sync, *args) -> tuple[int, int]:
+    """
+    Returns the peak traced memory in bytes and the result of the sync.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = sync(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak, result
+
+
+def run_benchmark(users: int, movies: int, shows: int) -> dict[str, tuple[int, int]]:
+    env = {"DRYRUN": "True"}
+    config = SyncConfig(dryrun=True)
+    results = {}
+
+    server_1, server_2, user_list = setup_servers(users, movies, shows)
+    peak, (_, changes) = measure(
+        sync_watched,
+        env,
+        config,
+        server_1,
+        server_2,
+        user_list,
+        dict(user_list),
+        LIBRARIES,
+        LIBRARIES,
+    )
+    results["all users"] = (peak, changes)
+
+    server_1, server_2, user_list = setup_servers(users, movies, shows)
+    peak, changes = measure(
+        sync_users_pipeline,
+        env,
+        config,
+        server_1,
+        server_2,
+        user_list,
+        dict(user_list),
+        LIBRARIES,
+        LIBRARIES,
+    )
+    results["per user"] = (peak, changes)
+
+    return results
+
+
+def main():
+    args = parse_args()
+    logger.remove()
+
+    results = run_benchmark(args.users, args.movies, args.shows)
+    for mode, (peak, changes) in results.items():
+        print(f"{mode}: peak {peak / 1024 / 1024:.1f} MiB, {changes} changes")
+
+
+if __name__ == "__main__":
+    main()
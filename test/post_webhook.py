@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+import requests
+from loguru import logger
+
+PAYLOAD_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "webhook_payloads"
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Post recorded webhook payloads to a running webhook listener to test near real time sync locally"
+    )
+    parser.add_argument(
+        "payloads",
+        nargs="*",
+        help="Payload files to post, defaults to every file in test/webhook_payloads",
+    )
+    parser.add_argument(
+        "--url",
+        default="http://localhost:8090",
+        help="Base url of the webhook listener",
+    )
+    parser.add_argument("--token", default=None, help="WEBHOOK_TOKEN of the listener")
+
+    return parser.parse_args()
+
+
+def post_payload(url: str, path: str, token: str | None = None) -> requests.Response:
+    name = os.path.basename(path)
+    params = {"token": token} if token else None
+
+    with open(path, "rb") as f:
+        payload = f.read()
+
+    if name.startswith("plex"):
+        # Plex posts the payload as a field of a multipart form
+        return requests.post(
+            f"{url}/plex",
+            params=params,
+            files={"payload": (None, payload, "application/json")},
+        )
+    elif name.startswith("jellyfin"):
+        return requests.post(
+            f"{url}/jellyfin",
+            params=params,
+            data=payload,
+            headers={"Content-Type": "application/json"},
+        )
+    elif name.startswith("emby"):
+        return requests.post(
+            f"{url}/emby",
+            params=params,
+            data=payload,
+            headers={"Content-Type": "application/json"},
+        )
+
+    raise Exception(
+        f"Unknown payload {name}, file name must start with plex, jellyfin or emby"
+    )
+
+
+def main():
+    args = parse_args()
+    payloads = args.payloads or [
+        os.path.join(PAYLOAD_DIR, name) for name in sorted(os.listdir(PAYLOAD_DIR))
+    ]
+
+    failed = False
+    for path in payloads:
+        response = post_payload(args.url, path, args.token)
+        if response.ok:
+            logger.info(f"Posted {path}, status {response.status_code}")
+        else:
+            logger.error(f"Failed to post {path}, status {response.status_code}")
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
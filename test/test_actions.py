@@ -0,0 +1,306 @@
+from datetime import datetime, timedelta
+import sys
+import os
+from loguru import logger
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.actions import (
+    PendingWrites,
+    build_actions,
+    group_actions,
+    group_series_actions,
+    is_satisfied,
+    log_action_results,
+)
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    Series,
+    UserData,
+    WatchedStatus,
+)
+
+viewed_date = datetime.today()
+
+
+def media_item(title: str, completed: bool = True, time: int = 0) -> MediaItem:
+    return MediaItem(
+        identifiers=MediaIdentifiers(title=title, locations=(f"{title}.mkv",)),
+        status=WatchedStatus(completed=completed, time=time, viewed_date=viewed_date),
+    )
+
+
+def series(title: str, episodes: list[MediaItem]) -> Series:
+    return Series(
+        identifiers=MediaIdentifiers(title=title, locations=(title,)),
+        episodes=episodes,
+    )
+
+
+watched_list = {
+    "user1": UserData(
+        libraries={
+            "Movies": LibraryData(
+                title="Movies",
+                movies=[
+                    media_item("Big Buck Bunny"),
+                    media_item("Sintel", completed=False, time=300_000),
+                ],
+            ),
+            "TV Shows": LibraryData(
+                title="TV Shows",
+                series=[
+                    series("Doctor Who", [media_item("S01E01"), media_item("S01E02")]),
+                    series("Monarch", [media_item("S01E01", False, 60_000)]),
+                ],
+            ),
+        }
+    ),
+    "user2": UserData(
+        libraries={
+            "Movies": LibraryData(title="Movies", movies=[media_item("Tears of Steel")])
+        }
+    ),
+}
+
+
+def test_build_actions():
+    actions = build_actions(watched_list)
+    assert len(actions) == 6
+    assert [action.action for action in actions] == [
+        "mark_watched",
+        "set_position",
+        "mark_watched",
+        "mark_watched",
+        "set_position",
+        "mark_watched",
+    ]
+
+    sintel = actions[1]
+    assert (sintel.user, sintel.library) == ("user1", "Movies")
+    assert sintel.identifiers.title == "Sintel"
+    assert sintel.series is None
+    assert sintel.position == 300_000
+
+    monarch = actions[4]
+    assert monarch.series.title == "Monarch"
+    assert monarch.position == 60_000
+    assert monarch.target_id is None
+
+    assert build_actions({}) == []
+    assert build_actions({"user1": UserData()}) == []
+
+
+def test_is_satisfied():
+    watched, partial = build_actions(watched_list)[:2]
+    assert is_satisfied(watched, completed=True, position=0)
+    assert not is_satisfied(watched, completed=False, position=300_000)
+
+    assert is_satisfied(partial, completed=False, position=305_000)
+    assert not is_satisfied(partial, completed=False, position=200_000)
+    assert not is_satisfied(partial, completed=True, position=0)
+
+
+def test_group_actions():
+    actions = build_actions(watched_list)
+    grouped = group_actions(actions)
+    assert set(grouped) == {"user1", "user2"}
+    assert set(grouped["user1"]) == {"Movies", "TV Shows"}
+    assert len(grouped["user1"]["Movies"]) == 2
+    assert len(grouped["user1"]["TV Shows"]) == 3
+    assert grouped["user2"]["Movies"][0].identifiers.title == "Tears of Steel"
+
+
+def test_group_actions_recent_first():
+    def item(title: str, days: int) -> MediaItem:
+        return MediaItem(
+            identifiers=MediaIdentifiers(title=title, locations=(f"{title}.mkv",)),
+            status=WatchedStatus(
+                completed=True, time=0, viewed_date=viewed_date - timedelta(days=days)
+            ),
+        )
+
+    actions = build_actions(
+        {
+            "old": UserData(
+                libraries={
+                    "Movies": LibraryData(
+                        title="Movies", movies=[item("Metropolis", 3000)]
+                    )
+                }
+            ),
+            "recent": UserData(
+                libraries={
+                    "Movies": LibraryData(
+                        title="Movies", movies=[item("Old", 400), item("New", 0)]
+                    ),
+                    "TV Shows": LibraryData(
+                        title="TV Shows",
+                        series=[
+                            series("Doctor Who", [item("S01E01", 200)]),
+                            series("Monarch", [item("S01E01", 10), item("S01E02", 1)]),
+                        ],
+                    ),
+                }
+            ),
+        }
+    )
+
+    grouped = group_actions(actions)
+    assert list(grouped) == ["recent", "old"]
+    assert list(grouped["recent"]) == ["Movies", "TV Shows"]
+    assert [action.identifiers.title for action in grouped["recent"]["Movies"]] == [
+        "New",
+        "Old",
+    ]
+
+    shows = group_series_actions(grouped["recent"]["TV Shows"])
+    assert [show.title for show, _ in shows] == ["Monarch", "Doctor Who"]
+    assert [action.identifiers.title for action in shows[0][1]] == [
+        "S01E02",
+        "S01E01",
+    ]
+
+
+def test_group_series_actions():
+    actions = build_actions(watched_list)
+    grouped = group_series_actions(actions)
+    assert [series.title for series, _ in grouped] == ["Doctor Who", "Monarch"]
+    assert [len(episode_actions) for _, episode_actions in grouped] == [2, 1]
+
+    # Movies are not part of any series
+    assert group_series_actions(group_actions(actions)["user2"]["Movies"]) == []
+
+
+class FakeServer:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.updates = []
+
+    def info(self) -> str:
+        return self.name
+
+    def update_watched(self, actions, user_mapping, library_mapping, dryrun):
+        self.updates.append(actions)
+        for action in actions:
+            action.target_id = action.identifiers.title
+            action.outcome = (
+                "satisfied" if action.action == "set_position" else "written"
+            )
+
+
+def movie_watched(user: str, movie: MediaItem) -> dict[str, UserData]:
+    return {
+        user: UserData(
+            libraries={"Movies": LibraryData(title="Movies", movies=[movie])}
+        )
+    }
+
+
+def test_pending_writes():
+    jellyfin = FakeServer("jellyfin")
+    plex = FakeServer("plex")
+    pending = PendingWrites({}, user_mapping={"plexuser": "jellyuser"})
+
+    partial = media_item("Sintel", completed=False, time=300_000)
+    partial.identifiers.imdb_id = "tt1727587"
+    partial.status.viewed_date = viewed_date - timedelta(days=1)
+    pending.add(jellyfin, build_actions(movie_watched("plexuser", partial)))
+
+    # The same movie from another source, matched by guid through the user mapping
+    watched = media_item("Sintel")
+    watched.identifiers.locations = ()
+    watched.identifiers.imdb_id = "tt1727587"
+    pending.add(jellyfin, build_actions(movie_watched("jellyuser", watched)))
+    assert pending.dropped == 1
+
+    # The older state does not replace the winner
+    pending.add(jellyfin, build_actions(movie_watched("plexuser", partial)))
+    assert pending.dropped == 2
+
+    # Other targets are independent
+    pending.add(plex, build_actions(movie_watched("jellyuser", partial)))
+    assert pending.dropped == 2
+
+    # Same episode file name in a show is a different item
+    pending.add(
+        jellyfin,
+        build_actions(
+            {
+                "plexuser": UserData(
+                    libraries={
+                        "Movies": LibraryData(
+                            title="Movies",
+                            series=[series("Sintel", [media_item("Sintel")])],
+                        )
+                    }
+                )
+            }
+        ),
+    )
+    assert pending.dropped == 2
+
+    # The partially watched movie on plex is already up to date
+    assert pending.flush(dryrun=False) == 2
+    assert len(jellyfin.updates) == 1
+    actions = jellyfin.updates[0]
+    assert len(actions) == 2
+    # The most recent state wins
+    assert actions[0].action == "mark_watched"
+    assert actions[0].user == "jellyuser"
+    assert actions[1].series.title == "Sintel"
+    assert plex.updates[0][0].action == "set_position"
+
+    assert pending.flush(dryrun=False) == 0
+
+
+def test_log_action_results():
+    actions = build_actions(
+        {
+            "user": UserData(
+                libraries={
+                    "Movies": LibraryData(
+                        title="Movies",
+                        movies=[
+                            MediaItem(
+                                identifiers=MediaIdentifiers(title=title),
+                                status=WatchedStatus(
+                                    completed=True, time=0, viewed_date=viewed_date
+                                ),
+                            )
+                            for title in ["A", "B", "C", "D", "E", "F"]
+                        ],
+                    )
+                }
+            )
+        }
+    )
+    # Written, up to date, skipped by the ledger, failed, dry run and not found
+    for action, outcome in zip(
+        actions, ["written", "satisfied", "skipped", "failed", None]
+    ):
+        action.target_id = action.identifiers.title
+        action.outcome = outcome
+
+    messages: list[str] = []
+    handler = logger.add(lambda message: messages.append(message.record["message"]))
+    try:
+        log_action_results(actions, "Plex")
+    finally:
+        logger.remove(handler)
+
+    assert messages == [
+        "Plex: 1 actions written, 1 already up to date, 2 skipped, 1 failed, 1 not found"
+    ]
@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta, timezone
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.activity import (
+    filter_idle_user_lists,
+    full_sync_due,
+    is_user_idle,
+    order_users_by_activity,
+    save_activity,
+    setup_activity,
+)
+from src.cache import MetadataCache
+from src.jellyfin import Jellyfin
+
+now = datetime.now(timezone.utc)
+
+
+def test_is_user_idle():
+    last_sync = now.isoformat()
+
+    assert is_user_idle(now - timedelta(hours=1), last_sync)
+    assert not is_user_idle(now + timedelta(minutes=1), last_sync)
+
+    # Missing information is treated as activity
+    assert not is_user_idle(None, last_sync)
+    assert not is_user_idle(now - timedelta(hours=1), None)
+
+    # Naive dates are treated as UTC
+    assert is_user_idle((now - timedelta(hours=1)).replace(tzinfo=None), last_sync)
+
+
+def test_filter_idle_user_lists():
+    users = {"luigi311": "luigi311", "test": "test2", "test3": "test3"}
+
+    # Users are only skipped when idle on both servers
+    filtered = filter_idle_user_lists(
+        users, {"luigi311", "test", "test3"}, {"luigi311", "test2"}
+    )
+
+    assert filtered == {"test3": "test3"}
+
+
+def test_full_sync_due():
+    assert full_sync_due({"full_sync": {}}, 3600, now)
+    assert not full_sync_due(
+        {"full_sync": {"all": (now - timedelta(minutes=10)).isoformat()}}, 3600, now
+    )
+    assert full_sync_due(
+        {"full_sync": {"all": (now - timedelta(hours=2)).isoformat()}}, 3600, now
+    )
+
+    # Full syncs are tracked separately for every key
+    assert full_sync_due(
+        {"full_sync": {"all": (now - timedelta(minutes=10)).isoformat()}},
+        3600,
+        now,
+        "plex <-> jellyfin",
+    )
+
+
+def test_setup_activity_sync_window(tmp_path):
+    activity_file = str(tmp_path / "activity.json")
+
+    assert setup_activity({}, now) == (None, True)
+
+    # The sync window tracks full passes without skipping idle users
+    env = {"SYNC_WINDOW": "86400", "ACTIVITY_FILE": activity_file}
+    state, full_sync = setup_activity(env, now)
+    assert state is not None
+    assert full_sync
+
+    # Until FULL_SYNC_INTERVAL has passed only the window is synced
+    save_activity(env, state, full_sync, now - timedelta(minutes=10))
+    _, full_sync = setup_activity(env, now)
+    assert not full_sync
+
+
+class FakeServer:
+    def __init__(self, activity):
+        self.activity = activity
+
+    def get_users_activity(self, since=None):
+        return self.activity
+
+
+class FakePlexUser:
+    def __init__(self, username: str) -> None:
+        self.username = username
+        self.title = username
+
+
+def test_order_users_by_activity():
+    server = FakeServer(
+        {
+            "Luigi311": now - timedelta(days=400),
+            "test": now - timedelta(minutes=5),
+            # Naive dates are treated as UTC
+            "test2": (now - timedelta(hours=1)).replace(tzinfo=None),
+        }
+    )
+
+    users = {"luigi311": "1", "unknown": "2", "test2": "3", "test": "4"}
+    ordered = order_users_by_activity(server, users, now)
+    assert ordered == users
+    assert list(ordered) == ["test", "test2", "luigi311", "unknown"]
+
+    plex_users = [
+        FakePlexUser("unknown"),
+        FakePlexUser("luigi311"),
+        FakePlexUser("test"),
+    ]
+    ordered = order_users_by_activity(server, plex_users, now)
+    assert [user.username for user in ordered] == ["test", "luigi311", "unknown"]
+
+
+def test_jellyfin_activity_with_cached_users():
+    responses = [
+        [{"Name": "JellyUser", "Id": "1", "LastActivityDate": "2024-09-01T10:00:00Z"}],
+        [{"Name": "JellyUser", "Id": "1", "LastActivityDate": "2024-09-02T10:00:00Z"}],
+    ]
+    server = Jellyfin.__new__(Jellyfin)
+    server.server_type = "Jellyfin"
+    server.cache = MetadataCache("Jellyfin")
+    server.users_activity = {}
+    server.query = lambda query, query_type: responses.pop(0)
+
+    server.users = server.cache.get("users", server.get_users)
+    assert server.get_users_activity() == {
+        "JellyUser": datetime(2024, 9, 1, 10, tzinfo=timezone.utc)
+    }
+
+    # The next run keeps the cached user list but sees the new activity
+    server.refresh()
+    assert server.users == {"JellyUser": "1"}
+    assert server.get_users_activity() == {
+        "JellyUser": datetime(2024, 9, 2, 10, tzinfo=timezone.utc)
+    }
+    assert responses == []
@@ -0,0 +1,109 @@
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from benchmark_pipeline import LIBRARIES, setup_servers
+from src.budget import RunBudget
+from src.config import SyncConfig
+from src.main import sync_users_pipeline
+
+
+class FakeServer:
+    def __init__(self, base_url: str) -> None:
+        self.server_type = "Jellyfin"
+        self.base_url = base_url
+
+
+class FakePlexUser:
+    def __init__(self, username: str) -> None:
+        self.username = username
+        self.title = username
+
+
+def test_budget_exhausted():
+    budget = RunBudget(100, reserve=20)
+    assert budget.reserve == 20
+    assert not budget.exhausted()
+
+    budget.started -= 85
+    assert budget.exhausted()
+    assert RunBudget(100).reserve == 20
+
+
+def test_budget_carry_over(tmp_path):
+    path = str(tmp_path / "deferred.json")
+    jellyfin = FakeServer("http://jellyfin:8096")
+    plex = FakeServer("http://plex:32400")
+    emby = FakeServer("http://emby:8096")
+
+    budget = RunBudget(100, path=path)
+    budget.defer_pair(plex, emby)
+    budget.defer_users(jellyfin, ["user3", "user4"])
+    budget.defer_users(plex, ["plex3"])
+    assert budget.is_deferred(jellyfin, "User3")
+    assert not budget.is_deferred(plex, "user3")
+    assert budget.has_deferred()
+    budget.save()
+
+    # The next run starts with whatever was deferred
+    budget = RunBudget(100, path=path)
+    assert not budget.has_deferred()
+    assert budget.prioritize_pairs([(jellyfin, plex), (plex, emby)]) == [
+        (plex, emby),
+        (jellyfin, plex),
+    ]
+    users = {"user1": "1", "User4": "4", "user2": "2", "user3": "3"}
+    assert list(budget.prioritize_users(jellyfin, users)) == [
+        "User4",
+        "user3",
+        "user1",
+        "user2",
+    ]
+    plex_users = [FakePlexUser("plex1"), FakePlexUser("plex3")]
+    assert [user.username for user in budget.prioritize_users(plex, plex_users)] == [
+        "plex3",
+        "plex1",
+    ]
+    assert budget.prioritize_users(emby, users) == users
+
+    # Nothing left to do removes the file
+    budget.save()
+    assert not os.path.exists(path)
+
+
+def test_pipeline_defers_users():
+    server_1, server_2, users = setup_servers(4, 10, 1)
+    budget = RunBudget(100)
+    checks = iter([False, False, True])
+    budget.exhausted = lambda: next(checks)
+
+    changes = sync_users_pipeline(
+        {},
+        SyncConfig(dryrun=True),
+        server_1,
+        server_2,
+        users,
+        dict(users),
+        LIBRARIES,
+        LIBRARIES,
+        budget=budget,
+    )
+
+    # Two users were synced before the budget ran low, every movie of server 1
+    # that server 2 is missing was written
+    assert changes == server_1.writes + server_2.writes == 2 * 5
+    assert budget.deferred_users == {
+        "Jellyfin:http://server1:8096": ["user2", "user3"],
+        "Emby:http://server2:8096": ["user2", "user3"],
+    }
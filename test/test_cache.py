@@ -0,0 +1,72 @@
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.cache import MetadataCache
+
+
+def test_metadata_cache():
+    calls: list[str] = []
+
+    def fetch_libraries() -> dict[str, str]:
+        calls.append("libraries")
+        return {"Movies": "movies"}
+
+    cache = MetadataCache("Jellyfin")
+
+    assert cache.get("libraries", fetch_libraries) == {"Movies": "movies"}
+    assert cache.get("libraries", fetch_libraries) == {"Movies": "movies"}
+    assert calls == ["libraries"]
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+    # Clearing the cache forces the next lookup to hit the server again
+    cache.clear()
+    cache.get("libraries", fetch_libraries)
+    assert calls == ["libraries", "libraries"]
+
+
+def test_metadata_cache_expire():
+    cache = MetadataCache("Plex")
+    cache.get("users", lambda: ["luigi311"])
+    cache.get("libraries", lambda: {"Movies": "movie"})
+
+    # Entries younger than the ttl are kept
+    cache.expire(3600)
+    assert "users" in cache.entries
+
+    cache.expire(0)
+    assert cache.entries == {}
+
+
+def test_metadata_cache_threads():
+    calls: list[str] = []
+
+    def fetch_users() -> list[str]:
+        calls.append("users")
+        sleep(0.05)
+        return ["luigi311"]
+
+    cache = MetadataCache("Plex")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(
+            executor.map(lambda _: cache.get("users", fetch_users), range(4))
+        )
+
+    # Workers asking for the same key wait for the first fetch
+    assert results == [["luigi311"]] * 4
+    assert calls == ["users"]
+    assert cache.hits == 3
@@ -0,0 +1,162 @@
+from datetime import datetime
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.actions import build_actions, write_actions
+from src.checkpoint import Checkpoint
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    UserData,
+    WatchedStatus,
+)
+
+
+class FakeServer:
+    def __init__(self, base_url: str) -> None:
+        self.server_type = "Jellyfin"
+        self.base_url = base_url
+        self.updates = []
+
+    def info(self) -> str:
+        return f"Jellyfin {self.base_url}"
+
+    def update_watched(self, actions, user_mapping, library_mapping, dryrun):
+        self.updates.append([(action.user, action.library) for action in actions])
+
+
+def library(title: str, movie: str) -> LibraryData:
+    return LibraryData(
+        title=title,
+        movies=[
+            MediaItem(
+                identifiers=MediaIdentifiers(title=movie, locations=(f"{movie}.mkv",)),
+                status=WatchedStatus(
+                    completed=True, time=0, viewed_date=datetime.today()
+                ),
+            )
+        ],
+    )
+
+
+def test_checkpoint_resume(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    server = FakeServer("http://jellyfin:8096")
+    other = FakeServer("http://other:8096")
+
+    checkpoint = Checkpoint(path, fsync_interval=0)
+    checkpoint.record_gather(server, "User1", "Movies", library("Movies", "Sintel"))
+    checkpoint.record_gather(server, "user1", "Shows", library("Shows", "Show"))
+    checkpoint.record_gather(server, "user2", "Movies", library("Movies", "Big Buck"))
+    checkpoint.record_write(other, "user1", "Movies")
+    checkpoint.close()
+
+    # A crash can cut off the last line
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"type": "gather", "server"')
+
+    checkpoint = Checkpoint(path)
+    assert checkpoint.is_written(other, "User1", "Movies")
+    assert not checkpoint.is_written(server, "user1", "Movies")
+
+    # Only the requested users and libraries are reused
+    watched = checkpoint.get_watched(server, {"User1": "1", "User3": "3"}, ["Movies"])
+    assert list(watched) == ["user1"]
+    assert list(watched["user1"].libraries) == ["Movies"]
+    assert checkpoint.get_watched(other, {"User1": "1"}, ["Movies"]) is None
+
+    # Callers get a copy they can merge into
+    watched["user1"].libraries["Movies"].movies = []
+    watched = checkpoint.get_watched(server, {"User1": "1"}, ["Movies"])
+    assert len(watched["user1"].libraries["Movies"].movies) == 1
+
+    checkpoint.complete()
+    assert not os.path.exists(path)
+
+    checkpoint = Checkpoint(path)
+    assert checkpoint.gathered == {}
+    checkpoint.close()
+
+
+def test_checkpoint_max_age(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    server = FakeServer("http://jellyfin:8096")
+
+    checkpoint = Checkpoint(path)
+    checkpoint.record_write(server, "user1", "Movies")
+    checkpoint.close()
+
+    checkpoint = Checkpoint(path, max_age=0)
+    assert not checkpoint.is_written(server, "user1", "Movies")
+    checkpoint.close()
+
+
+def test_write_actions_checkpoint(tmp_path):
+    server = FakeServer("http://jellyfin:8096")
+    actions = build_actions(
+        {
+            "user1": UserData(
+                libraries={
+                    "Movies": library("Movies", "Sintel"),
+                    "Shows": library("Shows", "Show"),
+                }
+            ),
+            "user2": UserData(libraries={"Movies": library("Movies", "Big Buck")}),
+        }
+    )
+
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.jsonl"))
+    checkpoint.record_write(server, "user1", "Shows")
+    write_actions(server, actions, None, None, False, checkpoint)
+    assert sorted(server.updates) == [[("user1", "Movies")], [("user2", "Movies")]]
+    assert checkpoint.is_written(server, "user2", "Movies")
+
+    # Without a checkpoint everything is written at once
+    server.updates = []
+    write_actions(server, actions, None, None, False)
+    assert len(server.updates) == 1
+    checkpoint.close()
+
+
+def test_write_actions_checkpoint_pairs(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    server_1 = FakeServer("http://jellyfin:8096")
+    server_2 = FakeServer("http://emby:8096")
+    target = FakeServer("http://plex:32400")
+    actions = build_actions(
+        {"bob": UserData(libraries={"Movies": library("Movies", "Sintel")})}
+    )
+
+    # Both pairs write the same user library to the target in the same run
+    checkpoint = Checkpoint(path)
+    write_actions(target, actions, None, None, False, checkpoint, server_1)
+    write_actions(target, actions, None, None, False, checkpoint, server_2)
+    assert target.updates == [[("bob", "Movies")], [("bob", "Movies")]]
+    checkpoint.complete()
+
+    # A run that stopped after the first pair resumes with the second one
+    checkpoint = Checkpoint(path)
+    write_actions(target, actions, None, None, False, checkpoint, server_1)
+    checkpoint.close()
+
+    target.updates = []
+    checkpoint = Checkpoint(path)
+    write_actions(target, actions, None, None, False, checkpoint, server_1)
+    write_actions(target, actions, None, None, False, checkpoint, server_2)
+    assert target.updates == [[("bob", "Movies")]]
+    assert checkpoint.is_written(target, "bob", "Movies", server_2)
+    assert not checkpoint.is_written(target, "bob", "Movies")
+    checkpoint.close()
@@ -0,0 +1,96 @@
+from time import sleep
+import pickle
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.connection import (
+    connect_missing_servers,
+    connect_servers,
+    get_server_connections,
+)
+from src.jellyfin import Jellyfin
+
+
+class FakeServer:
+    def __init__(self, name: str, delay: float = 0) -> None:
+        sleep(delay)
+        self.name = name
+        self.ledger = None
+        self.outbox = None
+
+    def info(self) -> str:
+        return self.name
+
+
+def failing_server() -> FakeServer:
+    raise Exception("Connection refused")
+
+
+def test_connect_servers():
+    servers = connect_servers(
+        [
+            ("Plex Server 0", lambda: FakeServer("plex", 0.1)),
+            ("jellyfin Server 0", failing_server),
+            ("jellyfin Server 1", lambda: FakeServer("slow", 2)),
+            ("emby Server 0", lambda: FakeServer("emby")),
+        ],
+        timeout=1,
+    )
+
+    # Failed and timed out servers are skipped, the configured order is kept
+    assert [server.info() for server in servers] == ["plex", "emby"]
+
+
+def test_connect_missing_servers():
+    servers = connect_servers(
+        [
+            ("Plex Server 0", failing_server),
+            ("emby Server 0", lambda: FakeServer("emby")),
+        ],
+        timeout=1,
+    )
+    emby = servers[0]
+
+    # Only the server that was down is connected again, in its configured place
+    servers = connect_missing_servers(
+        {},
+        [
+            ("Plex Server 0", lambda: FakeServer("plex")),
+            ("emby Server 0", lambda: FakeServer("new emby")),
+        ],
+        servers,
+    )
+    assert [server.info() for server in servers] == ["plex", "emby"]
+    assert servers[1] is emby
+    assert [server.connection_index for server in servers] == [0, 1]
+
+
+def test_server_connections_pickle():
+    server = Jellyfin.__new__(Jellyfin)
+    server.env = {"DRYRUN": "True"}
+    server.server_type = "Jellyfin"
+    server.base_url = "http://localhost:8096"
+    server.token = "token"
+
+    # Shard workers receive the connections of the parent in their task
+    connections = pickle.loads(pickle.dumps(get_server_connections([server])))
+    name, connect = connections[0]
+    assert name == "jellyfin Server 0"
+    assert connect.func is Jellyfin
+    assert connect.keywords == {
+        "env": {"DRYRUN": "True"},
+        "base_url": "http://localhost:8096",
+        "token": "token",
+    }
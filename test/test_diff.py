@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+import random
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from benchmark_diff import generate_watched
+from src.diff import cleanup_watched_parallel, decode_item, encode_library
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    Series,
+    UserData,
+    WatchedStatus,
+    cleanup_watched,
+)
+
+env = {"AVERAGE_TIME": "100", "SLEEP_DURATION": "5"}
+
+
+def random_identifiers(rng: random.Random, prefix: str) -> MediaIdentifiers:
+    # Small pools of values so items overlap on some identifiers but not others
+    return MediaIdentifiers(
+        title=prefix,
+        locations=tuple(
+            f"{prefix}{rng.randrange(8)}.mkv" for _ in range(rng.randrange(3))
+        ),
+        imdb_id=f"tt{rng.randrange(8)}" if rng.random() < 0.4 else None,
+        tvdb_id=str(rng.randrange(8)) if rng.random() < 0.4 else None,
+        tmdb_id=str(rng.randrange(8)) if rng.random() < 0.4 else None,
+    )
+
+
+def random_item(rng: random.Random, prefix: str) -> MediaItem:
+    return MediaItem(
+        identifiers=random_identifiers(rng, prefix),
+        status=WatchedStatus(
+            completed=rng.random() < 0.5,
+            time=rng.randrange(0, 600_000, 5_000),
+            viewed_date=datetime(2024, 1, 1) + timedelta(minutes=rng.randrange(10)),
+        ),
+    )
+
+
+def random_watched(rng: random.Random) -> dict[str, UserData]:
+    return {
+        user: UserData(
+            libraries={
+                title: LibraryData(
+                    title=title,
+                    movies=[random_item(rng, "movie") for _ in range(rng.randrange(6))],
+                    series=[
+                        Series(
+                            identifiers=random_identifiers(rng, "show"),
+                            episodes=[
+                                random_item(rng, "episode")
+                                for _ in range(rng.randrange(4))
+                            ],
+                        )
+                        for _ in range(rng.randrange(4))
+                    ],
+                )
+                for title in ["Movies", "Shows", "Other"]
+                if rng.random() < 0.8
+            }
+        )
+        for user in ["user1", "user2", "user3"]
+        if rng.random() < 0.9
+    }
+
+
+def test_encode_round_trip():
+    libraries = generate_watched(1, 5, 2, 1)["user0"].libraries
+    movies, _ = encode_library(libraries["Movies"])
+    _, series = encode_library(libraries["TV Shows"])
+
+    assert [decode_item(movie) for movie in movies] == libraries["Movies"].movies
+    episodes = libraries["TV Shows"].series[1].episodes
+    assert [decode_item(episode) for episode in series[1][1]] == episodes
+
+
+def test_parallel_cleanup_matches_cleanup():
+    rng = random.Random(42)
+    for _ in range(200):
+        watched_list_1 = random_watched(rng)
+        watched_list_2 = random_watched(rng)
+        for first, second in (
+            (watched_list_1, watched_list_2),
+            (watched_list_2, watched_list_1),
+        ):
+            assert cleanup_watched_parallel(first, second, env) == cleanup_watched(
+                first, second, env
+            )
+
+
+def test_parallel_cleanup_processes():
+    watched_list_1 = generate_watched(6, 20, 3, 1)
+    watched_list_2 = generate_watched(6, 20, 3, 2)
+    library_mapping = {"Movies": "Films"}
+    watched_list_2["user0"].libraries["Films"] = watched_list_2["user0"].libraries.pop(
+        "Movies"
+    )
+
+    expected = cleanup_watched(
+        watched_list_1, watched_list_2, env, library_mapping=library_mapping
+    )
+    result = cleanup_watched_parallel(
+        watched_list_1,
+        watched_list_2,
+        env,
+        library_mapping=library_mapping,
+        processes=2,
+    )
+    assert result == expected
+    # The results keep the order of the users and libraries
+    assert list(result) == list(expected)
+    assert all(
+        list(result[user].libraries) == list(expected[user].libraries)
+        for user in result
+    )
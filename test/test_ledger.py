@@ -0,0 +1,98 @@
+from datetime import datetime
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.actions import SyncAction
+from src.ledger import WriteLedger
+from src.watched import MediaIdentifiers
+
+
+class FakeServer:
+    server_type = "Jellyfin"
+    base_url = "http://localhost:8096"
+
+    def info(self) -> str:
+        return "Jellyfin localhost"
+
+
+server = FakeServer()
+
+
+def sync_action(action: str = "mark_watched", position: int = 0) -> SyncAction:
+    return SyncAction(
+        action=action,
+        user="user",
+        library="Movies",
+        identifiers=MediaIdentifiers(title="Sintel"),
+        position=position,
+        viewed_date=datetime.today(),
+        target_id="1",
+    )
+
+
+def test_written_state_is_not_skipped(tmp_path):
+    ledger = WriteLedger(str(tmp_path / "ledger.db"))
+    watched = sync_action()
+    assert ledger.should_write(server, "User", watched, now=0)
+    ledger.record(server, "User", watched, now=0)
+
+    # The target differs from what was written, so it changed since
+    assert ledger.should_write(server, "user", watched, now=60)
+    ledger.record(server, "user", sync_action("set_position", 60_000), now=0)
+    assert ledger.should_write(
+        server, "user", sync_action("set_position", 65_000), now=10
+    )
+
+    # Items without a target id are always written
+    watched.target_id = None
+    assert ledger.should_write(server, "user", watched, now=10)
+
+    # The ledger is kept between runs
+    ledger.close()
+    ledger = WriteLedger(str(tmp_path / "ledger.db"))
+    assert ledger.get_row(server, "user", "1")[:2] == ("set_position", 60_000)
+
+
+def test_oscillation(tmp_path):
+    ledger = WriteLedger(
+        str(tmp_path / "ledger.db"),
+        oscillation_window=3600,
+        oscillation_limit=3,
+        damping=7200,
+    )
+
+    # Progress moving forward is never damped
+    for minute in range(1, 10):
+        ledger.record(server, "user", sync_action("set_position", minute * 60_000))
+    ledger.record(server, "user", sync_action())
+    assert ledger.should_write(server, "user", sync_action("set_position", 60_000))
+
+    # Flipping between watched and a position is
+    ledger.record(server, "user", sync_action("set_position", 60_000), now=0)
+    ledger.record(server, "user", sync_action(), now=60)
+    ledger.record(server, "user", sync_action("set_position", 60_000), now=120)
+    assert ledger.should_write(server, "user", sync_action(), now=180)
+
+    ledger.record(server, "user", sync_action(), now=180)
+    assert not ledger.should_write(
+        server, "user", sync_action("set_position", 60_000), now=240
+    )
+    assert ledger.damped == 1
+    assert ledger.should_write(
+        server, "user", sync_action("set_position", 60_000), now=180 + 7200
+    )
+
+    ledger.log_metrics()
+    assert ledger.writes == 0
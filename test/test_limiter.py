@@ -0,0 +1,126 @@
+from threading import Thread
+from time import monotonic, sleep
+import sys
+import os
+
+import requests
+from requests.adapters import BaseAdapter
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.limiter import AdaptiveLimiter, limit_session, parse_retry_after
+
+
+class FakeAdapter(BaseAdapter):
+    def __init__(self, status_code: int = 200, headers=None, delay: float = 0):
+        super().__init__()
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.delay = delay
+        self.in_flight = 0
+        self.peak = 0
+
+    def send(self, request, **kwargs):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        sleep(self.delay)
+        self.in_flight -= 1
+
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.headers.update(self.headers)
+        response._content = b"{}"
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+
+def test_limiter_aimd():
+    limiter = AdaptiveLimiter("Jellyfin", initial=4, max_limit=8)
+
+    # Stable latency raises the limit by about one per round of requests
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.current_limit >= 6
+
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.current_limit == 8
+
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    assert limiter.current_limit == 4
+    assert limiter.metrics()["overloads"] == 1
+
+    # Rising latency cuts the limit as well
+    limiter.last_decrease = 0
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(1.0)
+    assert limiter.current_limit < 4
+    assert limiter.current_limit >= 1
+
+
+def test_limiter_retry_after():
+    limiter = AdaptiveLimiter("Emby", max_retry_after=0.2)
+    limiter.acquire()
+    limiter.release(overloaded=True, retry_after=60)
+
+    start = monotonic()
+    limiter.acquire()
+    assert monotonic() - start >= 0.15
+    limiter.release(0.1)
+
+
+def test_limited_session():
+    limiter = AdaptiveLimiter("Jellyfin", initial=2, max_limit=2)
+    adapter = FakeAdapter(delay=0.05)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    limit_session(session, limiter)
+    # Mounting again does not wrap the adapter twice
+    limit_session(session, limiter)
+
+    threads = [
+        Thread(target=session.get, args=("http://jellyfin:8096/Users",))
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert adapter.peak == 2
+    assert limiter.in_flight == 0
+
+    session.mount(
+        "http://",
+        FakeAdapter(503, {"Retry-After": "0"}),
+    )
+    limit_session(session, limiter)
+    response = session.get("http://jellyfin:8096/Users")
+    assert response.status_code == 503
+    assert limiter.current_limit == 1
+    assert limiter.metrics()["overloads"] == 1
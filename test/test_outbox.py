@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta, timezone
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.actions import SyncAction, is_superseded
+from src.outbox import WriteOutbox
+from src.watched import MediaIdentifiers
+
+
+class FakeServer:
+    def __init__(self, base_url: str) -> None:
+        self.server_type = "Jellyfin"
+        self.base_url = base_url
+        self.failures = 0
+        self.writes = []
+        self.superseded = False
+
+    def info(self) -> str:
+        return f"Jellyfin {self.base_url}"
+
+    def retry_write(self, user_name, action):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Query failed with status 503 Service Unavailable")
+        if self.superseded:
+            return False
+
+        self.writes.append((user_name, action.target_id, action.action))
+        return True
+
+    def record_write(self, user_name, action):
+        self.outbox.remove(self, user_name, action)
+
+
+def sync_action(target_id: str = "1") -> SyncAction:
+    return SyncAction(
+        action="mark_watched",
+        user="user",
+        library="Movies",
+        identifiers=MediaIdentifiers(title="Sintel"),
+        viewed_date=datetime.today(),
+        target_id=target_id,
+    )
+
+
+def test_outbox_retry(tmp_path):
+    outbox = WriteOutbox(str(tmp_path / "outbox.db"), retry_interval=60)
+    server = FakeServer("http://jellyfin:8096")
+    other = FakeServer("http://other:8096")
+    server.outbox = other.outbox = outbox
+
+    outbox.add(server, "User", sync_action(), "timeout", now=0)
+    outbox.add(other, "User", sync_action(), "timeout", now=0)
+    assert outbox.size() == 2
+
+    # Not due before the backoff
+    assert outbox.drain([server, other], now=30) == 0
+    assert server.writes == []
+
+    # A failed retry doubles the backoff
+    server.failures = 1
+    assert outbox.drain([server], now=60) == 0
+    assert outbox.due(server, now=150) == []
+    assert len(outbox.due(server, now=180)) == 1
+
+    assert outbox.drain([server], now=180) == 1
+    assert server.writes == [("user", "1", "mark_watched")]
+    assert outbox.size() == 1
+
+    # Entries are kept between runs
+    outbox.close()
+    outbox = WriteOutbox(str(tmp_path / "outbox.db"), retry_interval=60)
+    other.outbox = outbox
+    assert outbox.drain([server, other], now=180) == 1
+    assert outbox.size() == 0
+
+
+def test_outbox_max_attempts(tmp_path):
+    outbox = WriteOutbox(
+        str(tmp_path / "outbox.db"),
+        retry_interval=60,
+        max_retry_interval=100,
+        max_attempts=3,
+    )
+    server = FakeServer("http://jellyfin:8096")
+    server.outbox = outbox
+    server.failures = 10
+
+    outbox.add(server, "user", sync_action(), "timeout", now=0)
+    assert outbox.drain([server], now=60) == 0
+    # The backoff is capped
+    assert len(outbox.due(server, now=160)) == 1
+
+    # Dropped after the last attempt
+    assert outbox.drain([server], now=160) == 0
+    assert outbox.size() == 0
+
+    # Actions without a matched item can not be retried
+    action = sync_action()
+    action.target_id = None
+    outbox.add(server, "user", action, "timeout")
+    assert outbox.size() == 0
+
+
+def test_outbox_superseded(tmp_path):
+    outbox = WriteOutbox(str(tmp_path / "outbox.db"), retry_interval=60)
+    server = FakeServer("http://jellyfin:8096")
+    server.outbox = outbox
+    server.superseded = True
+
+    # The item changed since the write failed, the entry is dropped unwritten
+    outbox.add(server, "user", sync_action(), "timeout", now=0)
+    assert outbox.drain([server], now=60) == 0
+    assert server.writes == []
+    assert outbox.size() == 0
+
+
+def test_is_superseded():
+    queued = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    action = sync_action()
+    action.action = "set_position"
+    action.position = 600_000
+    action.viewed_date = queued
+
+    assert not is_superseded(action, False, 0, queued - timedelta(days=1))
+    assert not is_superseded(action, False, 0, None)
+    # Already at the position
+    assert is_superseded(action, False, 605_000, None)
+    # Finished or played since the action was queued
+    assert is_superseded(action, True, 0, queued + timedelta(hours=1))
+    assert is_superseded(action, False, 0, queued + timedelta(hours=1))
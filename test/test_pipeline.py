@@ -0,0 +1,85 @@
+from time import perf_counter, sleep
+import sys
+import os
+
+import pytest
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from benchmark_pipeline import run_benchmark
+from src.pipeline import Pipeline, Stage
+from src.users import pair_server_users, split_server_users
+
+
+def test_split_server_users():
+    assert split_server_users({"User1": "1", "User2": "2"}) == [
+        {"User1": "1"},
+        {"User2": "2"},
+    ]
+    assert split_server_users(["plex1", "plex2"]) == [["plex1"], ["plex2"]]
+
+
+def test_pair_server_users():
+    pairs = pair_server_users(
+        {"User1": "1", "User2": "2", "User3": "3"},
+        {"user1": "a", "Other": "b"},
+        {"user2": "other"},
+    )
+    assert pairs == [
+        ({"User1": "1"}, {"user1": "a"}),
+        ({"User2": "2"}, {"Other": "b"}),
+    ]
+
+
+def test_pipeline_memory():
+    results = run_benchmark(users=5, movies=100, shows=5)
+    all_peak, all_changes = results["all users"]
+    user_peak, user_changes = results["per user"]
+
+    assert all_changes == user_changes
+    assert user_peak < all_peak
+
+
+def test_pipeline_overlap():
+    def step(item):
+        sleep(0.05)
+        return item + 1
+
+    pipeline = Pipeline(
+        [Stage("gather", step), Stage("diff", step), Stage("write", step, 2)],
+        queue_size=1,
+    )
+    start = perf_counter()
+    results = pipeline.run(range(8))
+    elapsed = perf_counter() - start
+
+    assert sorted(results) == list(range(3, 11))
+    # Sequentially this takes 24 steps, overlapped about the 8 of the slowest stage
+    assert elapsed < 24 * 0.05 * 0.75
+
+    occupancy = pipeline.occupancy()
+    assert occupancy["write"]["workers"] == 2
+    assert all(stats["processed"] == 8 for stats in occupancy.values())
+    assert all(stats["peak_queue"] <= 1 for stats in occupancy.values())
+    assert occupancy["gather"]["utilization"] > occupancy["write"]["utilization"]
+
+
+def test_pipeline_error():
+    def fail(item):
+        if item == 3:
+            raise ValueError("Query failed")
+        return item
+
+    pipeline = Pipeline([Stage("gather", fail), Stage("write", fail, 2)])
+    with pytest.raises(Exception, match="Query failed"):
+        pipeline.run(range(100))
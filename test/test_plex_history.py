@@ -0,0 +1,213 @@
+from datetime import datetime, timezone
+from threading import Lock
+from types import SimpleNamespace
+from xml.etree import ElementTree
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from plexapi.video import Movie
+
+from src.actions import SyncAction
+from src.cache import MetadataCache
+from src.plex import Plex
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    UserData,
+    WatchedStatus,
+)
+
+
+def plex_movie(rating_key: int, title: str, view_count: int, view_offset: int = 0):
+    xml = (
+        f'<Video ratingKey="{rating_key}" type="movie" title="{title}" librarySectionTitle="Movies" '
+        f'viewCount="{view_count}" viewOffset="{view_offset}" lastViewedAt="1727384325">'
+        f'<Media><Part file="/media/{title}.mkv"/></Media></Video>'
+    )
+    return Movie(None, ElementTree.fromstring(xml))
+
+
+class FakePlexServer:
+    def __init__(self) -> None:
+        self.entries = []
+        self.items = {}
+        self.history_calls = []
+        self.on_deck = []
+        self.library = SimpleNamespace(onDeck=lambda: self.on_deck)
+
+    def history(self, maxresults=None, mindate=None):
+        self.history_calls.append(mindate)
+        return self.entries[:maxresults]
+
+    def fetchItem(self, rating_key):
+        return self.items[rating_key]
+
+
+def setup_plex() -> Plex:
+    plex = Plex.__new__(Plex)
+    plex.env = {}
+    plex.plex = FakePlexServer()
+    plex.cache = MetadataCache("Plex")
+    plex.admin_user = SimpleNamespace(id=1234, username="admin", title="Admin")
+    plex.users = [plex.admin_user]
+    plex.generate_guids = True
+    plex.generate_locations = True
+    plex.history_gather = True
+    plex.history_max_entries = 4
+    plex.history_full_interval = 86400
+    plex.history_watched = {}
+    plex.history_lock = Lock()
+    plex.history_written = {}
+    plex.history_watermark = None
+    plex.history_full_time = None
+    plex.history_updated = False
+    plex.ledger = None
+    plex.outbox = None
+    return plex
+
+
+def stored_movie(title: str) -> MediaItem:
+    return MediaItem(
+        identifiers=MediaIdentifiers(title=title, locations=(f"{title}.mkv",)),
+        status=WatchedStatus(completed=True, time=0, viewed_date=datetime.today()),
+    )
+
+
+def test_history_changes():
+    plex = setup_plex()
+    plex.plex.entries = [
+        SimpleNamespace(accountID=1, ratingKey=10),
+        SimpleNamespace(accountID=1, ratingKey=10),
+        SimpleNamespace(accountID=99, ratingKey=11),
+    ]
+
+    since = datetime.now(timezone.utc)
+    # The admin is always accountID 1, unknown accounts are ignored
+    assert plex.get_history_changes(since) == {"admin": {"10"}}
+
+    # Truncated history
+    plex.plex.entries.append(SimpleNamespace(accountID=1, ratingKey=12))
+    assert plex.get_history_changes(since) is None
+
+
+def test_update_history_watched():
+    plex = setup_plex()
+
+    # The first run gathers everything
+    plex.update_history_watched()
+    assert plex.history_watermark is not None
+    assert plex.history_full_time is not None
+    assert plex.plex.history_calls == []
+
+    plex.history_watched = {
+        "admin": UserData(
+            libraries={
+                "Movies": LibraryData(
+                    title="Movies",
+                    movies=[stored_movie("Big Buck Bunny"), stored_movie("Sintel")],
+                )
+            }
+        )
+    }
+
+    # Newly watched and partially rewatched movies are updated in place
+    plex.plex.entries = [
+        SimpleNamespace(accountID=1, ratingKey=10),
+        SimpleNamespace(accountID=1, ratingKey=11),
+    ]
+    plex.plex.items = {
+        10: plex_movie(10, "Tears of Steel", 1),
+        11: plex_movie(11, "Sintel", 1, view_offset=300_000),
+    }
+    plex.update_history_watched()
+    assert len(plex.plex.history_calls) == 1
+
+    movies = {
+        movie.identifiers.title: movie.status
+        for movie in plex.history_watched["admin"].libraries["Movies"].movies
+    }
+    assert set(movies) == {"Big Buck Bunny", "Sintel", "Tears of Steel"}
+    assert movies["Tears of Steel"].completed
+    assert not movies["Sintel"].completed
+    assert movies["Sintel"].time == 300_000
+
+    # Falls back to a full gather once the history is truncated
+    plex.plex.entries = [SimpleNamespace(accountID=1, ratingKey=10)] * 4
+    plex.update_history_watched()
+    assert plex.history_watched == {}
+
+
+def test_history_full_interval():
+    plex = setup_plex()
+    plex.update_history_watched()
+    plex.history_watched = {"admin": UserData()}
+
+    plex.history_full_interval = 0
+    plex.update_history_watched()
+    assert plex.plex.history_calls == []
+    assert plex.history_watched == {}
+
+
+def test_history_applies_writes():
+    plex = setup_plex()
+    plex.history_watched = {
+        "admin": UserData(
+            libraries={
+                "Movies": LibraryData(title="Movies", movies=[stored_movie("Sintel")])
+            }
+        )
+    }
+    plex.plex.items = {11: plex_movie(11, "Sintel", 0, view_offset=300_000)}
+
+    # Setting a position is not in the history, the written item is fetched again
+    plex.record_write(
+        "Admin",
+        SyncAction(
+            action="set_position",
+            user="admin",
+            library="Movies",
+            identifiers=MediaIdentifiers(title="Sintel"),
+            position=300_000,
+            viewed_date=datetime.today(),
+            target_id="11",
+        ),
+    )
+    plex.apply_history_writes(plex.admin_user, "admin", plex.plex)
+
+    movies = plex.history_watched["admin"].libraries["Movies"].movies
+    assert [(movie.status.completed, movie.status.time) for movie in movies] == [
+        (False, 300_000)
+    ]
+    assert plex.history_written == {}
+
+
+def test_users_activity_progress():
+    plex = setup_plex()
+    since = datetime(2024, 9, 1, tzinfo=timezone.utc)
+
+    # No finished views and nothing in progress
+    assert plex.get_users_activity(since) == {
+        "admin": datetime.fromtimestamp(0, timezone.utc)
+    }
+
+    # Partial progress is not in the history but on deck
+    plex.plex.on_deck = [plex_movie(11, "Sintel", 0, view_offset=300_000)]
+    activity = plex.get_users_activity(since)
+    assert activity["admin"] == datetime.fromtimestamp(1727384325, timezone.utc)
+
+    # Unknown when the progress can not be fetched
+    plex.plex.library = None
+    assert plex.get_users_activity(since) == {"admin": None}
@@ -0,0 +1,83 @@
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.scheduler import Scheduler
+
+
+def create_scheduler() -> Scheduler:
+    return Scheduler(
+        interval=3600,
+        min_interval=300,
+        max_interval=14400,
+        retry_interval=60,
+        jitter=0,
+    )
+
+
+def test_scheduler_spreads_pairs():
+    scheduler = create_scheduler()
+    scheduler.update(["a", "b", "c", "d"], now=0)
+
+    assert [pair.next_run for pair in scheduler.pairs.values()] == [
+        0,
+        900,
+        1800,
+        2700,
+    ]
+    assert scheduler.next_due(now=0) == ("a", 0)
+
+    # Removed pairs are dropped, existing pairs keep their schedule
+    scheduler.update(["b", "c", "d", "e"], now=100)
+    assert list(scheduler.pairs) == ["b", "c", "d", "e"]
+    assert scheduler.pairs["b"].next_run == 900
+    assert scheduler.pairs["e"].next_run == 100
+
+
+def test_scheduler_adapts_to_changes():
+    scheduler = create_scheduler()
+    scheduler.update(["a"], now=0)
+
+    scheduler.record_success("a", 5, now=0)
+    assert scheduler.pairs["a"].interval == 1800
+    assert scheduler.pairs["a"].next_run == 1800
+
+    scheduler.record_success("a", 0, now=1800)
+    assert scheduler.pairs["a"].interval == 2700
+
+    for _ in range(10):
+        scheduler.record_success("a", 10, now=0)
+    assert scheduler.pairs["a"].interval == 300
+
+    for _ in range(10):
+        scheduler.record_success("a", 0, now=0)
+    assert scheduler.pairs["a"].interval == 14400
+
+
+def test_scheduler_backoff():
+    scheduler = create_scheduler()
+    scheduler.update(["a", "b"], now=0)
+
+    for failures in range(1, 6):
+        scheduler.record_failure("a", now=0)
+        delay = 60 * 2 ** (failures - 1)
+        assert delay / 2 <= scheduler.pairs["a"].next_run <= delay
+
+    # Only the failing pair backs off
+    assert scheduler.pairs["b"].next_run == 1800
+    assert scheduler.pairs["b"].failures == 0
+
+    # A success resets the backoff
+    scheduler.record_success("a", 0, now=0)
+    assert scheduler.pairs["a"].failures == 0
@@ -0,0 +1,124 @@
+from datetime import datetime
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.config import SyncConfig
+from src.sessions import SessionPoller
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    WatchedStatus,
+)
+from src.webhook import WebhookProcessor
+
+
+class FakeServer:
+    def __init__(self, server_type: str, server_id: str) -> None:
+        self.server_type = server_type
+        self.server_id = server_id
+        self.sessions = []
+        self.completed = False
+        self.updates = []
+
+    def info(self) -> str:
+        return f"{self.server_type} {self.server_id}"
+
+    def get_active_sessions(self):
+        return self.sessions
+
+    def get_item_watched(self, user_name, item_id, user_id=None):
+        library = LibraryData(title="Movies")
+        library.movies.append(
+            MediaItem(
+                identifiers=MediaIdentifiers(title=item_id, imdb_id=item_id),
+                status=WatchedStatus(
+                    completed=self.completed,
+                    time=60_000,
+                    viewed_date=datetime.today(),
+                ),
+            )
+        )
+        return user_name, "Movies", "movies", library
+
+    def update_watched(self, actions, user_mapping, library_mapping, dryrun):
+        for action in actions:
+            self.updates.append(action.position)
+
+
+def setup_poller():
+    plex = FakeServer("Plex", "plex")
+    jellyfin = FakeServer("Jellyfin", "jellyfin")
+    processor = WebhookProcessor(
+        {}, SyncConfig(), [plex, jellyfin], lambda s1, s2: True
+    )
+    return plex, jellyfin, SessionPoller(processor, min_delta=60_000, min_interval=60)
+
+
+def test_session_poller():
+    plex, jellyfin, poller = setup_poller()
+
+    # Under a minute is not pushed
+    plex.sessions = [("User", None, "1", 30_000)]
+    assert poller.poll(now=0) == 0
+    assert jellyfin.updates == []
+
+    plex.sessions = [("User", None, "1", 120_000)]
+    assert poller.poll(now=10) == 1
+    assert jellyfin.updates == [120_000]
+    assert plex.updates == []
+
+    # Too soon after the last push
+    plex.sessions = [("User", None, "1", 300_000)]
+    assert poller.poll(now=30) == 0
+
+    # Position did not move enough
+    plex.sessions = [("User", None, "1", 150_000)]
+    assert poller.poll(now=100) == 0
+
+    plex.sessions = [("User", None, "1", 300_000)]
+    assert poller.poll(now=100) == 1
+    assert jellyfin.updates == [120_000, 300_000]
+
+    # Seeking back is pushed as well
+    plex.sessions = [("User", None, "1", 100_000)]
+    assert poller.poll(now=200) == 1
+    assert jellyfin.updates[-1] == 100_000
+
+
+def test_session_poller_stopped_sessions():
+    plex, jellyfin, poller = setup_poller()
+
+    plex.sessions = [("User", None, "1", 120_000), ("Other", None, "2", 120_000)]
+    jellyfin.sessions = [("User", "id", "3", 600_000)]
+    assert poller.poll(now=0) == 3
+    assert len(poller.progress) == 3
+    assert plex.updates == [600_000]
+
+    # Stopped sessions are forgotten so a new playback is pushed right away
+    plex.sessions = [("User", None, "1", 130_000)]
+    jellyfin.sessions = []
+    assert poller.poll(now=10) == 0
+    assert len(poller.progress) == 1
+
+
+def test_session_poller_watched():
+    plex, jellyfin, poller = setup_poller()
+
+    # Progress of an item that is already watched is not pushed
+    plex.completed = True
+    plex.sessions = [("User", None, "1", 120_000)]
+    assert poller.poll(now=0) == 1
+    assert jellyfin.updates == []
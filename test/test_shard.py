@@ -0,0 +1,109 @@
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.shard import (
+    ShardLeases,
+    filter_shard_users,
+    get_shard_env,
+    get_user_shard,
+    log_shard_summary,
+    run_shards,
+)
+
+
+class FakePlexUser:
+    def __init__(self, username: str) -> None:
+        self.username = username
+        self.title = username
+
+
+def test_user_shard_is_stable():
+    # The shard must not depend on the process, hash() is salted per interpreter
+    assert get_user_shard("user1", 4) == 1
+    assert get_user_shard("User1", 4) == get_user_shard("user1", 4)
+
+    mapping = {"user1": "plexuser"}
+    assert get_user_shard("user1", 8, mapping) == get_user_shard("plexuser", 8, mapping)
+
+
+def test_filter_shard_users():
+    users = {f"User{index}": str(index) for index in range(20)}
+    plex_users = [FakePlexUser(f"user{index}") for index in range(20)]
+
+    shards = [filter_shard_users(users, shard, 3) for shard in range(3)]
+    assert sorted(user for shard in shards for user in shard) == sorted(users)
+    assert all(shard for shard in shards)
+
+    # Both servers put the same person in the same shard
+    for shard in range(3):
+        plex_shard = filter_shard_users(plex_users, shard, 3)
+        assert [user.username for user in plex_shard] == [
+            user.lower() for user in shards[shard]
+        ]
+
+
+def test_shard_env():
+    env = get_shard_env({"ACTIVITY_FILE": "/config/activity.json"}, 2)
+    assert env["ACTIVITY_FILE"] == "/config/activity.shard-2.json"
+    assert env["CHECKPOINT_FILE"] == "checkpoint.shard-2.jsonl"
+    assert env["RUN_BUDGET_FILE"] == "deferred.shard-2.json"
+
+
+def test_shard_leases(tmp_path):
+    leases = ShardLeases(str(tmp_path), interval=60, ttl=100)
+    other = ShardLeases(str(tmp_path), interval=60, ttl=100)
+
+    assert leases.acquire(0)
+    assert not other.acquire(0)
+    assert other.acquire(1)
+
+    # A finished shard is not run again within the interval
+    leases.release(0, True)
+    assert not other.acquire(0)
+    other.release(1, False)
+    assert leases.acquire(1)
+
+    # The lease of a worker that died is taken over after ttl
+    lease = leases.get_path(1, "lease")
+    os.utime(lease, (0, 0))
+    assert other.acquire(1)
+    assert not os.path.exists(f"{lease}.stale")
+    assert not leases.acquire(1)
+
+
+def job(shard: int) -> dict:
+    return {
+        "shard": shard,
+        "status": "synced",
+        "changes": shard,
+        "elapsed": 0,
+        "pid": os.getpid(),
+    }
+
+
+def test_run_shards():
+    results = run_shards(job, list(range(4)), 2)
+    assert [result["shard"] for result in results] == [0, 1, 2, 3]
+    assert len({result["pid"] for result in results}) == 4
+    assert os.getpid() not in {result["pid"] for result in results}
+    log_shard_summary(results, 1)
+
+    results.append({"shard": 2, "status": "failed", "changes": 0, "error": "boom"})
+    try:
+        log_shard_summary(results, 1)
+    except Exception as e:
+        assert str(e) == "Shards [2] failed"
+    else:
+        assert False
@@ -0,0 +1,235 @@
+from datetime import datetime
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from benchmark_pipeline import LIBRARIES, setup_servers
+from src.config import SyncConfig
+from src.main import sync_watched, sync_watched_store
+from src.store import WatchedBuffer, WatchedStore
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    Series,
+    UserData,
+    WatchedStatus,
+    cleanup_watched,
+    count_watched,
+)
+
+env = {"AVERAGE_TIME": "100", "SLEEP_DURATION": "5"}
+
+
+def item(title, completed=True, time=0, day=1, locations=(), **guids) -> MediaItem:
+    return MediaItem(
+        identifiers=MediaIdentifiers(title=title, locations=locations, **guids),
+        status=WatchedStatus(
+            completed=completed, time=time, viewed_date=datetime(2024, 1, day)
+        ),
+    )
+
+
+def series(title, episodes, locations=(), **guids) -> Series:
+    return Series(
+        identifiers=MediaIdentifiers(title=title, locations=locations, **guids),
+        episodes=episodes,
+    )
+
+
+watched_list_1 = {
+    "user1": UserData(
+        libraries={
+            "Movies": LibraryData(
+                title="Movies",
+                movies=[
+                    # Same on both sides
+                    item("Tied", locations=("tied.mkv",)),
+                    # Further along on server 2
+                    item("Partial", False, 60_000, locations=("partial.mkv",)),
+                    # Watched later on server 1
+                    item("Newer", False, 600_000, 20, imdb_id="tt1"),
+                    item("Only 1", locations=("only1.mkv",)),
+                ],
+            ),
+            "Shows": LibraryData(
+                title="Shows",
+                series=[
+                    series(
+                        "Matched",
+                        [
+                            item("S01E01", locations=("m1.mkv",)),
+                            item("S01E02", locations=("m2.mkv",)),
+                        ],
+                        tvdb_id="100",
+                    ),
+                    series(
+                        "All Removed",
+                        [item("S01E01", locations=("r1.mkv",))],
+                        locations=("All Removed",),
+                    ),
+                    series(
+                        "Unmatched",
+                        [item("S01E01", locations=("u1.mkv",))],
+                        tvdb_id="300",
+                    ),
+                    # Same file as an episode of Matched, but a different show
+                    series(
+                        "Wrong Show",
+                        [item("S01E01", locations=("m1.mkv",))],
+                        tvdb_id="400",
+                    ),
+                ],
+            ),
+        }
+    ),
+    "user2": UserData(
+        libraries={
+            "Movies": LibraryData(title="Movies", movies=[item("Alone", imdb_id="tt9")])
+        }
+    ),
+    "mapped": UserData(
+        libraries={
+            "Movies": LibraryData(
+                title="Movies", movies=[item("Mapped", tmdb_id="5", locations=("a",))]
+            )
+        }
+    ),
+}
+
+watched_list_2 = {
+    "user1": UserData(
+        libraries={
+            "Movies": LibraryData(
+                title="Movies",
+                movies=[
+                    item("Tied", locations=("tied.mkv", "other.mkv")),
+                    item("Partial", False, 300_000, locations=("partial.mkv",)),
+                    item("Newer", False, 100_000, 2, imdb_id="tt1"),
+                    item("Only 2", tmdb_id="77"),
+                ],
+            ),
+            "TV Shows": LibraryData(
+                title="TV Shows",
+                series=[
+                    series(
+                        "Matched",
+                        [item("S01E01", False, 1_000, locations=("m1.mkv",))],
+                        tvdb_id="100",
+                    ),
+                    series(
+                        "Matched Again",
+                        [item("S01E02", locations=("m2.mkv",))],
+                        tvdb_id="100",
+                    ),
+                    series(
+                        "All Removed",
+                        [item("S01E01", locations=("r1.mkv",))],
+                        locations=("All Removed",),
+                    ),
+                ],
+            ),
+        }
+    ),
+    "other": UserData(
+        libraries={
+            "Movies": LibraryData(
+                title="Movies", movies=[item("Mapped", tmdb_id="5", locations=("b",))]
+            )
+        }
+    ),
+}
+
+
+def test_store_cleanup_matches_memory(tmp_path):
+    user_mapping = {"mapped": "other"}
+    library_mapping = {"Shows": "TV Shows"}
+    store = WatchedStore(str(tmp_path / "watched.db"))
+    store.add_watched(1, watched_list_1)
+    store.add_watched(2, watched_list_2)
+
+    for side, watched, other in (
+        (1, watched_list_1, watched_list_2),
+        (2, watched_list_2, watched_list_1),
+    ):
+        expected = cleanup_watched(watched, other, env, user_mapping, library_mapping)
+        assert dict(store.cleanup(side, env, user_mapping, library_mapping)) == expected
+
+    filtered = dict(store.cleanup(1, env, user_mapping, library_mapping))
+    assert [
+        movie.identifiers.title
+        for movie in filtered["user1"].libraries["Movies"].movies
+    ] == ["Newer", "Only 1"]
+    assert [
+        show.identifiers.title for show in filtered["user1"].libraries["Shows"].series
+    ] == [
+        "Matched",
+        "Unmatched",
+        "Wrong Show",
+    ]
+    assert filtered["mapped"].libraries == {}
+    store.close()
+    assert os.path.exists(tmp_path / "watched.db")
+
+
+def test_buffer_spills_past_threshold():
+    buffer = WatchedBuffer(5)
+    buffer.add(1, {"user2": watched_list_1["user2"]})
+    assert buffer.store is None
+    assert buffer.items == 1
+
+    buffer.add(1, {"user1": watched_list_1["user1"]})
+    store = buffer.store
+    assert store is not None
+    assert buffer.watched == {1: {}, 2: {}}
+
+    buffer.add(2, watched_list_2)
+    assert store.items == 1 + count_watched(
+        {"user1": watched_list_1["user1"]}
+    ) + count_watched(watched_list_2)
+
+    buffer.close()
+    assert not os.path.exists(store.path)
+
+
+def test_sync_watched_store():
+    server_1, server_2, users = setup_servers(3, 10, 2)
+    _, expected = sync_watched(
+        {},
+        SyncConfig(dryrun=True),
+        server_1,
+        server_2,
+        users,
+        dict(users),
+        LIBRARIES,
+        LIBRARIES,
+    )
+    expected_writes = (server_1.writes, server_2.writes)
+
+    for watched_store in ["sqlite", "auto"]:
+        server_1, server_2, users = setup_servers(3, 10, 2)
+        changes = sync_watched_store(
+            {},
+            SyncConfig(
+                dryrun=True, watched_store=watched_store, watched_store_threshold=50
+            ),
+            server_1,
+            server_2,
+            users,
+            dict(users),
+            LIBRARIES,
+            LIBRARIES,
+        )
+        assert changes == expected
+        assert server_1.writes + server_2.writes == sum(expected_writes)
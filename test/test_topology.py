@@ -0,0 +1,115 @@
+from types import SimpleNamespace
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+import pytest
+
+from src.topology import load_sync_matrix, load_sync_plan, plan_sync
+
+
+class FakeServer:
+    def __init__(self, server_type: str, name: str) -> None:
+        self.server_type = server_type
+        self.base_url = f"http://{name}:8096/"
+        if server_type == "Plex":
+            self.plex = SimpleNamespace(friendlyName=name)
+        else:
+            self.server_name = name
+
+    def info(self) -> str:
+        return f"{self.server_type} {self.base_url}"
+
+
+plex = FakeServer("Plex", "main")
+jellyfin_1 = FakeServer("Jellyfin", "jellyfin1")
+jellyfin_2 = FakeServer("Jellyfin", "jellyfin2")
+emby = FakeServer("Emby", "emby")
+servers = [plex, jellyfin_1, jellyfin_2, emby]
+
+
+def test_sync_matrix():
+    matrix = load_sync_matrix(
+        {"SYNC_FROM_PLEX_TO_EMBY": "False", "SYNC_FROM_JELLYFIN_TO_PLEX": "false"}
+    )
+    assert len(matrix.directions) == 9
+    assert not matrix.allows(plex, emby)
+    assert matrix.allows(emby, plex)
+    assert not matrix.allows(jellyfin_1, plex)
+    assert matrix.allows(jellyfin_1, jellyfin_2)
+
+
+def test_plan_mesh():
+    matrix = load_sync_matrix({})
+    plan = plan_sync(servers, matrix)
+    assert len(plan.pairs) == 6
+    assert len(plan.writes()) == 12
+    # Server 1 is only gathered once for all its pairs
+    assert len(plan.gathers()) == 9
+
+    # Pairs that are disabled in both directions are skipped
+    matrix = load_sync_matrix(
+        {"SYNC_FROM_JELLYFIN_TO_EMBY": "False", "SYNC_FROM_EMBY_TO_JELLYFIN": "False"}
+    )
+    plan = plan_sync(servers, matrix)
+    assert (jellyfin_1, emby) not in plan.pairs
+    assert (jellyfin_2, emby) not in plan.pairs
+    assert len(plan.pairs) == 4
+
+
+def test_plan_primary():
+    matrix = load_sync_matrix({})
+    plan = load_sync_plan({"SYNC_TOPOLOGY": "primary"}, servers, matrix)
+    assert plan.primary is plex
+    assert plan.pairs == [(plex, jellyfin_1), (plex, jellyfin_2), (plex, emby)]
+    # Every server is gathered once and written to in both directions with the primary
+    assert len(plan.gathers()) == len(servers)
+    assert len(plan.writes()) == 2 * (len(servers) - 1)
+
+    plan = load_sync_plan(
+        {"SYNC_TOPOLOGY": "primary", "SYNC_PRIMARY_SERVER": "http://jellyfin2:8096"},
+        servers,
+        matrix,
+    )
+    assert plan.primary is jellyfin_2
+    assert plan.pairs == [
+        (jellyfin_2, plex),
+        (jellyfin_2, jellyfin_1),
+        (jellyfin_2, emby),
+    ]
+
+    plan = load_sync_plan(
+        {"SYNC_TOPOLOGY": "primary", "SYNC_PRIMARY_SERVER": "Main"}, servers, matrix
+    )
+    assert plan.primary is plex
+
+    # Spokes that can not sync with the primary in either direction are dropped
+    plan = load_sync_plan(
+        {"SYNC_TOPOLOGY": "primary"},
+        servers,
+        load_sync_matrix(
+            {"SYNC_FROM_PLEX_TO_EMBY": "False", "SYNC_FROM_EMBY_TO_PLEX": "False"}
+        ),
+    )
+    assert plan.pairs == [(plex, jellyfin_1), (plex, jellyfin_2)]
+
+    with pytest.raises(Exception):
+        load_sync_plan(
+            {"SYNC_TOPOLOGY": "primary", "SYNC_PRIMARY_SERVER": "unknown"},
+            servers,
+            matrix,
+        )
+
+    with pytest.raises(Exception):
+        load_sync_plan({"SYNC_TOPOLOGY": "star"}, servers, matrix)
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timezone
 import sys
 import os
 
@@ -22,6 +22,7 @@ from src.watched import (
     UserData,
     WatchedStatus,
     cleanup_watched,
+    filter_watched_since,
 )
 
 viewed_date = datetime.today()
@@ -726,3 +727,44 @@ def test_simple_cleanup_watched():
 #
 #    assert return_watched_list_1 == expected_watched_list_1
 #    assert return_watched_list_2 == expected_watched_list_2
+
+
+def test_filter_watched_since():
+    since = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+    def item(title: str, viewed: datetime) -> MediaItem:
+        return MediaItem(
+            identifiers=MediaIdentifiers(title=title),
+            status=WatchedStatus(completed=True, time=0, viewed_date=viewed),
+        )
+
+    library = LibraryData(
+        title="Library",
+        movies=[
+            item("Old", datetime(2015, 1, 1, tzinfo=timezone.utc)),
+            # Naive dates are treated as UTC
+            item("New", datetime(2024, 6, 2)),
+        ],
+        series=[
+            Series(
+                identifiers=MediaIdentifiers(title="Old Show"),
+                episodes=[item("Pilot", datetime(2015, 1, 1, tzinfo=timezone.utc))],
+            ),
+            Series(
+                identifiers=MediaIdentifiers(title="New Show"),
+                episodes=[
+                    item("Pilot", datetime(2015, 1, 1, tzinfo=timezone.utc)),
+                    item("Finale", datetime(2024, 7, 1, tzinfo=timezone.utc)),
+                ],
+            ),
+        ],
+    )
+
+    recent = filter_watched_since(library, since)
+    assert [movie.identifiers.title for movie in recent.movies] == ["New"]
+    assert [series.identifiers.title for series in recent.series] == ["New Show"]
+    assert [episode.identifiers.title for episode in recent.series[0].episodes] == [
+        "Finale"
+    ]
+    # The gathered library is left untouched
+    assert len(library.movies) == 2
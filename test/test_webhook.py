@@ -0,0 +1,251 @@
+from datetime import datetime
+from time import sleep
+import threading
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.config import SyncConfig
+from src.watched import (
+    LibraryData,
+    MediaIdentifiers,
+    MediaItem,
+    WatchedStatus,
+)
+from src.webhook import (
+    WebhookEvent,
+    WebhookProcessor,
+    WebhookQueue,
+    create_webhook_server,
+    parse_webhook,
+    process_webhook_queue,
+)
+from post_webhook import PAYLOAD_DIR, post_payload
+
+PLEX_SERVER_ID = "54664a3d8acc39983675640ec9ce00b70af9cc36"
+JELLYFIN_SERVER_ID = "f4a1b3b6a2f54f0e9b8c5d7e6f1a2b3c"
+EMBY_SERVER_ID = "2b1c8f3e9d7a4c6b5e0f1a2d3c4b5a69"
+
+movie = MediaItem(
+    identifiers=MediaIdentifiers(
+        title="Tears of Steel",
+        locations=("Tears of Steel.mkv",),
+        imdb_id="tt2285752",
+        tmdb_id="133701",
+    ),
+    status=WatchedStatus(completed=True, time=0, viewed_date=datetime.today()),
+)
+
+
+class FakeServer:
+    def __init__(self, server_type: str, server_id: str, watched: bool = True) -> None:
+        self.server_type = server_type
+        self.server_id = server_id
+        self.watched = watched
+        self.updates = []
+
+    def info(self) -> str:
+        return f"{self.server_type} {self.server_id}"
+
+    def get_item_watched(self, user_name, item_id, user_id=None):
+        library = LibraryData(title="Movies")
+        if self.watched:
+            library.movies.append(movie)
+        return user_name, "Movies", "movies", library
+
+    def update_watched(self, actions, user_mapping, library_mapping, dryrun):
+        self.updates.append(actions)
+
+
+def read_payload(name: str) -> bytes:
+    with open(os.path.join(PAYLOAD_DIR, name), "rb") as f:
+        return f.read()
+
+
+def test_parse_webhook():
+    event = parse_webhook(
+        "/jellyfin", read_payload("jellyfin_playback_stop.json"), "application/json"
+    )
+    assert event == WebhookEvent(
+        server_type="Jellyfin",
+        server_id=JELLYFIN_SERVER_ID,
+        event="PlaybackStop",
+        user_name="JellyUser",
+        user_id="5a0b2c3d4e5f40718293a4b5c6d7e8f9",
+        item_id="a8f6e3c0c2b847b0a4d7f3b6d0c1e2f3",
+    )
+
+    event = parse_webhook(
+        "/emby", read_payload("emby_playback_stop.json"), "application/json"
+    )
+    assert event is not None
+    assert event.server_id == EMBY_SERVER_ID
+    assert event.user_name == "EmbyUser"
+    assert event.item_id == "3412"
+
+    event = parse_webhook(
+        "/plex", read_payload("plex_scrobble.json"), "application/json"
+    )
+    assert event is not None
+    assert event.server_id == PLEX_SERVER_ID
+    assert event.user_name == "luigi311"
+    assert event.item_id == "1936545"
+
+    # Playback start does not change the watched status
+    assert (
+        parse_webhook("/plex", read_payload("plex_play.json"), "application/json")
+        is None
+    )
+
+
+def test_parse_plex_multipart():
+    boundary = "----plexboundary"
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="payload"\r\n'
+        "Content-Type: application/json\r\n\r\n"
+    ).encode()
+    body += read_payload("plex_scrobble.json")
+    body += f"\r\n--{boundary}--\r\n".encode()
+
+    event = parse_webhook("/plex", body, f"multipart/form-data; boundary={boundary}")
+    assert event is not None
+    assert event.event == "media.scrobble"
+    assert event.item_id == "1936545"
+
+
+def test_webhook_queue_coalesce():
+    queue = WebhookQueue(debounce=0.2)
+    stop = WebhookEvent(
+        server_type="Plex", event="media.stop", user_name="User", item_id="1"
+    )
+    scrobble = WebhookEvent(
+        server_type="Plex", event="media.scrobble", user_name="user", item_id="1"
+    )
+    other = WebhookEvent(
+        server_type="Plex", event="media.stop", user_name="user", item_id="2"
+    )
+
+    queue.put(stop)
+    queue.put(scrobble)
+    queue.put(other)
+    assert len(queue) == 2
+
+    # Nothing is released before the debounce time passed
+    assert queue.get(timeout=0.05) is None
+
+    assert queue.get(timeout=1) == scrobble
+    assert queue.get(timeout=1) == other
+    assert queue.get(timeout=0.05) is None
+
+
+def test_webhook_processor():
+    plex = FakeServer("Plex", PLEX_SERVER_ID)
+    jellyfin = FakeServer("Jellyfin", JELLYFIN_SERVER_ID)
+    emby = FakeServer("Emby", EMBY_SERVER_ID)
+    processor = WebhookProcessor(
+        {}, SyncConfig(), [plex, jellyfin, emby], lambda s1, s2: True
+    )
+
+    processor.process(
+        WebhookEvent(
+            server_type="Jellyfin",
+            server_id=JELLYFIN_SERVER_ID,
+            event="PlaybackStop",
+            user_name="JellyUser",
+            item_id="a8f6e3c0c2b847b0a4d7f3b6d0c1e2f3",
+        )
+    )
+    assert jellyfin.updates == []
+    assert len(plex.updates) == 1
+    assert len(emby.updates) == 1
+    action = plex.updates[0][0]
+    assert (action.user, action.library) == ("jellyuser", "Movies")
+    assert action.action == "mark_watched"
+    assert action.identifiers == movie.identifiers
+
+    # Blacklisted users are not synced
+    processor.config = SyncConfig(blacklist_users=["jellyuser"])
+    processor.process(
+        WebhookEvent(
+            server_type="Jellyfin",
+            server_id=JELLYFIN_SERVER_ID,
+            event="PlaybackStop",
+            user_name="jellyuser",
+            item_id="a8f6e3c0c2b847b0a4d7f3b6d0c1e2f3",
+        )
+    )
+    assert len(plex.updates) == 1
+
+    # Unknown servers are ignored
+    processor.config = SyncConfig()
+    processor.process(
+        WebhookEvent(
+            server_type="Emby",
+            server_id="unknown",
+            event="playback.stop",
+            user_name="EmbyUser",
+            item_id="3412",
+        )
+    )
+    assert len(plex.updates) == 1
+
+
+def test_webhook_server():
+    plex = FakeServer("Plex", PLEX_SERVER_ID)
+    jellyfin = FakeServer("Jellyfin", JELLYFIN_SERVER_ID)
+    # Nothing watched on emby, so its event does not result in any updates
+    emby = FakeServer("Emby", EMBY_SERVER_ID, watched=False)
+    processor = WebhookProcessor(
+        {},
+        SyncConfig(),
+        [plex, jellyfin, emby],
+        lambda s1, s2: s2.server_type != "Emby",
+    )
+
+    queue = WebhookQueue(debounce=0.1)
+    webhook_server = create_webhook_server("127.0.0.1", 0, queue, token="secret")
+    url = f"http://127.0.0.1:{webhook_server.server_address[1]}"
+    stop = threading.Event()
+    threading.Thread(target=webhook_server.serve_forever, daemon=True).start()
+    worker = threading.Thread(
+        target=process_webhook_queue, args=(queue, processor, stop), daemon=True
+    )
+    worker.start()
+
+    try:
+        path = os.path.join(PAYLOAD_DIR, "jellyfin_playback_stop.json")
+        assert post_payload(url, path).status_code == 403
+        assert post_payload(url, path, "wrong").status_code == 403
+
+        for name in sorted(os.listdir(PAYLOAD_DIR)):
+            response = post_payload(url, os.path.join(PAYLOAD_DIR, name), "secret")
+            assert response.status_code == 200
+
+        for _ in range(50):
+            if len(queue) == 0 and plex.updates and jellyfin.updates:
+                break
+            sleep(0.1)
+    finally:
+        stop.set()
+        webhook_server.shutdown()
+        webhook_server.server_close()
+        worker.join()
+
+    # Plex event is synced to jellyfin, jellyfin event to plex, emby is never a target
+    assert len(plex.updates) == 1
+    assert len(jellyfin.updates) == 1
+    assert emby.updates == []
+    assert jellyfin.updates[0][0].user == "luigi311"
+    assert plex.updates[0][0].user == "jellyuser"
@@ -0,0 +1,392 @@
+from time import monotonic, sleep
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+import sys
+import os
+
+# getting the name of the directory
+# where the this file is present.
+current = os.path.dirname(os.path.realpath(__file__))
+
+# Getting the parent directory name
+# where the current directory is present.
+parent = os.path.dirname(current)
+
+# adding the parent directory to
+# the sys.path.
+sys.path.append(parent)
+
+from src.webhook import WebhookQueue
+from src.websocket import (
+    OPCODE_CLOSE,
+    OPCODE_PING,
+    OPCODE_PONG,
+    OPCODE_TEXT,
+    WEBSOCKET_GUID,
+    UserDataListener,
+    WebSocketClient,
+    WebSocketClosed,
+    parse_user_data_message,
+)
+
+USER_ID = "5a0b2c3d4e5f40718293a4b5c6d7e8f9"
+ITEM_ID = "a8f6e3c0c2b847b0a4d7f3b6d0c1e2f3"
+
+user_data_changed = {
+    "MessageType": "UserDataChanged",
+    "Data": {
+        "UserId": USER_ID,
+        "UserDataList": [
+            {
+                "ItemId": ITEM_ID,
+                "Played": True,
+                "PlaybackPositionTicks": 0,
+                "Key": "133701",
+            }
+        ],
+    },
+}
+
+
+def encode_frame(opcode: int, payload: bytes, final: bool = True) -> bytes:
+    # Frames sent by the server are not masked
+    header = bytes([(0x80 if final else 0) | opcode])
+    if len(payload) < 126:
+        header += bytes([len(payload)])
+    elif len(payload) < 2**16:
+        header += bytes([126]) + struct.pack("!H", len(payload))
+    else:
+        header += bytes([127]) + struct.pack("!Q", len(payload))
+    return header + payload
+
+
+def recv_exact(conn: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_frame(conn: socket.socket) -> tuple[int, bytes] | None:
+    header = recv_exact(conn, 2)
+    if len(header) < 2:
+        return None
+
+    # Frames sent by the client are always masked
+    assert header[1] & 0x80
+    length = header[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", recv_exact(conn, 2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", recv_exact(conn, 8))[0]
+    mask = recv_exact(conn, 4)
+    payload = recv_exact(conn, length)
+    return header[0] & 0x0F, bytes(
+        byte ^ mask[index % 4] for index, byte in enumerate(payload)
+    )
+
+
+class StubWebSocketServer:
+    """
+    Local websocket server that sends a scripted list of frames to every
+    connection, records the frames the client sends back and then closes.
+    """
+
+    def __init__(
+        self, frames: list[bytes], hold: float = 0.2, delay: float = 0
+    ) -> None:
+        self.frames = frames
+        self.hold = hold
+        # Seconds to wait between the scripted frames
+        self.delay = delay
+        self.connections = 0
+        self.paths: list[str] = []
+        self.received: list[tuple[int, bytes]] = []
+        # Whether the scripted frames end with a close frame of the server
+        self.closed = bool(frames) and frames[-1][0] & 0x0F == OPCODE_CLOSE
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn: socket.socket) -> None:
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += conn.recv(4096)
+
+        lines = request.decode().split("\r\n")
+        self.paths.append(lines[0].split(" ")[1])
+        key = next(
+            line.split(":", 1)[1].strip()
+            for line in lines
+            if line.lower().startswith("sec-websocket-key")
+        )
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+        conn.sendall(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+            ).encode()
+        )
+        self.connections += 1
+
+        for frame in self.frames:
+            conn.sendall(frame)
+            sleep(self.delay)
+
+        # Keep the connection open for hold seconds unless the client closes it
+        end = monotonic() + self.hold
+        try:
+            while (remaining := end - monotonic()) > 0:
+                conn.settimeout(remaining)
+                frame = read_frame(conn)
+                if frame is None:
+                    break
+                self.received.append(frame)
+                if frame[0] == OPCODE_CLOSE:
+                    # Answer the closing handshake of the client
+                    if not self.closed:
+                        conn.sendall(encode_frame(OPCODE_CLOSE, frame[1]))
+                    break
+        except OSError:
+            pass
+
+        conn.close()
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class FakeServer:
+    def __init__(self, url: str) -> None:
+        self.server_type = "Jellyfin"
+        self.server_id = "f4a1b3b6a2f54f0e9b8c5d7e6f1a2b3c"
+        self.users = {"JellyUser": USER_ID}
+        self.url = url
+        self.polls = 0
+
+    def get_socket_url(self) -> str:
+        return self.url
+
+    def get_recent_user_data(self, since):
+        self.polls += 1
+        return [("JellyUser", USER_ID, "polled")]
+
+
+def test_websocket_client():
+    text = json.dumps(user_data_changed).encode()
+    stub = StubWebSocketServer(
+        [
+            encode_frame(OPCODE_PING, b"ping"),
+            encode_frame(OPCODE_TEXT, text[:10], final=False),
+            encode_frame(0x0, text[10:]),
+            encode_frame(OPCODE_TEXT, b"{}"),
+            encode_frame(OPCODE_CLOSE, struct.pack("!H", 1000)),
+        ]
+    )
+
+    client = WebSocketClient(f"ws://127.0.0.1:{stub.port}/socket?api_key=token")
+    client.connect()
+    assert json.loads(client.recv()) == user_data_changed
+    assert client.recv() == "{}"
+
+    try:
+        client.recv()
+        assert False, "Expected the connection to be closed"
+    except WebSocketClosed:
+        pass
+
+    sleep(0.1)
+    stub.close()
+    assert stub.paths == ["/socket?api_key=token"]
+    assert (OPCODE_PONG, b"ping") in stub.received
+    assert stub.received[-1][0] == OPCODE_CLOSE
+
+
+def test_websocket_fragments():
+    text = json.dumps(user_data_changed).encode()
+    stub = StubWebSocketServer(
+        [
+            encode_frame(OPCODE_TEXT, text[:10], final=False),
+            # Control frames can arrive between the fragments of a message
+            encode_frame(OPCODE_PING, b"ping"),
+            encode_frame(0x0, text[10:20], final=False),
+            encode_frame(0x0, b"", final=False),
+            encode_frame(0x0, text[20:]),
+        ]
+    )
+
+    client = WebSocketClient(f"ws://127.0.0.1:{stub.port}/socket")
+    client.connect()
+    assert json.loads(client.recv()) == user_data_changed
+    client.close()
+
+    stub.close()
+    assert stub.received[0] == (OPCODE_PONG, b"ping")
+
+
+def test_websocket_payload_lengths():
+    # 7 bit, 16 bit and 64 bit payload lengths
+    messages = ["a" * 125, "b" * 126, "c" * 2**16, "d" * 70_000]
+    stub = StubWebSocketServer(
+        [encode_frame(OPCODE_TEXT, message.encode()) for message in messages], hold=5
+    )
+
+    client = WebSocketClient(f"ws://127.0.0.1:{stub.port}/socket")
+    client.connect()
+    assert [client.recv() for _ in messages] == messages
+    for message in messages:
+        client.send(message)
+    client.close()
+
+    stub.close()
+    assert stub.received[:-1] == [
+        (OPCODE_TEXT, message.encode()) for message in messages
+    ]
+
+
+def test_websocket_close_handshake():
+    # The client starts the handshake and waits for the close frame of the server
+    stub = StubWebSocketServer([], hold=5)
+    client = WebSocketClient(f"ws://127.0.0.1:{stub.port}/socket")
+    client.connect()
+    start = monotonic()
+    client.close()
+    assert monotonic() - start < 1
+    assert client.sock is None
+    assert stub.received == [(OPCODE_CLOSE, struct.pack("!H", 1000))]
+    stub.close()
+
+    # The server starts it, the client answers with the same status code
+    stub = StubWebSocketServer([encode_frame(OPCODE_CLOSE, struct.pack("!H", 1001))])
+    client = WebSocketClient(f"ws://127.0.0.1:{stub.port}/socket")
+    client.connect()
+    try:
+        client.recv()
+        assert False, "Expected the connection to be closed"
+    except WebSocketClosed:
+        pass
+
+    sleep(0.1)
+    stub.close()
+    assert client.sock is None
+    assert stub.received == [(OPCODE_CLOSE, struct.pack("!H", 1001))]
+
+
+def test_parse_user_data_message():
+    server = FakeServer("")
+    events = parse_user_data_message(server, user_data_changed)
+    assert len(events) == 1
+    assert events[0].user_name == "JellyUser"
+    assert events[0].item_id == ITEM_ID
+    assert events[0].server_id == server.server_id
+
+    assert parse_user_data_message(server, {"MessageType": "Sessions"}) == []
+    assert (
+        parse_user_data_message(
+            server,
+            {"MessageType": "UserDataChanged", "Data": {"UserId": "unknown"}},
+        )
+        == []
+    )
+
+
+def test_user_data_listener():
+    stub = StubWebSocketServer(
+        [
+            encode_frame(
+                OPCODE_TEXT,
+                json.dumps({"MessageType": "ForceKeepAlive", "Data": 60}).encode(),
+            ),
+            encode_frame(OPCODE_TEXT, json.dumps(user_data_changed).encode()),
+        ]
+    )
+    server = FakeServer(f"ws://127.0.0.1:{stub.port}/socket")
+    queue = WebhookQueue(debounce=0)
+    listener = UserDataListener(
+        server, queue, poll_interval=0.1, retry_interval=0.1, max_retry_interval=0.2
+    )
+    thread = threading.Thread(target=listener.run, daemon=True)
+    thread.start()
+
+    # The stub drops every connection, the listener has to reconnect and poll meanwhile
+    for _ in range(50):
+        if stub.connections >= 2:
+            break
+        sleep(0.1)
+
+    listener.stop()
+    thread.join(timeout=5)
+    stub.close()
+
+    assert not thread.is_alive()
+    assert stub.connections >= 2
+    assert server.polls >= 2
+
+    item_ids = set()
+    while event := queue.get(timeout=0):
+        item_ids.add(event.item_id)
+    assert item_ids == {ITEM_ID, "polled"}
+
+    keep_alives = [
+        frame
+        for frame in stub.received
+        if frame == (OPCODE_TEXT, json.dumps({"MessageType": "KeepAlive"}).encode())
+    ]
+    assert keep_alives
+
+
+def test_user_data_listener_keep_alive():
+    # Changes arrive faster than the socket timeout, the keep alive is still due
+    stub = StubWebSocketServer(
+        [
+            encode_frame(
+                OPCODE_TEXT,
+                json.dumps({"MessageType": "ForceKeepAlive", "Data": 0.4}).encode(),
+            )
+        ]
+        + [encode_frame(OPCODE_TEXT, json.dumps(user_data_changed).encode())] * 20,
+        hold=0.05,
+        delay=0.05,
+    )
+    server = FakeServer(f"ws://127.0.0.1:{stub.port}/socket")
+    queue = WebhookQueue(debounce=0)
+    listener = UserDataListener(server, queue, poll_interval=10, retry_interval=10)
+    thread = threading.Thread(target=listener.run, daemon=True)
+    thread.start()
+
+    # The listener polls again once the stub dropped the connection
+    for _ in range(50):
+        if server.polls >= 2:
+            break
+        sleep(0.1)
+
+    listener.stop()
+    thread.join(timeout=5)
+    stub.close()
+
+    keep_alives = [
+        frame
+        for frame in stub.received
+        if frame == (OPCODE_TEXT, json.dumps({"MessageType": "KeepAlive"}).encode())
+    ]
+    assert stub.connections == 1
+    assert len(keep_alives) >= 3